@@ -0,0 +1,270 @@
+import json
+import os
+import time
+import numpy as np
+import EmbeddingStore
+import SimFunctions
+import kNearestNeighbors
+
+
+class AnnIndex:
+    """
+    An approximate nearest neighbor index over the vocabulary of an embeddings file, for when the neighbors of many
+    tokens get queried over and over against the same file (e.g. dictionary curation), and a full scan
+    (kNearestNeighbors.find_k_nearest_neighbors_multi) per query is too slow.
+
+    It is a random-projection LSH index: each of num_tables tables hashes a vector to the signs of its projections
+    on num_bits random hyperplanes, so vectors at a small angle tend to share a bucket. A query collects the
+    members of its bucket in every table (plus, with probes > 0, of the buckets that differ from it in one of its
+    least certain bits), and ranks those candidates by their exact absolute cosine similarity. Since the similarity
+    is absolute, the buckets of the negated query (the complement of its hash) are searched too.
+
+    More tables and more probes find more of the true neighbors (see recall_benchmark) at the cost of more
+    candidates per query; more bits make the buckets smaller. The index is saved next to the embeddings file as
+    <embeddings_file>.ann-<num_tables>x<num_bits>-<seed>.npz and rebuilt if the embeddings file changes.
+    """
+
+    FORMAT_VERSION = 1
+
+    _registry = dict()  # index file -> AnnIndex
+
+    def __init__(self, table, rows, planes, sorted_codes, orders):
+        """
+        Use build, load or get rather than this.
+        :param table: the EmbeddingTable of the embeddings file
+        :param rows: the matrix rows of the indexed tokens (all but kNearestNeighbors.DUMMY_TOKENS), in token order
+        :param planes: a num_tables x num_bits x dimensions array of hyperplane normals
+        :param sorted_codes: a num_tables x len(rows) array, with the (sorted) hash of every token in every table
+        :param orders: a num_tables x len(rows) array; orders[t][i] is the token with hash sorted_codes[t][i]
+        """
+        self.table = table
+        self.rows = rows
+        self.tokens = [table.vocab[row] for row in rows]
+        self.planes = planes
+        self.sorted_codes = sorted_codes
+        self.orders = orders
+        self.num_tables, self.num_bits = planes.shape[0], planes.shape[1]
+        self._positions = dict()
+        for i in range(0, len(self.tokens)):
+            self._positions[self.tokens[i]] = i
+        self._norms = None
+
+    @staticmethod
+    def index_file_name(embeddings_file, num_tables, num_bits, seed):
+        return embeddings_file+'.ann-'+str(num_tables)+'x'+str(num_bits)+'-'+str(seed)+'.npz'
+
+    def _read_rows(self, positions):
+        """
+        :param positions: positions of tokens in self.tokens
+        :return: their vectors, as a float64 matrix
+        """
+        rows = self.rows[positions]
+        if self.table.is_sparse:
+            return self.table.matrix[rows].toarray().astype(np.float64)
+        return np.asarray(self.table.matrix[rows], dtype=np.float64).reshape((len(rows), self.table.dimensions))
+
+    def _hash(self, vectors):
+        """
+        :param vectors: an n x dimensions matrix
+        :return: a tuple (codes, projections): the n x num_tables int64 hashes, and the n x num_tables x num_bits
+        projections they were computed from
+        """
+        projections = np.einsum('nd,tbd->ntb', vectors, self.planes)
+        codes = ((projections >= 0) * (np.int64(1) << np.arange(self.num_bits, dtype=np.int64))).sum(axis=2)
+        return codes, projections
+
+    @staticmethod
+    def build(embeddings_file, num_tables=8, num_bits=12, seed=1, block_size=4096):
+        """
+        Builds the index for embeddings_file and saves it next to it.
+        :param embeddings_file: the json lines embeddings file
+        :param num_tables: the number of hash tables
+        :param num_bits: the number of hyperplanes per table (at most 62)
+        :param seed: the seed of the hyperplanes
+        :param block_size: the number of vectors hashed at a time
+        :return: an AnnIndex
+        """
+        if not 0 < num_bits <= 62:
+            raise Exception('num_bits must be between 1 and 62')
+        table = EmbeddingStore.EmbeddingStore.get_table(embeddings_file)
+        indexed = table.without(kNearestNeighbors.DUMMY_TOKENS)
+        rows = np.sort(indexed.indices(list(indexed.keys())))
+        planes = np.random.RandomState(seed).randn(num_tables, num_bits, table.dimensions)
+        index = AnnIndex(table, rows, planes, None, None)
+        codes = np.zeros((len(rows), num_tables), dtype=np.int64)
+        for start in range(0, len(rows), block_size):
+            positions = np.arange(start, min(start+block_size, len(rows)))
+            codes[positions] = index._hash(index._read_rows(positions))[0]
+        index.orders = np.argsort(codes.T, axis=1, kind='mergesort')
+        index.sorted_codes = np.take_along_axis(codes.T, index.orders, axis=1) if hasattr(np, 'take_along_axis') \
+            else np.array([codes[index.orders[t], t] for t in range(0, num_tables)])
+
+        index_file = AnnIndex.index_file_name(embeddings_file, num_tables, num_bits, seed)
+        signature = EmbeddingStore.EmbeddingStore._source_signature(embeddings_file)
+        signature['ann_version'] = AnnIndex.FORMAT_VERSION
+        try:
+            tmp_file = index_file+'.tmp.npz'
+            np.savez(tmp_file, rows=rows, planes=planes, sorted_codes=index.sorted_codes, orders=index.orders,
+                     signature=np.array(json.dumps(signature, sort_keys=True)))
+            os.rename(tmp_file, index_file)
+        except (IOError, OSError) as e:
+            print 'Warning. Could not write the nearest neighbor index: ',
+            print e
+        AnnIndex._registry[index_file] = index
+        return index
+
+    @staticmethod
+    def load(embeddings_file, num_tables=8, num_bits=12, seed=1):
+        """
+        :param embeddings_file: the json lines embeddings file
+        :param num_tables: see build
+        :param num_bits: see build
+        :param seed: see build
+        :return: the saved AnnIndex, or None if there is none or it was built from an older embeddings file
+        """
+        index_file = AnnIndex.index_file_name(embeddings_file, num_tables, num_bits, seed)
+        if not os.path.exists(index_file):
+            return None
+        saved = np.load(index_file)
+        signature = EmbeddingStore.EmbeddingStore._source_signature(embeddings_file)
+        signature['ann_version'] = AnnIndex.FORMAT_VERSION
+        if json.loads(str(saved['signature'])) != json.loads(json.dumps(signature)):
+            return None
+        return AnnIndex(EmbeddingStore.EmbeddingStore.get_table(embeddings_file), saved['rows'], saved['planes'],
+                        saved['sorted_codes'], saved['orders'])
+
+    @staticmethod
+    def get(embeddings_file, num_tables=8, num_bits=12, seed=1):
+        """
+        The index for embeddings_file with these settings: kept in memory once loaded, loaded if it was saved,
+        built (and saved) otherwise.
+        :return: an AnnIndex
+        """
+        index_file = AnnIndex.index_file_name(embeddings_file, num_tables, num_bits, seed)
+        index = AnnIndex._registry.get(index_file)
+        if index is not None and index.table is EmbeddingStore.EmbeddingStore.get_table(embeddings_file):
+            return index
+        index = AnnIndex.load(embeddings_file, num_tables, num_bits, seed)
+        if index is None:
+            print 'building nearest neighbor index for: ',
+            print embeddings_file
+            index = AnnIndex.build(embeddings_file, num_tables, num_bits, seed)
+        AnnIndex._registry[index_file] = index
+        return index
+
+    def candidates(self, vector, probes=0):
+        """
+        :param vector: a query vector
+        :param probes: the number of extra buckets searched per table: the ones that differ from the query's in
+        one of its probes least certain bits (those whose projections are closest to 0)
+        :return: a sorted array of the positions (in self.tokens) of the candidate neighbors
+        """
+        codes, projections = self._hash(np.asarray(vector, dtype=np.float64).reshape((1, -1)))
+        mask = (np.int64(1) << self.num_bits) - 1
+        found = list()
+        for t in range(0, self.num_tables):
+            probe_codes = [codes[0, t]]
+            for bit in np.argsort(np.abs(projections[0, t]), kind='mergesort')[0:probes]:
+                probe_codes.append(codes[0, t] ^ (np.int64(1) << bit))
+            for code in probe_codes:
+                for c in (code, code ^ mask):
+                    start = np.searchsorted(self.sorted_codes[t], c, side='left')
+                    end = np.searchsorted(self.sorted_codes[t], c, side='right')
+                    found.append(self.orders[t][start:end])
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def query(self, seed_tokens, k=10, probes=0):
+        """
+        :param seed_tokens: a list of tokens that must be in the index
+        :param k:
+        :param probes: see candidates
+        :return: a dictionary where each seed token references the list of its (at most) k approximate nearest
+        neighbors, by decreasing absolute cosine similarity
+        """
+        results = dict()
+        for seed_token in seed_tokens:
+            position = self._positions[seed_token]
+            vector = self._read_rows(np.array([position]))[0]
+            candidates = self.candidates(vector, probes)
+            candidates = candidates[candidates != position]
+            scores = SimFunctions.SimFunctions.abs_cosine_sim_batch(vector, self._read_rows(candidates))
+            top = np.lexsort((candidates, -scores))[0:k]
+            results[seed_token] = [self.tokens[i] for i in candidates[top]]
+        return results
+
+    @staticmethod
+    def find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=10, suppress_print=True, num_tables=8,
+                                       num_bits=12, probes=2):
+        """
+        The approximate version of kNearestNeighbors.find_k_nearest_neighbors_multi, with the same inputs and
+        output. The index is built on the first call for embeddings_file (see get).
+        :param embeddings_file: the json lines embeddings file
+        :param seed_tokens: a set of tokens that must occur in the embeddings_file
+        :param k:
+        :param suppress_print:
+        :param num_tables: see build
+        :param num_bits: see build
+        :param probes: see candidates. The recall/speed knob that doesn't require a rebuild.
+        :return: a dictionary where each seed token references the list of its k (approximate) nearest neighbors
+        """
+        results = AnnIndex.get(embeddings_file, num_tables, num_bits).query(seed_tokens, k=k, probes=probes)
+        for seed_token in seed_tokens:
+            if not suppress_print:
+                print 'seed_token: ',
+                print seed_token
+                print results[seed_token]
+                print '\n'
+        return results
+
+    @staticmethod
+    def recall_benchmark(embeddings_file, seed_tokens=None, num_seeds=100, k=10,
+                         settings=((4, 12, 0), (8, 12, 0), (8, 12, 2), (16, 12, 2), (16, 10, 4)), seed=1):
+        """
+        Compares the index against exact search (kNearestNeighbors.k_nearest_neighbors_blocked), for choosing
+        settings. Prints a line per setting.
+        :param embeddings_file: the json lines embeddings file
+        :param seed_tokens: the tokens to query. If None, num_seeds tokens are sampled from the vocabulary.
+        :param num_seeds:
+        :param k:
+        :param settings: a list of (num_tables, num_bits, probes)
+        :param seed: for the sample of seed tokens and for the hyperplanes
+        :return: a list with a dictionary per setting: num_tables, num_bits, probes, recall (the average fraction
+        of the exact k nearest neighbors found), candidates (the average number of candidates scored per query),
+        build_seconds and query_seconds (per query), and exact_query_seconds
+        """
+        table = EmbeddingStore.EmbeddingStore.get_table(embeddings_file).without(kNearestNeighbors.DUMMY_TOKENS)
+        if seed_tokens is None:
+            tokens = sorted(table.keys())
+            random_state = np.random.RandomState(seed)
+            seed_tokens = [tokens[i] for i in random_state.choice(len(tokens), min(num_seeds, len(tokens)),
+                                                                  replace=False)]
+        start = time.time()
+        exact = kNearestNeighbors.k_nearest_neighbors_blocked(table, seed_tokens, k=k)
+        exact_seconds = (time.time()-start)/max(len(seed_tokens), 1)
+
+        results = list()
+        for num_tables, num_bits, probes in settings:
+            start = time.time()
+            index = AnnIndex.get(embeddings_file, num_tables, num_bits, seed)
+            build_seconds = time.time()-start
+            start = time.time()
+            approximate = index.query(seed_tokens, k=k, probes=probes)
+            query_seconds = (time.time()-start)/max(len(seed_tokens), 1)
+            recalls = list()
+            candidates = list()
+            for seed_token in seed_tokens:
+                if exact[seed_token]:
+                    recalls.append(len(set(exact[seed_token]) & set(approximate[seed_token]))
+                                   / float(len(exact[seed_token])))
+                candidates.append(len(index.candidates(index._read_rows(
+                    np.array([index._positions[seed_token]]))[0], probes)))
+            result = {'num_tables': num_tables, 'num_bits': num_bits, 'probes': probes,
+                      'recall': float(np.mean(recalls)) if recalls else 1.0,
+                      'candidates': float(np.mean(candidates)), 'build_seconds': build_seconds,
+                      'query_seconds': query_seconds, 'exact_query_seconds': exact_seconds}
+            print 'tables: '+str(num_tables)+', bits: '+str(num_bits)+', probes: '+str(probes)+', recall@'+str(k)+\
+                  ': '+str(round(result['recall'], 3))+', candidates: '+str(int(result['candidates']))+' of '+\
+                  str(len(index.tokens))+', query: '+str(round(query_seconds*1000, 2))+' ms (exact: '+\
+                  str(round(exact_seconds*1000, 2))+' ms)'
+            results.append(result)
+        return results
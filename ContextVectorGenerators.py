@@ -1,11 +1,21 @@
 import TextPreprocessors
+import numpy as np
+from scipy import sparse
 
 class ContextVectorGenerators:
     """
     Each non-protected method in this class has the same signature and is static. Typically, these functions will
     be passed in as parameters to some function in TokenSupervised, in order for datasets to be prepared.
+
+    The symmetric generators also take an optional spans argument: the (start, end) token spans of word in
+    list_of_words, if the caller already knows them (e.g. from TextPreprocessors.build_token_position_index).
+    Otherwise they search list_of_words for word themselves.
     """
 
+    # row ids and prefix sums of the last document a prefix-sum/memoized generator was called on. The prep functions
+    # call the generator once per annotated word with the same list_of_words, so this gets reused.
+    _document_cache = dict()
+
     @staticmethod
     def _add_vectors(big_vector, little_vector):
         """
@@ -22,7 +32,25 @@ class ContextVectorGenerators:
                 big_vector[i] += little_vector[i]
 
     @staticmethod
-    def symmetric_generator(word, list_of_words, embeddings_dict, window_size=5, multi=False):
+    def _sum_vectors(tokens, embeddings_dict):
+        """
+        Sums the vectors of the tokens that are in embeddings_dict, without copying any of them into lists. If
+        embeddings_dict is an EmbeddingTable, all the rows are fetched in one batched lookup.
+        :param tokens: a list of tokens
+        :param embeddings_dict: a dict or EmbeddingTable
+        :return: the (float64) sum as a numpy array, or None if none of the tokens are in embeddings_dict
+        """
+        tokens = [t for t in tokens if t in embeddings_dict]
+        if not tokens:
+            return None
+        if hasattr(embeddings_dict, 'lookup'):
+            vecs = embeddings_dict.lookup(tokens)
+        else:
+            vecs = np.array([embeddings_dict[t] for t in tokens])
+        return vecs.sum(axis=0, dtype=np.float64)
+
+    @staticmethod
+    def symmetric_generator(word, list_of_words, embeddings_dict, window_size=5, multi=False, spans=None):
         """
         The algorithm will search for occurrences of word in list_of_words (there could be multiple or even 0), then
         symmetrically look backward and forward up to the window_size. If the words in the window (not including
@@ -34,26 +62,18 @@ class ContextVectorGenerators:
         :param embeddings_dict:
         :param window_size
         :param multi: If True, then word is multi-token. You must tokenize it first, then generate context embedd.
+        :param spans: the (start, end) spans of word in list_of_words, if known. We won't search for word then.
         :return: a list of lists, with each inner list representing the context vectors. If there are no occurrences
         of word, will return None. Check for this in your code.
         """
         if not list_of_words:
             return None
         context_vecs = list()
-        if multi:
-            word_tokens = TextPreprocessors.TextPreprocessors.tokenize_string(word)
-        for i in range(0, len(list_of_words)):
-            if multi:
-                if list_of_words[i] == word_tokens[0] and list_of_words[i:i + len(word_tokens)] == word_tokens:
-                    min_index = i-window_size
-                    max_index = ((i + len(word_tokens))-1)+window_size
-                else:
-                    continue
-            elif list_of_words[i] != word:
-                continue
-            else:
-                min_index = i-window_size
-                max_index = i+window_size
+        if spans is None:
+            spans = ContextVectorGenerators._find_occurrences(word, list_of_words, multi)
+        for start, end in spans:
+            min_index = start-window_size
+            max_index = (end-1)+window_size
 
             # make sure the indices are within range
             if min_index < 0:
@@ -61,31 +81,279 @@ class ContextVectorGenerators:
             if max_index >= len(list_of_words):
                 max_index = len(list_of_words)-1
 
-            new_context_vec = []
-            for j in range(min_index, max_index+1):
-                # if multi:   # we do not want the vector of the word/work_tokens itself
-                #     if j >= i and j < i+len(word_tokens):
-                #         continue
-                # elif j == i:
-                #     continue
-
-                if list_of_words[j] not in embeddings_dict: # is the word even in our embeddings?
-                    continue
-
-                vec = list(embeddings_dict[list_of_words[j]])  # deep copy of list
-                if not new_context_vec:
-                    new_context_vec = vec
-                else:
-                    ContextVectorGenerators._add_vectors(new_context_vec, vec)
-            if not new_context_vec:
+            # we do not skip the word/word_tokens itself; its vector is part of the context
+            new_context_vec = ContextVectorGenerators._sum_vectors(list_of_words[min_index:max_index+1],
+                                                                   embeddings_dict)
+            if new_context_vec is None:
                 continue
             else:
-                context_vecs.append(new_context_vec)
+                context_vecs.append(new_context_vec.tolist())
         if not context_vecs:
             return None
         else:
             return context_vecs
 
+    @staticmethod
+    def _document_rows(list_of_words, embeddings_dict):
+        """
+        Turns list_of_words into an int32 array of embedding rows (-1 if a word is not in embeddings_dict). Results
+        for the last document are cached (by identity, so don't modify list_of_words in between calls).
+        :param list_of_words:
+        :param embeddings_dict: an EmbeddingTable or a plain dict
+        :return: a tuple (ids, matrix), where matrix holds the rows that ids refer to
+        """
+        cache = ContextVectorGenerators._document_cache
+        if cache.get('words') is list_of_words and cache.get('length') == len(list_of_words) \
+                and cache.get('embeddings') is embeddings_dict:
+            return cache['ids'], cache['matrix']
+
+        if hasattr(embeddings_dict, 'indices'):
+            ids = embeddings_dict.indices(list_of_words).astype(np.int32)
+            matrix = embeddings_dict.matrix
+        else:
+            rows = dict()
+            for w in list_of_words:
+                if w not in rows and w in embeddings_dict:
+                    rows[w] = len(rows)
+            ids = np.array([rows.get(w, -1) for w in list_of_words], dtype=np.int32)
+            tokens = sorted(rows, key=rows.get)
+            matrix = np.array([embeddings_dict[w] for w in tokens]) if tokens else np.zeros((0, 0))
+
+        cache.clear()
+        cache['words'] = list_of_words
+        cache['length'] = len(list_of_words)
+        cache['embeddings'] = embeddings_dict
+        cache['ids'] = ids
+        cache['matrix'] = matrix
+        return ids, matrix
+
+    @staticmethod
+    def _document_prefix_sums(list_of_words, embeddings_dict):
+        """
+        Builds the cumulative sums of the vectors (see _document_rows) of list_of_words and of the number of
+        embedded words. The sum over list_of_words[i:j] is then sums[j]-sums[i], whatever j-i is. Results for the
+        last document are cached, like _document_rows.
+        :param list_of_words:
+        :param embeddings_dict: an EmbeddingTable or a plain dict
+        :return: a tuple (sums, counts): a (len+1) x dimensions float64 matrix and a (len+1) int array
+        """
+        ids, matrix = ContextVectorGenerators._document_rows(list_of_words, embeddings_dict)
+        cache = ContextVectorGenerators._document_cache
+        if 'sums' in cache:
+            return cache['sums'], cache['counts']
+
+        present = ids >= 0
+        sums = np.zeros((len(list_of_words)+1, matrix.shape[1]), dtype=np.float64)
+        if present.any():
+            sums[1:][present] = matrix[ids[present]]
+        np.cumsum(sums, axis=0, out=sums)
+        counts = np.zeros(len(list_of_words)+1, dtype=np.int64)
+        np.cumsum(present, out=counts[1:])
+
+        cache['sums'] = sums
+        cache['counts'] = counts
+        return sums, counts
+
+    @staticmethod
+    def clear_document_cache():
+        """
+        The document cache holds on to the last document and embeddings table; call this once you are done with
+        them (e.g. after releasing the embeddings) so they can be garbage collected.
+        :return: None
+        """
+        ContextVectorGenerators._document_cache.clear()
+
+    @staticmethod
+    def _find_occurrences(word, list_of_words, multi=False):
+        """
+        :return: a list of (start, end) token spans (end exclusive) where word occurs in list_of_words
+        """
+        spans = list()
+        if multi:
+            word_tokens = TextPreprocessors.TextPreprocessors.tokenize_string_cached(word)
+            if not word_tokens:
+                return spans
+            for i in range(0, len(list_of_words)):
+                if list_of_words[i] == word_tokens[0] and list_of_words[i:i + len(word_tokens)] == word_tokens:
+                    spans.append((i, i + len(word_tokens)))
+        else:
+            for i in range(0, len(list_of_words)):
+                if list_of_words[i] == word:
+                    spans.append((i, i + 1))
+        return spans
+
+    @staticmethod
+    def prefix_sum_symmetric_generator(word, list_of_words, embeddings_dict, window_size=5, multi=False,
+                                       spans=None):
+        """
+        Same inputs and outputs as symmetric_generator, but with a numpy engine: each document is converted to
+        embedding row ids and prefix sums once (see _document_prefix_sums), after which every window sum costs
+        O(dimensions) regardless of window_size. The outputs match symmetric_generator up to floating point
+        rounding of the (float64) sums.
+        :param word:
+        :param list_of_words: e.g. high_recall_readability_text
+        :param embeddings_dict:
+        :param window_size
+        :param multi: If True, then word is multi-token. You must tokenize it first, then generate context embedd.
+        :param spans: the (start, end) spans of word in list_of_words, if known. We won't search for word then.
+        :return: a list of lists, with each inner list representing the context vectors. If there are no occurrences
+        of word, will return None. Check for this in your code.
+        """
+        if not list_of_words:
+            return None
+        if spans is None:
+            spans = ContextVectorGenerators._find_occurrences(word, list_of_words, multi)
+        if not spans:
+            return None
+        sums, counts = ContextVectorGenerators._document_prefix_sums(list_of_words, embeddings_dict)
+        spans = np.array(spans, dtype=np.int64)
+        min_indices = np.maximum(spans[:, 0] - window_size, 0)
+        max_indices = np.minimum(spans[:, 1] + window_size, len(list_of_words))  # exclusive
+        # as in symmetric_generator, windows without a single embedded word do not count as occurrences
+        has_context = (counts[max_indices] - counts[min_indices]) > 0
+        if not has_context.any():
+            return None
+        context_vecs = sums[max_indices[has_context]] - sums[min_indices[has_context]]
+        return context_vecs.tolist()
+
+    @staticmethod
+    def sparse_symmetric_generator(word, list_of_words, embeddings_dict, window_size=5, multi=False, spans=None):
+        """
+        Same inputs as symmetric_generator, for sparse (random-indexing) embeddings, e.g. a table from
+        EmbeddingStore.get_sparse_table. The windows are a sparse windows x words indicator matrix, which gets
+        multiplied by the CSR rows of the document's embedded words, so every sum only touches the non-zero entries.
+        The context vectors stay sparse; TokenSupervised densifies them when it writes or collects the rows.
+        :param word:
+        :param list_of_words: e.g. high_recall_readability_text
+        :param embeddings_dict: an EmbeddingTable (ideally a sparse one) or a plain dict
+        :param window_size
+        :param multi: If True, then word is multi-token. You must tokenize it first, then generate context embedd.
+        :param spans: the (start, end) spans of word in list_of_words, if known. We won't search for word then.
+        :return: a list of 1 x dimensions (float64) scipy.sparse CSR rows, which densify to the context vectors
+        symmetric_generator returns. If there are no occurrences of word, will return None.
+        """
+        if not list_of_words:
+            return None
+        if spans is None:
+            spans = ContextVectorGenerators._find_occurrences(word, list_of_words, multi)
+        if not spans:
+            return None
+        ids, matrix = ContextVectorGenerators._document_rows(list_of_words, embeddings_dict)
+        positions = np.flatnonzero(ids >= 0)  # positions of the embedded words in list_of_words
+        if not len(positions):
+            return None
+        spans = np.array(spans, dtype=np.int64)
+        # the embedded words of each window are positions[first:last]
+        first = np.searchsorted(positions, np.maximum(spans[:, 0] - window_size, 0))
+        last = np.searchsorted(positions, np.minimum(spans[:, 1] + window_size, len(list_of_words)))
+        # as in symmetric_generator, windows without a single embedded word do not count as occurrences
+        has_context = last > first
+        if not has_context.any():
+            return None
+        first = first[has_context]
+        last = last[has_context]
+        indptr = np.zeros(len(first)+1, dtype=np.int64)
+        np.cumsum(last-first, out=indptr[1:])
+        indices = np.concatenate([np.arange(f, l) for f, l in zip(first, last)])
+        windows = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(first), len(positions)))
+        rows = matrix[ids[positions]]
+        if not sparse.issparse(rows):
+            rows = sparse.csr_matrix(rows)
+        context_vecs = windows.dot(rows.astype(np.float64)).tocsr()
+        return [context_vecs.getrow(i) for i in range(0, context_vecs.shape[0])]
+
+    @staticmethod
+    def memoized_symmetric_generator(word, list_of_words, embeddings_dict, window_size=5, multi=False, spans=None,
+                                     context_cache=None):
+        """
+        Same inputs and outputs as symmetric_generator, but the context vector of each window is looked up in
+        context_cache first, under (word, the tuple of embedding rows in the window). Templated and reposted ads
+        put the same words in identical windows over and over, and those only get summed once. Misses are summed
+        straight from the embedding rows, so documents whose windows all hit cost little more than a row lookup.
+        With a plain dict (rather than an EmbeddingTable) the rows are only numbered within a document, so the
+        window is keyed by its words instead.
+        :param word:
+        :param list_of_words: e.g. high_recall_readability_text
+        :param embeddings_dict:
+        :param window_size
+        :param multi: If True, then word is multi-token. You must tokenize it first, then generate context embedd.
+        :param spans: the (start, end) spans of word in list_of_words, if known. We won't search for word then.
+        :param context_cache: an LRUCache. The keys do not say which table the rows (or words) were looked up in,
+        so only ever use a cache with one table, and start a new one if the embeddings file changes. If None, we
+        don't memoize.
+        :return: a list of lists, with each inner list representing the context vectors. If there are no occurrences
+        of word, will return None. Check for this in your code.
+        """
+        if not list_of_words:
+            return None
+        if spans is None:
+            spans = ContextVectorGenerators._find_occurrences(word, list_of_words, multi)
+        if not spans:
+            return None
+        ids, matrix = ContextVectorGenerators._document_rows(list_of_words, embeddings_dict)
+        rows_are_global = hasattr(embeddings_dict, 'indices')
+        context_vecs = list()
+        for start, end in spans:
+            min_index = max(start-window_size, 0)
+            max_index = min(end+window_size, len(list_of_words))
+            window = ids[min_index:max_index]
+            if rows_are_global:
+                key = (word, tuple(window.tolist()))
+            else:
+                key = (word, tuple(list_of_words[min_index:max_index]))
+            context_vec = context_cache.get(key, False) if context_cache is not None else False
+            if context_vec is False:
+                present = window[window >= 0]
+                if len(present):
+                    context_vec = matrix[present].sum(axis=0, dtype=np.float64)
+                else:
+                    context_vec = None
+                if context_cache is not None:
+                    context_cache.put(key, context_vec)
+            # as in symmetric_generator, windows without a single embedded word do not count as occurrences
+            if context_vec is not None:
+                context_vecs.append(context_vec.tolist())
+        if not context_vecs:
+            return None
+        return context_vecs
+
+    @staticmethod
+    def prefix_sum_multi_window_generator(word, list_of_words, embeddings_dict, window_sizes=(2, 3, 5, 8),
+                                          multi=False, spans=None):
+        """
+        prefix_sum_symmetric_generator for several window sizes at once. The document's prefix sums are built once
+        and shared by all the window sizes, so a sweep over window sizes costs about as much as a single one.
+        :param word:
+        :param list_of_words: e.g. high_recall_readability_text
+        :param embeddings_dict:
+        :param window_sizes: a list of window sizes
+        :param multi: If True, then word is multi-token. You must tokenize it first, then generate context embedd.
+        :param spans: the (start, end) spans of word in list_of_words, if known. We won't search for word then.
+        :return: a dictionary where each window size references what prefix_sum_symmetric_generator would have
+        returned for it (a list of lists, or None). If there are no occurrences of word with context in any of the
+        windows, will return None.
+        """
+        if not list_of_words:
+            return None
+        if spans is None:
+            spans = ContextVectorGenerators._find_occurrences(word, list_of_words, multi)
+        if not spans:
+            return None
+        sums, counts = ContextVectorGenerators._document_prefix_sums(list_of_words, embeddings_dict)
+        spans = np.array(spans, dtype=np.int64)
+        result = dict()
+        for window_size in window_sizes:
+            min_indices = np.maximum(spans[:, 0] - window_size, 0)
+            max_indices = np.minimum(spans[:, 1] + window_size, len(list_of_words))
+            has_context = (counts[max_indices] - counts[min_indices]) > 0
+            if has_context.any():
+                result[window_size] = (sums[max_indices[has_context]] - sums[min_indices[has_context]]).tolist()
+            else:
+                result[window_size] = None
+        if all(v is None for v in result.values()):
+            return None
+        return result
+
     @staticmethod
     def tokenize_add_all_generator(word, list_of_words, embeddings_dict):
         """
@@ -95,13 +363,62 @@ class ContextVectorGenerators:
         :param embeddings_dict: The embeddings dictionary
         :return: A context vector
         """
-        context_vec = list()
-        for w in list_of_words:
-            if w not in embeddings_dict:
-                continue
-            if not context_vec:
-                context_vec = list(embeddings_dict[w])
+        context_vec = ContextVectorGenerators._sum_vectors(list_of_words, embeddings_dict)
+        if context_vec is not None:
+            return context_vec.tolist()
+
+    @staticmethod
+    def _bag_of_words_matrix(lists_of_words, embeddings_dict):
+        """
+        Counts the words of each list that are in embeddings_dict. Only the embedding rows that actually occur get
+        gathered (as float64), so the count matrix has as many columns as there are distinct words in the block,
+        not one per token of the vocabulary.
+        :param lists_of_words: a list of lists of words
+        :param embeddings_dict: an EmbeddingTable or a plain dict
+        :return: a tuple (counts, matrix), where counts is a len(lists_of_words) x distinct-words scipy.sparse CSR
+        matrix and matrix holds the vectors of its columns
+        """
+        lengths = [len(list_of_words) for list_of_words in lists_of_words]
+        tokens = [w for list_of_words in lists_of_words for w in list_of_words]
+        if hasattr(embeddings_dict, 'indices'):
+            ids = embeddings_dict.indices(tokens)
+        else:
+            rows = dict()
+            for w in tokens:
+                if w not in rows and w in embeddings_dict:
+                    rows[w] = len(rows)
+            ids = np.array([rows.get(w, -1) for w in tokens], dtype=np.int64)
+        doc_of_token = np.repeat(np.arange(len(lists_of_words)), lengths)
+        present = ids >= 0
+        columns, inverse = np.unique(ids[present], return_inverse=True)
+        # duplicate (document, column) entries are summed when the matrix is built, which makes them counts
+        counts = sparse.csr_matrix((np.ones(len(inverse)), (doc_of_token[present], inverse)),
+                                   shape=(len(lists_of_words), len(columns)))
+        if len(columns) == 0:
+            # no word of the block is in embeddings_dict; every document gets a zero (not present) row
+            if hasattr(embeddings_dict, 'dimensions'):
+                dimensions = embeddings_dict.dimensions
             else:
-                ContextVectorGenerators._add_vectors(context_vec, embeddings_dict[w])
-        if context_vec:
-            return context_vec
+                dimensions = len(next(iter(embeddings_dict.values()))) if embeddings_dict else 0
+            return counts, np.zeros((0, dimensions))
+        if hasattr(embeddings_dict, 'indices'):
+            matrix = np.asarray(embeddings_dict.matrix[columns], dtype=np.float64)
+        else:
+            by_row = sorted(rows, key=rows.get)
+            matrix = np.array([embeddings_dict[by_row[i]] for i in columns], dtype=np.float64)
+        return counts, matrix.reshape((len(columns), -1))
+
+    @staticmethod
+    def tokenize_add_all_block(lists_of_words, embeddings_dict):
+        """
+        tokenize_add_all_generator for a whole block of documents at once: one sparse count matrix times the
+        embedding matrix, instead of a sum per document.
+        :param lists_of_words: a list of lists of words (one per document)
+        :param embeddings_dict: The embeddings dictionary
+        :return: a tuple (context_vecs, present): a len(lists_of_words) x dimensions float64 matrix, and a boolean
+        array that is False for the documents without any word in embeddings_dict (tokenize_add_all_generator
+        would have returned None for those; their rows are zeros)
+        """
+        counts, matrix = ContextVectorGenerators._bag_of_words_matrix(lists_of_words, embeddings_dict)
+        present = np.diff(counts.indptr) > 0
+        return counts.dot(matrix), present
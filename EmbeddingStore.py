@@ -0,0 +1,297 @@
+import codecs
+import json
+import os
+import re
+import numpy as np
+from scipy import sparse
+import EmbeddingTable
+
+
+class EmbeddingStore:
+    """
+    The embeddings files we get (e.g. unigram-part-00000-v2.json) are json lines files, where each line is an
+    object of the form {token: vector}. Parsing these with json.loads every time is slow, and the resulting dict of
+    lists of floats is several times bigger than the vectors themselves.
+
+    This class converts such a file (once) into a binary store that lives next to it:
+        <embeddings_file>.matrix.npy: a float32 matrix with one row per token
+        <embeddings_file>.vocab.json: a json list of tokens, in row order
+        <embeddings_file>.meta.json: the size/mtime of the json file at conversion time, and the matrix shape
+    The meta file is written last, so its presence means the store is complete. If the json file changes, the
+    store gets rebuilt the next time it is loaded. The matrix is memory-mapped, so loading is near-instant and the
+    pages are shared (through the page cache) by every process that has the same file open.
+
+    Within a process, get_table keeps a registry of loaded tables keyed by (path, size, mtime), so every stage of
+    a run (e.g. the training and actual data preparation in TrainClassifier) shares one table. Call release once
+    you are done with a file.
+
+    For random-indexing embeddings (mostly zeros), get_sparse_table keeps the matrix in CSR form instead; it is
+    built from the dense store once and saved next to it as <embeddings_file>.csr.npz.
+    """
+
+    FORMAT_VERSION = 1
+
+    # matches the (json-escaped) token at the start of a {token: vector} line
+    _LINE_KEY_REGEX = re.compile(r'^\s*\{\s*"((?:[^"\\]|\\.)*)"\s*:')
+
+    _registry = dict()  # absolute path (+'#csr' for sparse tables) -> (signature, EmbeddingTable)
+
+    @staticmethod
+    def _store_paths(embeddings_file):
+        return {'matrix': embeddings_file + '.matrix.npy', 'vocab': embeddings_file + '.vocab.json',
+                'meta': embeddings_file + '.meta.json', 'csr': embeddings_file + '.csr.npz'}
+
+    @staticmethod
+    def _source_signature(embeddings_file):
+        stat = os.stat(embeddings_file)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'version': EmbeddingStore.FORMAT_VERSION}
+
+    @staticmethod
+    def is_store_current(embeddings_file):
+        """
+        :param embeddings_file: the json lines embeddings file
+        :return: True if a complete binary store exists for embeddings_file and it was built from the file in its
+        present state.
+        """
+        paths = EmbeddingStore._store_paths(embeddings_file)
+        if not os.path.exists(paths['meta']):
+            return False
+        with codecs.open(paths['meta'], 'r', 'utf-8') as f:
+            meta = json.load(f)
+        signature = EmbeddingStore._source_signature(embeddings_file)
+        for k, v in signature.items():
+            if meta.get(k) != v:
+                return False
+        return os.path.exists(paths['matrix']) and os.path.exists(paths['vocab'])
+
+    @staticmethod
+    def convert_embeddings_file(embeddings_file):
+        """
+        Convert the json lines embeddings file into the binary store described in the class docstring. The vectors
+        are streamed into a raw float32 file while the json is being parsed, so we never hold the lists in memory.
+        :param embeddings_file:
+        :return: None
+        """
+        paths = EmbeddingStore._store_paths(embeddings_file)
+        signature = EmbeddingStore._source_signature(embeddings_file)
+        raw_file = paths['matrix'] + '.raw.tmp'
+        vocab = list()
+        dimensions = None
+        raw = open(raw_file, 'wb')
+        with codecs.open(embeddings_file, 'r', 'utf-8') as f:
+            for line in f:
+                obj = json.loads(line)
+                for k, v in obj.items():
+                    if dimensions is None:
+                        dimensions = len(v)
+                    elif len(v) != dimensions:
+                        raw.close()
+                        os.remove(raw_file)
+                        raise Exception('Vector for token '+k+' has '+str(len(v))+' dimensions; expected '
+                                        +str(dimensions))
+                    vocab.append(k)
+                    raw.write(np.asarray(v, dtype=np.float32).tobytes())
+        raw.close()
+        if dimensions is None:
+            dimensions = 0
+
+        shape = (len(vocab), dimensions)
+        matrix_tmp = paths['matrix'] + '.tmp'
+        if len(vocab) > 0 and dimensions > 0:
+            matrix = np.lib.format.open_memmap(matrix_tmp, mode='w+', dtype=np.float32, shape=shape)
+            matrix[:] = np.memmap(raw_file, dtype=np.float32, mode='r', shape=shape)
+            matrix.flush()
+            del matrix
+        else:
+            with open(matrix_tmp, 'wb') as out:
+                np.save(out, np.zeros(shape, dtype=np.float32))
+        os.remove(raw_file)
+        os.rename(matrix_tmp, paths['matrix'])
+
+        vocab_tmp = paths['vocab'] + '.tmp'
+        out = codecs.open(vocab_tmp, 'w', 'utf-8')
+        json.dump(vocab, out)
+        out.close()
+        os.rename(vocab_tmp, paths['vocab'])
+
+        signature['shape'] = list(shape)
+        meta_tmp = paths['meta'] + '.tmp'
+        out = codecs.open(meta_tmp, 'w', 'utf-8')
+        json.dump(signature, out)
+        out.close()
+        os.rename(meta_tmp, paths['meta'])
+
+    @staticmethod
+    def _parse_embeddings_file(embeddings_file):
+        """
+        Fallback for when the store cannot be written (e.g. read-only directory). Same result as load, but the
+        matrix lives in memory.
+        """
+        vocab = list()
+        vectors = list()
+        with codecs.open(embeddings_file, 'r', 'utf-8') as f:
+            for line in f:
+                obj = json.loads(line)
+                for k, v in obj.items():
+                    vocab.append(k)
+                    vectors.append(v)
+        return vocab, np.array(vectors, dtype=np.float32)
+
+    @staticmethod
+    def load(embeddings_file):
+        """
+        Load the embeddings in embeddings_file, converting it to a binary store first if there isn't a current one.
+        :param embeddings_file: the json lines embeddings file
+        :return: a tuple (vocab, matrix) where vocab is a list of tokens and matrix is a (read-only, memory-mapped)
+        float32 matrix whose i-th row is the vector of vocab[i]
+        """
+        if not EmbeddingStore.is_store_current(embeddings_file):
+            print 'building binary embeddings store for: ',
+            print embeddings_file
+            try:
+                EmbeddingStore.convert_embeddings_file(embeddings_file)
+            except (IOError, OSError) as e:
+                print 'Warning. Could not write binary embeddings store, parsing json instead: ',
+                print e
+                return EmbeddingStore._parse_embeddings_file(embeddings_file)
+        paths = EmbeddingStore._store_paths(embeddings_file)
+        with codecs.open(paths['vocab'], 'r', 'utf-8') as f:
+            vocab = json.load(f)
+        matrix = np.load(paths['matrix'], mmap_mode='r')
+        return vocab, matrix
+
+    @staticmethod
+    def get_table(embeddings_file):
+        """
+        Returns the registered EmbeddingTable for embeddings_file, loading (and registering) it if it hasn't been
+        loaded yet or if the file has changed since. The table is shared, so do not modify it; use
+        EmbeddingTable.without if you need to drop tokens.
+        :param embeddings_file: the json lines embeddings file
+        :return: an EmbeddingTable
+        """
+        key = os.path.abspath(embeddings_file)
+        signature = EmbeddingStore._source_signature(embeddings_file)
+        if key in EmbeddingStore._registry:
+            registered_signature, table = EmbeddingStore._registry[key]
+            if registered_signature == signature:
+                return table
+            del EmbeddingStore._registry[key]
+        vocab, matrix = EmbeddingStore.load(embeddings_file)
+        table = EmbeddingTable.EmbeddingTable(vocab, matrix)
+        EmbeddingStore._registry[key] = (signature, table)
+        return table
+
+    @staticmethod
+    def load_sparse(embeddings_file):
+        """
+        Like load, but the matrix is a (float32) CSR matrix. The CSR store gets (re)built from the dense store if
+        it is missing or older than it.
+        :param embeddings_file: the json lines embeddings file
+        :return: a tuple (vocab, matrix)
+        """
+        vocab, matrix = EmbeddingStore.load(embeddings_file)
+        paths = EmbeddingStore._store_paths(embeddings_file)
+        if EmbeddingStore.is_store_current(embeddings_file) and os.path.exists(paths['csr']) \
+                and os.path.getmtime(paths['csr']) >= os.path.getmtime(paths['meta']):
+            return vocab, sparse.load_npz(paths['csr'])
+        csr_matrix = EmbeddingTable.EmbeddingTable.to_csr(matrix)
+        try:
+            csr_tmp = paths['csr'] + '.tmp.npz'
+            sparse.save_npz(csr_tmp, csr_matrix)
+            os.rename(csr_tmp, paths['csr'])
+        except (IOError, OSError) as e:
+            print 'Warning. Could not write sparse embeddings store: ',
+            print e
+        return vocab, csr_matrix
+
+    @staticmethod
+    def get_sparse_table(embeddings_file):
+        """
+        get_table, with the matrix in CSR form (see load_sparse). Registered separately from the dense table.
+        :param embeddings_file: the json lines embeddings file
+        :return: an EmbeddingTable
+        """
+        key = EmbeddingStore._sparse_key(embeddings_file)
+        signature = EmbeddingStore._source_signature(embeddings_file)
+        if key in EmbeddingStore._registry:
+            registered_signature, table = EmbeddingStore._registry[key]
+            if registered_signature == signature:
+                return table
+            del EmbeddingStore._registry[key]
+        vocab, matrix = EmbeddingStore.load_sparse(embeddings_file)
+        table = EmbeddingTable.EmbeddingTable(vocab, matrix)
+        EmbeddingStore._registry[key] = (signature, table)
+        return table
+
+    @staticmethod
+    def _sparse_key(embeddings_file):
+        return os.path.abspath(embeddings_file) + '#csr'
+
+    @staticmethod
+    def release(embeddings_file=None):
+        """
+        Drop the registry's reference to the table for embeddings_file, so it can be garbage collected (and
+        the memory map closed) once nobody else holds it.
+        :param embeddings_file: if None, we release every registered table
+        :return: None
+        """
+        if embeddings_file is None:
+            EmbeddingStore._registry.clear()
+        else:
+            EmbeddingStore._registry.pop(os.path.abspath(embeddings_file), None)
+            EmbeddingStore._registry.pop(EmbeddingStore._sparse_key(embeddings_file), None)
+
+    @staticmethod
+    def load_restricted(embeddings_file, vocabulary):
+        """
+        Load only the vectors of tokens in vocabulary. If there is a current binary store, we just pick the rows
+        out of it. Otherwise we stream the json file and only json-parse the lines whose token is in vocabulary,
+        so memory and (most of the) time scale with the size of vocabulary, not the embeddings file.
+        :param embeddings_file: the json lines embeddings file
+        :param vocabulary: a set of tokens
+        :return: a tuple (vocab, matrix), as in load. The matrix is in memory (not memory-mapped).
+        """
+        if EmbeddingStore.is_store_current(embeddings_file):
+            full_vocab, full_matrix = EmbeddingStore.load(embeddings_file)
+            rows = dict()
+            for i in range(0, len(full_vocab)):
+                if full_vocab[i] in vocabulary:
+                    rows[full_vocab[i]] = i  # the last occurrence wins, as in EmbeddingTable
+            vocab = rows.keys()
+            matrix = np.array(full_matrix[[rows[token] for token in vocab]], dtype=np.float32)
+            return vocab, matrix.reshape((len(vocab), full_matrix.shape[1]))
+
+        vocab = list()
+        vectors = list()
+        with codecs.open(embeddings_file, 'r', 'utf-8') as f:
+            for line in f:
+                m = EmbeddingStore._LINE_KEY_REGEX.match(line)
+                if m and line.count('"') == 2:  # a single {token: vector} object, the usual case
+                    if json.loads('"'+m.group(1)+'"') not in vocabulary:
+                        continue
+                obj = json.loads(line)
+                for k, v in obj.items():
+                    if k in vocabulary:
+                        vocab.append(k)
+                        vectors.append(v)
+        if not vectors:
+            return vocab, np.zeros((0, 0), dtype=np.float32)
+        return vocab, np.array(vectors, dtype=np.float32)
+
+    @staticmethod
+    def get_restricted_table(embeddings_file, vocabulary):
+        """
+        Like get_table, but only for the tokens in vocabulary (see load_restricted). Restricted tables are not
+        registered. If the full table for embeddings_file is already registered, we just return that, since
+        the load has already been paid for.
+        :param embeddings_file: the json lines embeddings file
+        :param vocabulary: a set of tokens
+        :return: an EmbeddingTable
+        """
+        key = os.path.abspath(embeddings_file)
+        if key in EmbeddingStore._registry:
+            registered_signature, table = EmbeddingStore._registry[key]
+            if registered_signature == EmbeddingStore._source_signature(embeddings_file):
+                return table
+        vocab, matrix = EmbeddingStore.load_restricted(embeddings_file, vocabulary)
+        return EmbeddingTable.EmbeddingTable(vocab, matrix)
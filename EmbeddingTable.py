@@ -0,0 +1,163 @@
+import numpy as np
+from scipy import sparse
+
+
+class EmbeddingTable:
+    """
+    A drop-in replacement for the {token: vector} dictionaries that read_in_embeddings used to return. All vectors
+    live in one contiguous float32 matrix (typically memory-mapped by EmbeddingStore), and we only keep a
+    token->row index on the side, so the table is about the size of the raw vectors.
+
+    Supports the dict-style access the rest of the code relies on (in, [], len, keys, items, values, get), but not
+    del: tables are shared, so use without to leave tokens out.
+    Note that table[token] is a (zero-copy) view into the matrix, not a list; do not modify it. If you need a list,
+    call tolist() on it. For hot loops, use indices/lookup to fetch many rows at once.
+
+    The matrix may also be a scipy.sparse CSR matrix (see to_sparse and EmbeddingStore.get_sparse_table), for
+    random-indexing embeddings, which are mostly zeros. The dict-style accessors and lookup still return dense
+    vectors then (copies), so the table stays a drop-in; use sparse_lookup to stay sparse.
+    """
+
+    def __init__(self, vocab, matrix):
+        """
+        :param vocab: a list of tokens. vocab[i] is the token of the i-th row of matrix. If a token occurs more
+        than once, the last occurrence wins (as it would in a dict).
+        :param matrix: a 2-d numpy array (or memmap) with one row per token
+        """
+        self.vocab = vocab
+        self.matrix = matrix
+        self._index = dict()
+        for i in range(0, len(vocab)):
+            self._index[vocab[i]] = i
+
+    def __contains__(self, token):
+        return token in self._index
+
+    def __getitem__(self, token):
+        return self._row(self._index[token])
+
+    def __delitem__(self, token):
+        """
+        Tables are shared (EmbeddingStore.get_table hands the same one to every caller), so deleting a token would
+        delete it for everybody. Use without instead.
+        """
+        raise Exception('EmbeddingTables are shared and cannot be modified; use without(['+repr(token)+'])')
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    @property
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    @property
+    def is_sparse(self):
+        return sparse.issparse(self.matrix)
+
+    def _row(self, i):
+        if self.is_sparse:
+            return self.matrix.getrow(i).toarray().ravel()
+        return self.matrix[i]
+
+    def get(self, token, default=None):
+        if token in self._index:
+            return self._row(self._index[token])
+        return default
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return [self._row(i) for i in self._index.values()]
+
+    def items(self):
+        return [(token, self._row(i)) for token, i in self._index.items()]
+
+    def without(self, tokens):
+        """
+        Use this instead of del on shared tables (e.g. the ones handed out by EmbeddingStore.get_table).
+        :param tokens: tokens to leave out. Tokens not in the table are ignored.
+        :return: a new EmbeddingTable over the same matrix, minus tokens
+        """
+        table = EmbeddingTable([], self.matrix)
+        table.vocab = self.vocab
+        table._index = dict(self._index)
+        for token in tokens:
+            table._index.pop(token, None)
+        return table
+
+    def to_sparse(self):
+        """
+        :return: a new EmbeddingTable with the same tokens, over a CSR copy of the matrix (or self, if the matrix
+        is already sparse)
+        """
+        if self.is_sparse:
+            return self
+        table = EmbeddingTable([], EmbeddingTable.to_csr(self.matrix))
+        table.vocab = self.vocab
+        table._index = dict(self._index)
+        return table
+
+    @staticmethod
+    def to_csr(matrix, block_size=10000):
+        """
+        Converts a dense (possibly memory-mapped) matrix to float32 CSR, block_size rows at a time, so that only
+        one block is ever densely in memory.
+        :param matrix:
+        :param block_size:
+        :return: a scipy.sparse CSR matrix
+        """
+        if matrix.shape[0] == 0:
+            return sparse.csr_matrix(matrix.shape, dtype=np.float32)
+        blocks = list()
+        for start in range(0, matrix.shape[0], block_size):
+            blocks.append(sparse.csr_matrix(np.asarray(matrix[start:start+block_size], dtype=np.float32)))
+        return sparse.vstack(blocks, format='csr')
+
+    def row_of(self, token):
+        """
+        :param token:
+        :return: the row of token in the matrix, or -1 if token is not in the table
+        """
+        return self._index.get(token, -1)
+
+    def indices(self, tokens):
+        """
+        :param tokens: a list of tokens
+        :return: an int array with the row of each token in the matrix, and -1 for tokens not in the table
+        """
+        index = self._index
+        return np.array([index.get(token, -1) for token in tokens], dtype=np.int64)
+
+    def lookup(self, tokens):
+        """
+        Batched access. One fancy-indexing call instead of a list per token.
+        :param tokens: a list of tokens
+        :return: a len(tokens) x dimensions float32 array. Rows of tokens not in the table are all zeros.
+        """
+        rows = self.indices(tokens)
+        result = np.zeros((len(rows), self.dimensions), dtype=self.matrix.dtype)
+        present = rows >= 0
+        if present.any():
+            if self.is_sparse:
+                result[present] = self.matrix[rows[present]].toarray()
+            else:
+                result[present] = self.matrix[rows[present]]
+        return result
+
+    def sparse_lookup(self, tokens):
+        """
+        Like lookup, but returns a CSR matrix (for sparse tables, without ever densifying the rows).
+        :param tokens: a list of tokens
+        :return: a len(tokens) x dimensions scipy.sparse CSR matrix. Rows of tokens not in the table are empty.
+        """
+        rows = self.indices(tokens)
+        present = rows >= 0
+        result = sparse.csr_matrix(self.matrix[np.where(present, rows, 0)], dtype=self.matrix.dtype)
+        if not present.all():
+            result = sparse.diags(present.astype(self.matrix.dtype)).dot(result).tocsr()
+            result.eliminate_zeros()
+        return result
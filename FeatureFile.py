@@ -0,0 +1,107 @@
+import codecs
+import json
+import os
+import numpy as np
+
+
+class FeatureFile:
+    """
+    A binary alternative to the tab-delimited 'pos-neg' text files (word, str(vector), label[, line number]).
+    Writing str(vector.tolist()) and parsing it back float by float is slow and the files are big; here a feature
+    file is a directory with:
+        vectors.f32: the vectors, as a row-major float32 matrix
+        labels.i8: the labels (0 or 1), as int8
+        line_nums.i64: the line numbers (or -1 if there aren't any), as int64
+        words.txt: the words, one per line (utf-8)
+        meta.json: the number of rows and dimensions. Written on close, so its presence means the file is complete.
+
+    Write one row at a time with an instance (the columns are streamed to disk), and load it with FeatureFile.read,
+    which goes straight into numpy arrays (optionally memory-mapped).
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path, dimensions=None):
+        """
+        :param path: the feature file (directory) to write. It will be created if it doesn't exist, and overwritten
+        if it does.
+        :param dimensions: the length of the vectors. If None, we take it from the first vector written.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            os.remove(os.path.join(path, 'meta.json'))
+        self.path = path
+        self.dimensions = dimensions
+        self.rows = 0
+        self._vectors = open(os.path.join(path, 'vectors.f32'), 'wb')
+        self._labels = open(os.path.join(path, 'labels.i8'), 'wb')
+        self._line_nums = open(os.path.join(path, 'line_nums.i64'), 'wb')
+        self._words = codecs.open(os.path.join(path, 'words.txt'), 'w', 'utf-8')
+
+    def write(self, word, vector, label, line_num=-1):
+        """
+        :param word: must not contain a newline
+        :param vector: a list or numpy array
+        :param label: 0 or 1
+        :param line_num: the line of the preprocessed file the row came from, if relevant
+        :return: None
+        """
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        if self.dimensions is None:
+            self.dimensions = len(vector)
+        elif len(vector) != self.dimensions:
+            raise Exception('Vector for word '+word+' has '+str(len(vector))+' dimensions; expected '
+                            +str(self.dimensions))
+        self._vectors.write(vector.tobytes())
+        self._labels.write(np.array([label], dtype=np.int8).tobytes())
+        self._line_nums.write(np.array([line_num], dtype=np.int64).tobytes())
+        self._words.write(word)
+        self._words.write('\n')
+        self.rows += 1
+
+    def close(self):
+        """
+        Flushes the columns and writes meta.json.
+        :return: None
+        """
+        self._vectors.close()
+        self._labels.close()
+        self._line_nums.close()
+        self._words.close()
+        out = codecs.open(os.path.join(self.path, 'meta.json'), 'w', 'utf-8')
+        json.dump({'rows': self.rows, 'dimensions': (self.dimensions if self.dimensions is not None else 0),
+                   'version': FeatureFile.FORMAT_VERSION}, out)
+        out.close()
+
+    @staticmethod
+    def is_feature_file(path):
+        """
+        :param path:
+        :return: True if path is a complete feature file (as opposed to, e.g., a pos-neg text file)
+        """
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+    @staticmethod
+    def read(path, mmap=False):
+        """
+        :param path: a feature file written by FeatureFile
+        :param mmap: if True, the vectors are memory-mapped (read-only) instead of read into memory
+        :return: a dictionary with 'vectors' (a rows x dimensions float32 matrix), 'labels' (int8 array),
+        'line_nums' (int64 array) and 'words' (a list)
+        """
+        if not FeatureFile.is_feature_file(path):
+            raise Exception('Not a (complete) feature file: '+path)
+        with codecs.open(os.path.join(path, 'meta.json'), 'r', 'utf-8') as f:
+            meta = json.load(f)
+        shape = (meta['rows'], meta['dimensions'])
+        vectors_file = os.path.join(path, 'vectors.f32')
+        if mmap and shape[0] > 0 and shape[1] > 0:
+            vectors = np.memmap(vectors_file, dtype=np.float32, mode='r', shape=shape)
+        else:
+            vectors = np.fromfile(vectors_file, dtype=np.float32, count=shape[0]*shape[1]).reshape(shape)
+        labels = np.fromfile(os.path.join(path, 'labels.i8'), dtype=np.int8, count=shape[0])
+        line_nums = np.fromfile(os.path.join(path, 'line_nums.i64'), dtype=np.int64, count=shape[0])
+        with codecs.open(os.path.join(path, 'words.txt'), 'r', 'utf-8') as f:
+            words = f.read().split('\n')[0:shape[0]]
+        return {'vectors': vectors, 'labels': labels, 'line_nums': line_nums, 'words': words}
@@ -2,6 +2,7 @@ import codecs
 import json
 import pprint
 import TextPreprocessors
+import TokenizerSession
 import kNearestNeighbors
 from decimal import *
 import math
@@ -106,28 +107,15 @@ class FieldAnalyses:
         return attribute_vectors
 
     @staticmethod
-    def _k_centroid(score_dict, k, nearest):
+    def _k_centroid(items, scores, k, nearest):
         """
-        :param score_dict: A key is a sim. score, and values are lists of items.
+        :param items: a list of items
+        :param scores: their sim. scores (a list or array)
         :param k:
         :param nearest: If True, return k nearest, otherwise return k farthest
         :return: a list of (at most) k values
         """
-        return kNearestNeighbors._extract_top_k(scored_results_dict=score_dict, k=k, disable_k=False, reverse=nearest)
-
-    @staticmethod
-    def _reverse_dict(dictionary):
-        """
-        Turn keys into (lists of) values, and values into keys. Values must originally be primitive.
-        :param dictionary:
-        :return: Another dictionary
-        """
-        new_dict = dict()
-        for k, v in dictionary.items():
-            if v not in new_dict:
-                new_dict[v] = list()
-            new_dict[v].append(k)
-        return new_dict
+        return [items[i] for i in kNearestNeighbors._top_k_indices(scores, k=k, nearest=nearest)]
 
     @staticmethod
     def read_in_ground_truth_file(ground_truth_file):
@@ -168,21 +156,20 @@ class FieldAnalyses:
         warnings.filterwarnings("ignore")
         attribute_vecs = FieldAnalyses._build_vector_set_for_attribute(embeddings_file, ground_truth_file, attribute)
         centroid = FieldAnalyses._find_normalized_centroid_of_vectors(attribute_vecs)
-        sim_dict = dict()
-        for key, val in attribute_vecs.items():
-            sim_dict[key] = SimFunctions.SimFunctions.abs_cosine_sim(val, centroid)
+        keys = attribute_vecs.keys()
+        sims = SimFunctions.SimFunctions.abs_cosine_sim_batch(centroid, [attribute_vecs[key] for key in keys])
+        sim_dict = dict(zip(keys, sims.tolist()))
         # print sim_dict.values()
         print 'mean: ',
         print np.mean(sim_dict.values())
         print 'std. dev: ',
         print np.std(sim_dict.values())
-        score_dict = FieldAnalyses._reverse_dict(sim_dict)
         print 'k nearest values: ',
         # print sim_dict['z']
         # print sim_dict['vietnamese']
-        print FieldAnalyses._k_centroid(score_dict=score_dict, k=k, nearest=True)
+        print FieldAnalyses._k_centroid(keys, sims, k=k, nearest=True)
         print 'k farthest values: ',
-        print FieldAnalyses._k_centroid(score_dict=score_dict, k=k, nearest=False)
+        print FieldAnalyses._k_centroid(keys, sims, k=k, nearest=False)
 
     @staticmethod
     def sample_n_values_from_field(text_corpus, attribute, n=10, output_file=None):
@@ -236,17 +223,18 @@ class FieldAnalyses:
         """
         values1 = set()
         values2 = set()
+        session = TokenizerSession.TokenizerSession()
         count = 1
         with codecs.open(corpus, 'r', 'utf-8') as f:
             for line in f:
                 print count
                 obj = json.loads(line)
                 if attribute1 in obj:
-                    tokens_list = TextPreprocessors.TextPreprocessors._tokenize_field(obj, attribute1)
+                    tokens_list = TextPreprocessors.TextPreprocessors._tokenize_field(obj, attribute1, session=session)
                     vals = set(TextPreprocessors.TextPreprocessors._preprocess_tokens(tokens_list, options=['lower']))
                     values1 = values1.union(vals)
                 if attribute2 in obj:
-                    tokens_list = TextPreprocessors.TextPreprocessors._tokenize_field(obj, attribute2)
+                    tokens_list = TextPreprocessors.TextPreprocessors._tokenize_field(obj, attribute2, session=session)
                     vals = set(TextPreprocessors.TextPreprocessors._preprocess_tokens(tokens_list, options=['lower']))
                     values2 = values2.union(vals)
                 if count == num:
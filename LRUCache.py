@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entry once it is full, and counts its hits, misses and
+    evictions. Use it for memoizing things that recur a lot across a corpus (annotation tokenizations, context
+    vectors of templated ads...).
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: the maximum number of entries. Must be positive.
+        """
+        if max_size <= 0:
+            raise Exception('max_size must be positive')
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Counts as a hit or a miss, and marks key as the most recently used entry.
+        :param key:
+        :param default: what to return if key is not in the cache
+        :return: the cached value, or default
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Adds (or refreshes) key, evicting the least recently used entry if the cache is full.
+        :return: None
+        """
+        if key in self._entries:
+            del self._entries[key]
+        elif len(self._entries) >= self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._entries[key] = value
+
+    def items(self):
+        """
+        :return: a list of (key, value) tuples, from least to most recently used
+        """
+        return self._entries.items()
+
+    def clear(self):
+        """
+        Drops all entries and resets the counters.
+        :return: None
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """
+        :return: a dictionary with the size, max_size, hits, misses, evictions and hit_rate of the cache
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': (float(self.hits)/lookups if lookups else 0.0)}
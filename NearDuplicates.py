@@ -0,0 +1,161 @@
+import codecs
+import copy
+import json
+import zlib
+import numpy as np
+
+
+class NearDuplicates:
+    """
+    MinHash/LSH grouping of near-duplicate documents (e.g. reposted ads that only differ in a phone number or a
+    timestamp), by the k-token shingles of a tokenized text field. Documents are added one at a time, in order, and
+    each one gets the index of its group's representative: the first document it was found to be similar to, or
+    itself. Only representatives get featurized and classified; fan_out_classified copies their results to the
+    other members of the group. Since the results are per annotated value, documents can also be given a key (their
+    annotated values) and only get grouped with representatives with the same key: two reposts of an ad whose
+    annotations differ are then classified separately.
+
+    Hashing is deterministic (crc32 shingles, seeded permutations), so the same corpus always gets the same groups.
+    """
+
+    _PRIME = (1 << 31) - 1
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=3, seed=1):
+        """
+        :param threshold: the minimum (estimated) Jaccard similarity of the shingles of a document and of its
+        representative
+        :param num_perm: the number of MinHash permutations. Must be a multiple of bands.
+        :param bands: the number of LSH bands. More bands find less similar candidates (which then get checked
+        against threshold).
+        :param shingle_size: the number of tokens per shingle
+        :param seed:
+        """
+        if num_perm % bands != 0:
+            raise Exception('num_perm must be a multiple of bands')
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        random_state = np.random.RandomState(seed)
+        self._a = random_state.randint(1, NearDuplicates._PRIME, size=num_perm).astype(np.uint64)
+        self._b = random_state.randint(0, NearDuplicates._PRIME, size=num_perm).astype(np.uint64)
+        self._buckets = dict()  # (band, band of signature) -> list of representatives
+        self._signatures = dict()  # representative -> signature
+        self._keys = dict()  # representative -> key
+        self.count = 0
+
+    def signature(self, tokens):
+        """
+        :param tokens: a list of tokens
+        :return: the MinHash signature (a numpy array of num_perm hashes), or None if tokens is empty
+        """
+        if not tokens:
+            return None
+        size = min(self.shingle_size, len(tokens))
+        hashes = set()
+        for i in range(0, len(tokens)-size+1):
+            hashes.add(zlib.crc32(u' '.join(tokens[i:i+size]).encode('utf-8')) & 0xffffffff)
+        hashes = np.array(sorted(hashes), dtype=np.uint64) % NearDuplicates._PRIME
+        return ((np.outer(self._a, hashes) + self._b[:, np.newaxis]) % NearDuplicates._PRIME).min(axis=1)
+
+    def add(self, tokens, key=None):
+        """
+        :param tokens: the tokens of the next document
+        :param key: the document only gets grouped with a representative that was added with an equal key
+        :return: the index (in order of addition) of the representative of the document
+        """
+        index = self.count
+        self.count += 1
+        signature = self.signature(tokens)
+        if signature is None:
+            return index
+        rows = self.num_perm / self.bands
+        buckets = [(band, signature[band*rows:(band+1)*rows].tostring()) for band in range(0, self.bands)]
+        candidates = set()
+        for bucket in buckets:
+            candidates.update(self._buckets.get(bucket, []))
+        for candidate in sorted(candidates):
+            if self._keys[candidate] == key and np.mean(self._signatures[candidate] == signature) >= self.threshold:
+                return candidate
+        self._signatures[index] = signature
+        self._keys[index] = key
+        for bucket in buckets:
+            if bucket not in self._buckets:
+                self._buckets[bucket] = list()
+            self._buckets[bucket].append(index)
+        return index
+
+    @staticmethod
+    def group_file(preprocessed_file, text_field, annotated_field=None, **kwargs):
+        """
+        :param preprocessed_file: a tokens file, output by TextPreprocessors.preprocess_annotated_file
+        :param text_field: e.g. 'high_recall_readability_text'
+        :param annotated_field: if specified, lines only get grouped if their values of this field match (see
+        annotations_key)
+        :param kwargs: passed on to NearDuplicates
+        :return: a list with the line number of the representative of each line of preprocessed_file
+        """
+        near_duplicates = NearDuplicates(**kwargs)
+        representatives = list()
+        with codecs.open(preprocessed_file, 'r', 'utf-8') as f:
+            for line in f:
+                obj = json.loads(line)
+                representatives.append(near_duplicates.add(obj[text_field],
+                                                           NearDuplicates.annotations_key(obj, annotated_field)))
+        duplicates = len(representatives) - len(set(representatives))
+        print 'found '+str(duplicates)+' near-duplicate lines in '+str(len(representatives))+' lines'
+        return representatives
+
+    @staticmethod
+    def annotations_key(obj, annotated_field):
+        """
+        :param obj: a preprocessed object
+        :param annotated_field: e.g. 'annotated_cities'. If None, the key is None.
+        :return: a key for add that is equal for objects with the same annotated values
+        """
+        if annotated_field is None:
+            return None
+        return json.dumps(obj.get(annotated_field), sort_keys=True)
+
+    @staticmethod
+    def groups_file_name(pos_neg_file):
+        """
+        :param pos_neg_file:
+        :return: where the representatives of the lines of pos_neg_file are kept, if it was deduplicated
+        """
+        return pos_neg_file.rstrip('/')+'.groups.json'
+
+    @staticmethod
+    def write_groups(representatives, groups_file):
+        out = codecs.open(groups_file, 'w', 'utf-8')
+        json.dump(representatives, out)
+        out.close()
+
+    @staticmethod
+    def read_groups(groups_file):
+        with codecs.open(groups_file, 'r', 'utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def fan_out_classified(classified, representatives, first_line=0):
+        """
+        Copies the classification results of each representative to the other lines of its group.
+        :param classified: what TokenSupervised._classify returns. Its per-line lists start at first_line.
+        :param representatives: see group_file
+        :param first_line: the line number of the first entry of the per-line lists
+        :return: classified, with the per-line lists extended and filled in for the non-representative lines
+        """
+        empty = {'classified_cities': {'cities': set(), 'borderline_cities': set(), 'not_cities': set()},
+                 'combined_all_data': {'combined_city_name': [], 'combined_city_predicted_label': [],
+                                       'combined_city_predicted_probability': [], 'combined_city_actual_label': [],
+                                       'combined_city_occurence_counts': [], 'combined_city_negative_prob': []}}
+        for key in empty:
+            results = classified[key]
+            for line in range(first_line, len(representatives)):
+                representative = representatives[line]
+                if representative == line or not first_line <= representative < first_line+len(results):
+                    continue
+                while first_line+len(results) <= line:
+                    results.append(copy.deepcopy(empty[key]))
+                results[line-first_line] = copy.deepcopy(results[representative-first_line])
+        return classified
@@ -0,0 +1,333 @@
+import json
+import multiprocessing
+import os
+import time
+import zlib
+import numpy as np
+import EmbeddingStore
+import kNearestNeighbors
+
+
+_worker_state = dict()  # what every chunk of a NeighborGraph._top_k pool needs; set once per worker process
+
+
+def _init_top_k_worker(embeddings_file, rows, inverse_norms, k, column_start, block_size):
+    """
+    Initializer of the NeighborGraph._top_k pool. The vocabulary-length rows and inverse_norms get handed to each
+    worker once, here, rather than with every chunk of seeds.
+    """
+    _worker_state['read_block'] = kNearestNeighbors._matrix_block_reader(
+        EmbeddingStore.EmbeddingStore.get_table(embeddings_file).matrix, rows)
+    _worker_state['inverse_norms'] = inverse_norms
+    _worker_state['k'] = k
+    _worker_state['column_start'] = column_start
+    _worker_state['block_size'] = block_size
+
+
+def _top_k_chunk(seed_positions):
+    """
+    Worker for NeighborGraph._top_k: the neighbors of a chunk of seeds, read from the (memory-mapped) store.
+    """
+    return kNearestNeighbors._blocked_top_k(_worker_state['read_block'], _worker_state['inverse_norms'],
+                                            seed_positions, _worker_state['k'],
+                                            column_start=_worker_state['column_start'],
+                                            block_size=_worker_state['block_size'])
+
+
+class NeighborGraph:
+    """
+    The k nearest neighbors (by absolute cosine similarity, as in kNearestNeighbors.find_k_nearest_neighbors_multi)
+    of every token of an embeddings file, computed once and saved next to it as <embeddings_file>.knn.npz, so that
+    dictionary supplementation is a lookup rather than a scan of the vocabulary per seed.
+
+    Tokens are kept in the order of their rows in the embeddings store (the dummy tokens are left out), and ties go
+    to the earlier token. When lines get appended to the embeddings file, refresh only rescores what they can
+    change: the appended tokens (new ones, and old ones with a new vector) get their neighbors computed in full,
+    as do the tokens that had an old vector of a re-appended token among their neighbors; every other token only
+    gets scored against the appended tokens, and keeps the better of those and its old neighbors. The result is the
+    one a rebuild would give. Any other change to the file means a rebuild.
+    """
+
+    FORMAT_VERSION = 1
+
+    _registry = dict()  # embeddings file -> NeighborGraph
+
+    def __init__(self, tokens, rows, scores, indices, signature):
+        """
+        Use build, load or get rather than this.
+        :param tokens: the tokens of the graph
+        :param rows: the row of each token in the embeddings store
+        :param scores: a len(tokens) x k array. scores[i] are the similarities of the neighbors of tokens[i], in
+        decreasing order; -inf for missing neighbors (when there are fewer than k other tokens).
+        :param indices: the positions (in tokens) of the neighbors of scores
+        :param signature: what the graph was built from: the size, mtime and crc32 of the embeddings file, the
+        number of rows of its store, and k
+        """
+        self.tokens = tokens
+        self.rows = rows
+        self.scores = scores
+        self.indices = indices
+        self.signature = signature
+        self.k = signature['k']
+        self._positions = dict()
+        for i in range(0, len(tokens)):
+            self._positions[tokens[i]] = i
+
+    def __contains__(self, token):
+        return token in self._positions
+
+    @staticmethod
+    def graph_file_name(embeddings_file):
+        return embeddings_file+'.knn.npz'
+
+    @staticmethod
+    def _file_crc(embeddings_file, size, chunk_size=1 << 20):
+        """
+        :return: the crc32 of the first size bytes of embeddings_file
+        """
+        crc = 0
+        with open(embeddings_file, 'rb') as f:
+            while size > 0:
+                chunk = f.read(min(chunk_size, size))
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size -= len(chunk)
+        return crc & 0xffffffff
+
+    @staticmethod
+    def _signature(embeddings_file, store_rows, k):
+        stat = os.stat(embeddings_file)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime,
+                'crc': NeighborGraph._file_crc(embeddings_file, stat.st_size), 'store_rows': store_rows, 'k': k,
+                'version': NeighborGraph.FORMAT_VERSION}
+
+    @staticmethod
+    def _graph_rows(table):
+        """
+        :param table: the EmbeddingTable of the embeddings file
+        :return: the store rows of the tokens of the graph, in order
+        """
+        indexed = table.without(kNearestNeighbors.DUMMY_TOKENS)
+        return np.sort(indexed.indices(list(indexed.keys())))
+
+    @staticmethod
+    def _top_k(embeddings_file, table, rows, inverse_norms, seed_positions, k, column_start=0, workers=1,
+               block_size=4096, chunk_size=4096):
+        """
+        The neighbors of the tokens at seed_positions among the tokens from column_start on, with
+        kNearestNeighbors._blocked_top_k. With workers > 1, chunks of chunk_size seeds are scored in a process pool,
+        whose workers only get rows and inverse_norms once (see _init_top_k_worker).
+        :return: a tuple (scores, indices), padded to k columns
+        """
+        if workers > 1 and len(seed_positions) > chunk_size:
+            pool = multiprocessing.Pool(workers, _init_top_k_worker,
+                                        (embeddings_file, rows, inverse_norms, k, column_start, block_size))
+            try:
+                chunks = [seed_positions[start:start+chunk_size] for start in range(0, len(seed_positions), chunk_size)]
+                results = pool.map(_top_k_chunk, chunks)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            read_block = kNearestNeighbors._matrix_block_reader(table.matrix, rows)
+            results = [kNearestNeighbors._blocked_top_k(read_block, inverse_norms, seed_positions, k,
+                                                        column_start=column_start, block_size=block_size)]
+        scores = np.full((len(seed_positions), k), -np.inf)
+        indices = np.full((len(seed_positions), k), -1, dtype=np.int64)
+        start = 0
+        for chunk_scores, chunk_indices in results:
+            end = start+len(chunk_scores)
+            scores[start:end, 0:chunk_scores.shape[1]] = chunk_scores
+            indices[start:end, 0:chunk_indices.shape[1]] = chunk_indices
+            start = end
+        return scores, indices
+
+    @staticmethod
+    def build(embeddings_file, k=20, workers=1, block_size=4096):
+        """
+        Computes the graph of embeddings_file and saves it next to it. This is the batch job; run it with as
+        many workers as there are cores.
+        :param embeddings_file: the json lines embeddings file
+        :param k: the number of neighbors kept per token. Lookups can ask for up to this many.
+        :param workers: the number of processes to score with
+        :param block_size: the number of vocabulary vectors scored at a time
+        :return: a NeighborGraph
+        """
+        start_time = time.time()
+        table = EmbeddingStore.EmbeddingStore.get_table(embeddings_file)
+        rows = NeighborGraph._graph_rows(table)
+        read_block = kNearestNeighbors._matrix_block_reader(table.matrix, rows)
+        inverse_norms = kNearestNeighbors._inverse_norms(read_block, len(rows), block_size)
+        scores, indices = NeighborGraph._top_k(embeddings_file, table, rows, inverse_norms,
+                                               np.arange(len(rows), dtype=np.int64), k, workers=workers,
+                                               block_size=block_size)
+        graph = NeighborGraph([table.vocab[row] for row in rows], rows, scores, indices,
+                              NeighborGraph._signature(embeddings_file, len(table.vocab), k))
+        graph.save(embeddings_file)
+        print 'built the neighbor graph of '+str(len(rows))+' tokens in '+str(round(time.time()-start_time, 1))+\
+              ' seconds'
+        return graph
+
+    def save(self, embeddings_file):
+        graph_file = NeighborGraph.graph_file_name(embeddings_file)
+        try:
+            tmp_file = graph_file+'.tmp.npz'
+            np.savez(tmp_file, tokens=np.array(json.dumps(self.tokens)), rows=self.rows, scores=self.scores,
+                     indices=self.indices, signature=np.array(json.dumps(self.signature, sort_keys=True)))
+            os.rename(tmp_file, graph_file)
+        except (IOError, OSError) as e:
+            print 'Warning. Could not write the neighbor graph: ',
+            print e
+
+    @staticmethod
+    def load(embeddings_file):
+        """
+        :param embeddings_file: the json lines embeddings file
+        :return: the saved NeighborGraph (current or not; see is_current), or None if there is none
+        """
+        graph_file = NeighborGraph.graph_file_name(embeddings_file)
+        if not os.path.exists(graph_file):
+            return None
+        saved = np.load(graph_file)
+        signature = json.loads(str(saved['signature']))
+        if signature.get('version') != NeighborGraph.FORMAT_VERSION:
+            return None
+        return NeighborGraph(json.loads(str(saved['tokens'])), saved['rows'], saved['scores'], saved['indices'],
+                             signature)
+
+    def is_current(self, embeddings_file):
+        """
+        Only compares the size and modification time of embeddings_file with the ones the graph was built from
+        (as EmbeddingStore does), so it is cheap enough to check on every get. The contents only get checked (by
+        refresh) once these differ.
+        :param embeddings_file: the json lines embeddings file
+        :return: True if embeddings_file is unchanged since the graph was built
+        """
+        stat = os.stat(embeddings_file)
+        return stat.st_size == self.signature['size'] and stat.st_mtime == self.signature.get('mtime')
+
+    def refresh(self, embeddings_file, workers=1, block_size=4096):
+        """
+        Brings the graph up to date with embeddings_file, which has had lines appended since the graph was built
+        (see the class docstring), or was only touched, and saves it.
+        :param embeddings_file: the json lines embeddings file
+        :param workers: the number of processes to score with
+        :param block_size: the number of vocabulary vectors scored at a time
+        :return: the refreshed NeighborGraph, or None if embeddings_file changed in some other way than appended
+        lines (then it needs a build)
+        """
+        old_size = self.signature['size']
+        if os.path.getsize(embeddings_file) < old_size or \
+                NeighborGraph._file_crc(embeddings_file, old_size) != self.signature['crc']:
+            return None
+        table = EmbeddingStore.EmbeddingStore.get_table(embeddings_file)
+        old_rows = self.signature['store_rows']
+        if len(table.vocab) < old_rows:
+            return None
+        start_time = time.time()
+        rows = NeighborGraph._graph_rows(table)
+        tokens = [table.vocab[row] for row in rows]
+        # tokens of the appended lines (new, or with a new vector) come after all the untouched ones
+        num_untouched = int(np.searchsorted(rows, old_rows))
+        positions = dict()
+        for i in range(0, num_untouched):
+            positions[tokens[i]] = i
+        remap = np.array([positions.get(token, -1) for token in self.tokens] + [-1], dtype=np.int64)
+        indices = remap[self.indices]  # -1 (the last entry of remap) stays -1
+        old_positions = np.array([self._positions[token] for token in tokens[0:num_untouched]], dtype=np.int64)
+        indices = indices[old_positions]
+        scores = self.scores[old_positions]
+        # a neighbor whose vector changed (or went away) means a full recompute of the row
+        affected = np.flatnonzero(((indices == -1) & (scores != -np.inf)).any(axis=1))
+        unaffected = np.setdiff1d(np.arange(num_untouched, dtype=np.int64), affected)
+
+        read_block = kNearestNeighbors._matrix_block_reader(table.matrix, rows)
+        inverse_norms = kNearestNeighbors._inverse_norms(read_block, len(rows), block_size)
+        k = self.k
+        new_scores = np.full((len(rows), k), -np.inf)
+        new_indices = np.full((len(rows), k), -1, dtype=np.int64)
+        if num_untouched < len(rows) and len(unaffected) > 0:
+            appended_scores, appended_indices = NeighborGraph._top_k(embeddings_file, table, rows, inverse_norms,
+                                                                     unaffected, k, column_start=num_untouched,
+                                                                     workers=workers, block_size=block_size)
+            merged_scores, merged_indices = kNearestNeighbors._merge_top_k(scores[unaffected], indices[unaffected],
+                                                                          appended_scores, appended_indices, k)
+            order = np.lexsort((merged_indices, -merged_scores))
+            merged_rows = np.arange(len(unaffected))[:, np.newaxis]
+            merged_scores, merged_indices = merged_scores[merged_rows, order], merged_indices[merged_rows, order]
+            new_scores[unaffected], new_indices[unaffected] = merged_scores, merged_indices
+        else:
+            new_scores[unaffected], new_indices[unaffected] = scores[unaffected], indices[unaffected]
+        recompute = np.concatenate((affected, np.arange(num_untouched, len(rows), dtype=np.int64)))
+        if len(recompute) > 0:
+            new_scores[recompute], new_indices[recompute] = NeighborGraph._top_k(embeddings_file, table, rows,
+                                                                                 inverse_norms, recompute, k,
+                                                                                 workers=workers,
+                                                                                 block_size=block_size)
+        graph = NeighborGraph(tokens, rows, new_scores, new_indices,
+                              NeighborGraph._signature(embeddings_file, len(table.vocab), k))
+        graph.save(embeddings_file)
+        print 'refreshed the neighbor graph: '+str(len(recompute))+' of '+str(len(rows))+' tokens recomputed, '+\
+              str(len(unaffected))+' merged, in '+str(round(time.time()-start_time, 1))+' seconds'
+        return graph
+
+    @staticmethod
+    def get(embeddings_file, k=20, workers=1):
+        """
+        The graph of embeddings_file, with at least k neighbors per token: kept in memory once loaded, loaded if it
+        was saved, refreshed if lines were appended to the file since, built (and saved) otherwise.
+        :param embeddings_file: the json lines embeddings file
+        :param k:
+        :param workers: the number of processes to score with, if the graph has to be built or refreshed
+        :return: a NeighborGraph
+        """
+        graph = NeighborGraph._registry.get(embeddings_file)
+        if graph is None:
+            graph = NeighborGraph.load(embeddings_file)
+        if graph is not None and graph.k >= k and not graph.is_current(embeddings_file):
+            graph = graph.refresh(embeddings_file, workers=workers)
+        if graph is None or graph.k < k:
+            print 'building neighbor graph for: ',
+            print embeddings_file
+            graph = NeighborGraph.build(embeddings_file, k=k, workers=workers)
+        NeighborGraph._registry[embeddings_file] = graph
+        return graph
+
+    def neighbors(self, token, k=None):
+        """
+        :param token: a token of the graph
+        :param k: at most self.k. If None, self.k.
+        :return: the list of the (at most) k nearest neighbors of token
+        """
+        if k is None:
+            k = self.k
+        if k > self.k:
+            raise Exception('the neighbor graph only has '+str(self.k)+' neighbors per token')
+        i = self._positions[token]
+        return [self.tokens[self.indices[i][j]] for j in range(0, k) if self.scores[i][j] != -np.inf]
+
+    @staticmethod
+    def find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=10, suppress_print=True, workers=1):
+        """
+        The lookup version of kNearestNeighbors.find_k_nearest_neighbors_multi, with the same inputs and output.
+        :param embeddings_file: the json lines embeddings file
+        :param seed_tokens: a set of tokens that must occur in the embeddings_file
+        :param k:
+        :param suppress_print:
+        :param workers: see get
+        :return: a dictionary where each seed token references the list of its k nearest neighbors
+        """
+        graph = NeighborGraph.get(embeddings_file, k=k, workers=workers)
+        results = dict()
+        for seed_token in seed_tokens:
+            results[seed_token] = graph.neighbors(seed_token, k)
+            if not suppress_print:
+                print 'seed_token: ',
+                print seed_token
+                print results[seed_token]
+                print '\n'
+        return results
@@ -0,0 +1,95 @@
+class PhraseMatcher:
+    """
+    A token-level Aho-Corasick automaton. Add the (tokenized) phrases you are looking for, e.g. the multi-token
+    annotations of a document ['salt', 'lake', 'city'] or a whole dictionary of them, and find_spans will locate
+    every occurrence of every phrase in a tokenized document in a single pass, instead of one scan (with list
+    slicing) per phrase. The matcher can be reused across documents.
+    """
+
+    def __init__(self, phrases=None):
+        """
+        :param phrases: (optional) a dict where each key references its list of tokens, or a list of token lists
+        (in which case the key is the tuple of tokens)
+        """
+        self._goto = [dict()]  # state -> {token: next state}; state 0 is the root
+        self._fail = [0]
+        self._phrases = [list()]  # state -> list of (key, phrase length) of the phrases that end at this state
+        self._outputs = [list()]  # as _phrases, plus the phrases ending at the states reachable by failure links
+        self._built = True
+        if phrases:
+            if type(phrases) == dict:
+                for key, tokens in phrases.items():
+                    self.add_phrase(tokens, key)
+            else:
+                for tokens in phrases:
+                    self.add_phrase(tokens)
+
+    def add_phrase(self, tokens, key=None):
+        """
+        :param tokens: a non-empty list of tokens
+        :param key: what find_spans will report occurrences under. Defaults to the tuple of tokens.
+        :return: None
+        """
+        if not tokens:
+            return
+        if key is None:
+            key = tuple(tokens)
+        state = 0
+        for token in tokens:
+            if token not in self._goto[state]:
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._phrases.append(list())
+                self._goto[state][token] = len(self._goto)-1
+            state = self._goto[state][token]
+        if (key, len(tokens)) not in self._phrases[state]:
+            self._phrases[state].append((key, len(tokens)))
+            self._built = False
+
+    def _build(self):
+        """
+        Breadth-first computation of the failure links; the outputs of a state's failure state get merged into
+        its own, so find_spans never has to follow output chains.
+        """
+        self._fail = [0]*len(self._goto)
+        self._outputs = [list(phrases) for phrases in self._phrases]
+        queue = list()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for token, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(token, 0)
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+        self._built = True
+
+    def find_spans(self, list_of_words):
+        """
+        :param list_of_words: a tokenized document
+        :return: a dict where each key (see add_phrase) that occurs in list_of_words references the list of its
+        (start, end) token spans (end exclusive), in increasing order of end. Keys that do not occur are absent.
+        """
+        if not self._built:
+            self._build()
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        spans = dict()
+        state = 0
+        for i in range(0, len(list_of_words)):
+            token = list_of_words[i]
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for key, length in outputs[state]:
+                if key not in spans:
+                    spans[key] = list()
+                spans[key].append((i+1-length, i+1))
+        return spans
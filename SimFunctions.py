@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 class SimFunctions:
     """
@@ -34,3 +35,92 @@ class SimFunctions:
             return 0.0
         else:
             return math.fabs(sim/(total1*total2))
+
+    @staticmethod
+    def row_norms(matrix):
+        """
+        :param matrix: a 2-d array (or list of vectors)
+        :return: the l2 norm of each row, as a float64 array. Precompute these once when scoring many queries against
+        the same matrix (see abs_cosine_sim_batch).
+        """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        return np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+
+    @staticmethod
+    def _as_matrix(matrix, dimensions):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        if matrix.ndim != 2 or matrix.shape[1] != dimensions:
+            if matrix.size == 0:
+                return matrix.reshape((0, dimensions))
+            raise Exception
+        return matrix
+
+    @staticmethod
+    def abs_dot_product_sim_batch(vector, matrix):
+        """
+        abs_dot_product_sim of vector against every row of matrix, in one matrix-vector product.
+        :param vector: a vector
+        :param matrix: a 2-d array (or list of vectors) with len(vector) columns
+        :return: a float64 array with one score per row of matrix
+        """
+        vector = np.asarray(vector, dtype=np.float64)
+        return np.abs(SimFunctions._as_matrix(matrix, len(vector)).dot(vector))
+
+    @staticmethod
+    def abs_cosine_sim_batch(vector, matrix, norms=None):
+        """
+        abs_cosine_sim of vector against every row of matrix, in one matrix-vector product. As in abs_cosine_sim,
+        the score is 0.0 wherever vector or the row is all zeros.
+        :param vector: a vector
+        :param matrix: a 2-d array (or list of vectors) with len(vector) columns
+        :param norms: row_norms(matrix), if already known
+        :return: a float64 array with one score per row of matrix
+        """
+        vector = np.asarray(vector, dtype=np.float64)
+        matrix = SimFunctions._as_matrix(matrix, len(vector))
+        if norms is None:
+            norms = SimFunctions.row_norms(matrix)
+        return SimFunctions._divide_by_norms(matrix.dot(vector), np.sqrt(vector.dot(vector)) * norms)
+
+    @staticmethod
+    def abs_dot_product_sim_matrix(matrix1, matrix2):
+        """
+        :param matrix1: a 2-d array (or list of vectors)
+        :param matrix2: a 2-d array (or list of vectors) with as many columns as matrix1
+        :return: a len(matrix1) x len(matrix2) float64 array, where [i, j] is abs_dot_product_sim of matrix1[i]
+        and matrix2[j]
+        """
+        matrix1 = np.asarray(matrix1, dtype=np.float64)
+        if matrix1.ndim != 2:
+            raise Exception
+        return np.abs(matrix1.dot(SimFunctions._as_matrix(matrix2, matrix1.shape[1]).T))
+
+    @staticmethod
+    def abs_cosine_sim_matrix(matrix1, matrix2, norms1=None, norms2=None):
+        """
+        :param matrix1: a 2-d array (or list of vectors)
+        :param matrix2: a 2-d array (or list of vectors) with as many columns as matrix1
+        :param norms1: row_norms(matrix1), if already known
+        :param norms2: row_norms(matrix2), if already known
+        :return: a len(matrix1) x len(matrix2) float64 array, where [i, j] is abs_cosine_sim of matrix1[i] and
+        matrix2[j] (0.0 if either of them is all zeros)
+        """
+        matrix1 = np.asarray(matrix1, dtype=np.float64)
+        if matrix1.ndim != 2:
+            raise Exception
+        matrix2 = SimFunctions._as_matrix(matrix2, matrix1.shape[1])
+        if norms1 is None:
+            norms1 = SimFunctions.row_norms(matrix1)
+        if norms2 is None:
+            norms2 = SimFunctions.row_norms(matrix2)
+        return SimFunctions._divide_by_norms(matrix1.dot(matrix2.T), np.outer(norms1, norms2))
+
+    @staticmethod
+    def _divide_by_norms(dots, norm_products):
+        """
+        :return: |dots|/norm_products, and 0.0 where norm_products is 0.0
+        """
+        sims = np.zeros(dots.shape, dtype=np.float64)
+        nonzero = norm_products != 0.0
+        sims[nonzero] = np.abs(dots[nonzero] / norm_products[nonzero])
+        return sims
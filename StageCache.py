@@ -0,0 +1,173 @@
+import codecs
+import hashlib
+import json
+import os
+import re
+import shutil
+
+
+class StageCache:
+    """
+    A content-addressed cache for the outputs of pipeline stages (tokenize, featurize, train...). A stage's output
+    is stored under a hash of the contents of its input files, its parameters and the source code of the modules
+    that compute it, so a stage only re-runs if one of those changed, no matter which file names or runs its inputs
+    came from. For example, if the training and the actual file are the same, they only get tokenized once.
+
+    Content hashes of (possibly big) input files are remembered by path, size and modification time, so an
+    unchanged embeddings file is not re-hashed on every run.
+
+    Only the max_entries most recently used outputs of each stage are kept; older ones (e.g. from before an input
+    or the code changed) get evicted when a new one is stored.
+    """
+
+    CONTENT_HASHES_FILE = 'content-hashes.json'
+
+    def __init__(self, cache_dir, max_entries=2):
+        """
+        :param cache_dir: where the stage outputs get stored. It will be created if it doesn't exist.
+        :param max_entries: the number of outputs kept per stage. Two, so that the training and the actual data
+        don't evict each other's tokens file. If None, nothing is ever evicted.
+        """
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._content_hashes = dict()
+        hashes_file = os.path.join(cache_dir, StageCache.CONTENT_HASHES_FILE)
+        if os.path.exists(hashes_file):
+            with codecs.open(hashes_file, 'r', 'utf-8') as f:
+                self._content_hashes = json.load(f)
+
+    @staticmethod
+    def _hash_file(path, digest):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+
+    def content_hash(self, path):
+        """
+        :param path: a file, or a directory (e.g. a FeatureFile), in which case all its files are hashed
+        :return: the sha1 hex digest of the contents of path
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if os.path.isdir(path):
+            # the signature of a directory is the one of its most recently modified file
+            names = sorted(os.listdir(path))
+            signature = [len(names), max([os.stat(os.path.join(path, n)).st_mtime for n in names] or [stat.st_mtime])]
+        else:
+            signature = [stat.st_size, stat.st_mtime]
+        if path in self._content_hashes and self._content_hashes[path][0] == signature:
+            return self._content_hashes[path][1]
+
+        digest = hashlib.sha1()
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                digest.update(name.encode('utf-8'))
+                StageCache._hash_file(os.path.join(path, name), digest)
+        else:
+            StageCache._hash_file(path, digest)
+        self._content_hashes[path] = [signature, digest.hexdigest()]
+        out = codecs.open(os.path.join(self.cache_dir, StageCache.CONTENT_HASHES_FILE), 'w', 'utf-8')
+        json.dump(self._content_hashes, out)
+        out.close()
+        return digest.hexdigest()
+
+    @staticmethod
+    def code_version(modules):
+        """
+        :param modules: a list of (imported) modules
+        :return: a hash of their source code
+        """
+        digest = hashlib.sha1()
+        for module in modules:
+            source = module.__file__
+            if source.endswith('.pyc') or source.endswith('.pyo'):
+                source = source[0:-1]
+            digest.update(module.__name__.encode('utf-8'))
+            StageCache._hash_file(source, digest)
+        return digest.hexdigest()
+
+    def key(self, stage, input_files, params, modules):
+        """
+        :param stage: the name of the stage, e.g. 'tokenize'
+        :param input_files: the list of files (or FeatureFiles) the stage reads
+        :param params: a dictionary with the parameters of the stage (must be json-serializable)
+        :param modules: the modules whose code the stage runs
+        :return: the key the output of the stage is stored under
+        """
+        digest = hashlib.sha1()
+        digest.update(stage.encode('utf-8'))
+        for input_file in input_files:
+            digest.update(self.content_hash(input_file).encode('utf-8'))
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        digest.update(StageCache.code_version(modules).encode('utf-8'))
+        return digest.hexdigest()
+
+    def run(self, stage, input_files, params, modules, build, suffix=''):
+        """
+        Returns the cached output of the stage if its inputs are unchanged, otherwise computes and caches it.
+        :param stage: see key
+        :param input_files: see key
+        :param params: see key
+        :param modules: see key
+        :param build: a function that takes a path and writes the output of the stage to it (a file or a directory)
+        :param suffix: appended to the name of the output, e.g. '.jl'
+        :return: the path of the (cached) output
+        """
+        key = self.key(stage, input_files, params, modules)
+        path = os.path.join(self.cache_dir, stage+'-'+key+suffix)
+        if os.path.exists(path):
+            self.hits += 1
+            print 'stage '+stage+': inputs unchanged, reusing '+path
+            os.utime(path, None)  # most recently used
+            return path
+        self.misses += 1
+        tmp_path = path+'.tmp'
+        StageCache._remove(tmp_path)
+        build(tmp_path)
+        os.rename(tmp_path, path)
+        self.evict(stage, keep=key)
+        return path
+
+    def evict(self, stage, keep=None):
+        """
+        Removes all but the max_entries most recently used outputs of stage, along with the files stored next to
+        them (e.g. the groups file of a pos-neg file).
+        :param stage: see key
+        :param keep: a key that is kept whatever its modification time (e.g. the one that was just stored)
+        :return: None
+        """
+        if self.max_entries is None:
+            return
+        pattern = re.compile(re.escape(stage)+'-([0-9a-f]{40})')
+        entries = dict()  # key -> the names of its files
+        for name in os.listdir(self.cache_dir):
+            match = pattern.match(name)
+            if match:
+                entries.setdefault(match.group(1), list()).append(name)
+        last_used = dict()
+        for key, names in entries.items():
+            modified = max([os.path.getmtime(os.path.join(self.cache_dir, name)) for name in names])
+            last_used[key] = (key == keep, modified)
+        for key in sorted(entries, key=last_used.get, reverse=True)[self.max_entries:]:
+            for name in entries[key]:
+                StageCache._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        """
+        Removes every cached output (and the remembered content hashes).
+        :return: None
+        """
+        for name in os.listdir(self.cache_dir):
+            StageCache._remove(os.path.join(self.cache_dir, name))
+        self._content_hashes = dict()
@@ -6,10 +6,13 @@ import nltk
 from scipy.stats import rankdata
 import numpy as np
 import random
+import time
+import itertools
+import multiprocessing
+import LRUCache
 
 from digExtractor.extractor import Extractor
-from digExtractor.extractor_processor import ExtractorProcessor
-from digTokenizerExtractor.tokenizer_extractor import TokenizerExtractor
+import TokenizerSession
 
 
 
@@ -19,6 +22,9 @@ class TextPreprocessors:
     so they are more suitable for word-embedding code.
     """
 
+    # annotation values (cities, names, colors...) recur across the whole corpus; see tokenize_string_cached
+    _tokenize_string_cache = LRUCache.LRUCache(max_size=100000)
+
     @staticmethod
     def is_sublist_in_big_list(big_list, sublist):
         # matches = []
@@ -27,6 +33,38 @@ class TextPreprocessors:
                 return True
         return False
 
+    @staticmethod
+    def build_token_position_index(list_of_words):
+        """
+        Build an inverted index over a tokenized document, so that we can locate words without scanning it.
+        :param list_of_words: e.g. the tokenized readability_text of an object
+        :return: a dict where each token references the (increasing) list of positions it occurs at
+        """
+        position_index = dict()
+        for i in range(0, len(list_of_words)):
+            if list_of_words[i] not in position_index:
+                position_index[list_of_words[i]] = list()
+            position_index[list_of_words[i]].append(i)
+        return position_index
+
+    @staticmethod
+    def find_token_spans(position_index, big_list, sublist):
+        """
+        Locates every occurrence of sublist in big_list, using the position index of big_list. Only the positions
+        of sublist[0] get checked.
+        :param position_index: built by build_token_position_index(big_list)
+        :param big_list: the tokenized document
+        :param sublist: a list of tokens (may be of length 1)
+        :return: a list of (start, end) spans (end exclusive). Empty if sublist does not occur.
+        """
+        spans = list()
+        if not sublist or sublist[0] not in position_index:
+            return spans
+        for i in position_index[sublist[0]]:
+            if len(sublist) == 1 or big_list[i:i + len(sublist)] == sublist:
+                spans.append((i, i + len(sublist)))
+        return spans
+
     @staticmethod
     def tokenize_string(string):
         """
@@ -53,7 +91,57 @@ class TextPreprocessors:
         return word_tokens
 
     @staticmethod
-    def _tokenize_field(obj, field, method='dig'):
+    def tokenize_string_cached(string):
+        """
+        Memoized tokenize_string, for strings that recur a lot (e.g. annotation values). The cache is a bounded
+        LRU; see tokenize_string_cache_stats, save_tokenize_string_cache and load_tokenize_string_cache.
+        :param string: e.g. 'salt lake city'
+        :return: list of tokens (a copy, so feel free to modify it)
+        """
+        cache = TextPreprocessors._tokenize_string_cache
+        word_tokens = cache.get(string)
+        if word_tokens is None:
+            word_tokens = TextPreprocessors.tokenize_string(string)
+            cache.put(string, word_tokens)
+        return list(word_tokens)
+
+    @staticmethod
+    def tokenize_string_cache_stats():
+        """
+        :return: the stats dictionary of the tokenize_string_cached cache (hits, misses, hit_rate...)
+        """
+        return TextPreprocessors._tokenize_string_cache.stats()
+
+    @staticmethod
+    def save_tokenize_string_cache(cache_file):
+        """
+        Writes the tokenize_string_cached cache out, so the next run can start with it. Each line is a json list
+        [string, tokens].
+        :param cache_file:
+        :return: None
+        """
+        out = codecs.open(cache_file, 'w', 'utf-8')
+        for string, word_tokens in TextPreprocessors._tokenize_string_cache.items():
+            json.dump([string, word_tokens], out)
+            out.write('\n')
+        out.close()
+
+    @staticmethod
+    def load_tokenize_string_cache(cache_file):
+        """
+        Fills the tokenize_string_cached cache from a file written by save_tokenize_string_cache. If the file
+        holds more entries than the cache, the most recently used ones are kept.
+        :param cache_file:
+        :return: None
+        """
+        cache = TextPreprocessors._tokenize_string_cache
+        with codecs.open(cache_file, 'r', 'utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                cache.put(entry[0], entry[1])
+
+    @staticmethod
+    def _tokenize_field(obj, field, method='dig', session=None):
         """
         At present, we'll deal with only one field (e.g. readability_text). The field could be a unicode
         or a list, so make sure to take both into account.
@@ -61,6 +149,8 @@ class TextPreprocessors:
         We are not preprocessing the tokens in any way. For this, I'll write another function.
         :param obj: the adultservice json object
         :param field: e.g. 'readability_text'
+        :param session: the TokenizerSession to use for method 'dig'. If None, we use the default session of the
+        process. Either way, the tokenizer is not set up again for every call.
         :return: A list of tokens.
         """
 
@@ -89,11 +179,9 @@ class TextPreprocessors:
                         word_tokens += word_tokenize(s)
 
         elif(method == 'dig'):
-            doc = { 'string': obj[field]}
-            e = TokenizerExtractor()
-            ep = ExtractorProcessor().set_input_fields('string').set_output_field('output').set_extractor(e)
-            updated_doc = ep.extract(doc)
-            word_tokens = updated_doc['output'][0]['result'][0]['value']
+            if session is None:
+                session = TokenizerSession.TokenizerSession.default()
+            word_tokens = session.tokenize(obj[field])
 
         return word_tokens
 
@@ -179,12 +267,13 @@ class TextPreprocessors:
         :return: None
         """
         field = 'readability_text'
+        session = TokenizerSession.TokenizerSession()
         out = codecs.open(output_file, 'w', 'utf-8')
         with codecs.open(input_file, 'r', 'utf-8') as f:
             for line in f:
                 tokens_obj = dict()
                 obj = json.loads(line)
-                tokenized_field = TextPreprocessors._tokenize_field(obj, field)
+                tokenized_field = TextPreprocessors._tokenize_field(obj, field, session=session)
                 if tokenized_field:
                     tokens_obj[obj['identifier']] = TextPreprocessors._preprocess_tokens(tokenized_field, options=["lower"])
                     json.dump(tokens_obj, out)
@@ -204,6 +293,7 @@ class TextPreprocessors:
         :return: None
         """
         # field = 'readability_text'
+        session = TokenizerSession.TokenizerSession()
         out = codecs.open(output_file, 'w', 'utf-8')
         with codecs.open(input_file, 'r', 'utf-8') as f:
             for line in f:
@@ -234,7 +324,7 @@ class TextPreprocessors:
                     if k == 'email':
                         tokenized_field = TextPreprocessors._extract_name_strings_from_dict_lists(obj, 'email', True)
                     else:
-                        tokenized_field = TextPreprocessors._tokenize_field(obj, k)
+                        tokenized_field = TextPreprocessors._tokenize_field(obj, k, session=session)
                     if tokenized_field:
                         tokens = TextPreprocessors._preprocess_tokens(tokenized_field, options=["lower"])
                         if tokens:
@@ -278,11 +368,13 @@ class TextPreprocessors:
         :param output_file:
         :return:
         """
+        session = TokenizerSession.TokenizerSession()
         out = codecs.open(output_file, 'w', 'utf-8')
         with codecs.open(input_file, 'r', 'utf-8') as f:
             for line in f:
                 obj = json.loads(line)
-                tokenized_field = TextPreprocessors._tokenize_field(obj, 'high_recall_readability_text')
+                tokenized_field = TextPreprocessors._tokenize_field(obj, 'high_recall_readability_text',
+                                                                    session=session)
                 if tokenized_field:
                     obj['high_recall_readability_text'] = TextPreprocessors._preprocess_tokens(tokenized_field, options=["lower"])
                     for k in obj.keys():
@@ -292,7 +384,189 @@ class TextPreprocessors:
         out.close()
 
     @staticmethod
-    def preprocess_annotated_file(input_file, text_field, output_file):
+    def _annotation_regions(text, annotations, window_size, session):
+        """
+        Finds the occurrences of annotations in text by a (case-insensitive) string search, and grows a character
+        region around each one, cutting at whitespace, until it holds at least window_size tokens on either side of
+        the occurrence (or reaches the end of text). Overlapping regions get merged, so the window of an
+        occurrence never runs into another region.
+        :param text: the raw text field
+        :param annotations: a list of annotation strings (e.g. the annotated_cities of the object)
+        :param window_size: the window size of the context generator that will be used
+        :param session: a TokenizerSession
+        :return: a sorted list of disjoint (start, end) character regions
+        """
+        regions = list()
+        for annotation in set(annotations):
+            words = annotation.split()
+            if not words:
+                continue
+            pattern = r'\s+'.join([re.escape(w) for w in words])
+            # a token never starts or ends in the middle of a word, so neither can an occurrence. The tokenizer
+            # splits on _ (as on all punctuation), so _ is not part of a word here, unlike in \w
+            if re.match(r'[^\W_]', annotation.strip()[0], re.UNICODE):
+                pattern = r'(?<![^\W_])' + pattern
+            if re.match(r'[^\W_]', annotation.strip()[-1], re.UNICODE):
+                pattern += r'(?![^\W_])'
+            pattern = re.compile(pattern, re.IGNORECASE | re.UNICODE)
+            for m in pattern.finditer(text):
+                start = TextPreprocessors._grow_region(text, m.start(), -1, window_size, session)
+                end = TextPreprocessors._grow_region(text, m.end(), 1, window_size, session)
+                regions.append((start, end))
+        regions.sort()
+        merged = list()
+        for start, end in regions:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def _grow_region(text, position, direction, window_size, session):
+        """
+        :param text:
+        :param position: where the occurrence starts (direction -1) or ends (direction 1)
+        :param direction: -1 to grow backward, 1 to grow forward
+        :param window_size:
+        :param session: a TokenizerSession
+        :return: a character offset, at whitespace (or at either end of text), such that the text between it and
+        position has at least window_size tokens
+        """
+        chunks = window_size + 1  # whitespace-delimited chunks have at least one token, unless they are all junk
+        span = 16*chunks  # characters to look at; we only split what's near position, not the whole text
+        while True:
+            if direction < 0:
+                start = max(position-span, 0)
+                pieces = re.split(r'(\s+)', text[start:position])
+                if start > 0:
+                    pieces = pieces[1:]  # the first chunk may have been cut
+                if len(pieces) <= 2*chunks:
+                    if start == 0:
+                        return 0
+                    span *= 2
+                    continue
+                offset = position - len(u''.join(pieces[-2*chunks:]))
+                if len(session.tokenize(text[offset:position])) >= window_size:
+                    return offset
+            else:
+                end = min(position+span, len(text))
+                pieces = re.split(r'(\s+)', text[position:end])
+                if end < len(text):
+                    pieces = pieces[0:-1]
+                if len(pieces) <= 2*chunks:
+                    if end == len(text):
+                        return len(text)
+                    span *= 2
+                    continue
+                offset = position + len(u''.join(pieces[0:2*chunks]))
+                if len(session.tokenize(text[position:offset])) >= window_size:
+                    return offset
+            chunks *= 2
+            span *= 2
+
+    @staticmethod
+    def _tokenize_regions(obj, text_field, annotated_field, window_size, session=None):
+        """
+        The region-only alternative to _tokenize_field: only the text around the occurrences of the annotations
+        (see _annotation_regions) gets tokenized. The tokens of the regions are concatenated in order. Since every
+        occurrence keeps window_size tokens of context on either side, a symmetric context generator with a
+        window of at most window_size sees the same windows as on the full text.
+        :param obj:
+        :param text_field: e.g. 'readability_text'
+        :param annotated_field: e.g. 'annotated_cities'
+        :param window_size:
+        :param session: a TokenizerSession. If None, we use the default session of the process.
+        :return: A list of tokens (empty if obj has no annotations, without tokenizing anything)
+        """
+        if session is None:
+            session = TokenizerSession.TokenizerSession.default()
+        if not obj.get(annotated_field) or not obj.get(text_field):
+            return list()
+        text = obj[text_field]
+        word_tokens = list()
+        for start, end in TextPreprocessors._annotation_regions(text, obj[annotated_field], window_size, session):
+            word_tokens += session.tokenize(text[start:end])
+        return word_tokens
+
+    @staticmethod
+    def _preprocess_annotated_line(line, text_field, session=None, serialize=True, annotated_field=None,
+                                   window_size=5):
+        """
+        The per-line part of preprocess_annotated_file.
+        :param line: a json line
+        :param text_field:
+        :param session: a TokenizerSession (see _tokenize_field)
+        :param serialize: if False, the preprocessed object is returned as is
+        :param annotated_field: if specified, we only tokenize the regions of the text field around its annotations
+        (see _tokenize_regions). Objects with a non-blank text field but no tokens in the regions (e.g. without
+        annotations) are kept rather than dropped, so that line numbers still match full tokenization.
+        :param window_size: see _tokenize_regions
+        :return: the preprocessed object, serialized as a json string, or None if the text field had no tokens
+        """
+        obj = json.loads(line)
+        if annotated_field is not None:
+            if not obj.get(text_field, u'').strip():
+                return None
+            obj[text_field] = TextPreprocessors._tokenize_regions(obj, text_field, annotated_field, window_size,
+                                                                  session=session)
+            for k in obj.keys():
+                obj[k] = TextPreprocessors._preprocess_tokens(obj[k], options=["lower"])
+            if serialize:
+                return json.dumps(obj)
+            return obj
+        tokenized_field = TextPreprocessors._tokenize_field(obj, text_field, session=session)
+        if tokenized_field:
+            obj[text_field] = TextPreprocessors._preprocess_tokens(tokenized_field,
+                                                                                       options=["lower"])
+            for k in obj.keys():
+                obj[k] = TextPreprocessors._preprocess_tokens(obj[k], options=["lower"])
+            if serialize:
+                return json.dumps(obj)
+            return obj
+        return None
+
+    @staticmethod
+    def preprocess_annotated_stream(input_file, text_field, workers=1, chunk_size=500, serialize=False,
+                                    annotated_field=None, window_size=5):
+        """
+        Generator version of preprocess_annotated_file: yields the result of _preprocess_annotated_line for every
+        line of input_file, in order (including the Nones, so callers can count lines). Use it with
+        serialize=False to feed preprocessed objects to the next stage without writing a tokens file.
+        :param input_file:
+        :param text_field:
+        :param workers: the number of processes to use
+        :param chunk_size: the number of lines handed to a worker at a time
+        :param serialize: if True, we yield json strings rather than objects
+        :param annotated_field: see _preprocess_annotated_line
+        :param window_size: see _preprocess_annotated_line
+        :return: a generator
+        """
+        with codecs.open(input_file, 'r', 'utf-8') as f:
+            if workers > 1:
+                pool = multiprocessing.Pool(workers)
+                try:
+                    chunks = iter(lambda: list(itertools.islice(f, chunk_size)), [])
+                    for results in pool.imap(_preprocess_annotated_chunk,
+                                    itertools.izip(chunks, itertools.repeat(text_field), itertools.repeat(serialize),
+                                                   itertools.repeat(annotated_field), itertools.repeat(window_size))):
+                        for result in results:
+                            yield result
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                session = TokenizerSession.TokenizerSession()
+                for line in f:
+                    yield TextPreprocessors._preprocess_annotated_line(line, text_field, session=session,
+                                        serialize=serialize, annotated_field=annotated_field, window_size=window_size)
+
+    @staticmethod
+    def preprocess_annotated_file(input_file, text_field, output_file, workers=1, chunk_size=500,
+                                  annotated_field=None, window_size=5):
         """
         We will take in a file such as annotated-cities-1.json as input and output another json that:
         tokenizes the text( e.g. high_recall_readability_text field) and converts it to lower-case.
@@ -302,24 +576,56 @@ class TextPreprocessors:
 
         Note that the field names remain the same in the output file, even though high_recall-* is now
          a list of tokens instead of a string.
+
+        With workers > 1, chunks of chunk_size lines get preprocessed in a process pool. The output is written in
+        the same order as with a single worker, which matters because line numbers are used downstream (e.g. by
+        TokenSupervised._classify).
+
+        With annotated_field (e.g. 'annotated_cities'), only the regions of the text around the annotations get
+        tokenized, enough for windows of up to window_size tokens (see _tokenize_regions), and objects without
+        annotations are not tokenized at all. Use this when the tokens file is only going to be used for context
+        vectors around the annotations; the cost then tracks the annotations rather than the length of the pages.
         :param input_file:
         :param text_field:
         :param output_file:
+        :param workers: the number of processes to use
+        :param chunk_size: the number of lines handed to a worker at a time
+        :param annotated_field:
+        :param window_size: the largest window size the tokens file will be used with
         :return:
         """
+        start = time.time()
+        num_lines = 0
         out = codecs.open(output_file, 'w', 'utf-8')
-        with codecs.open(input_file, 'r', 'utf-8') as f:
+        for result in TextPreprocessors.preprocess_annotated_stream(input_file, text_field, workers=workers,
+                                                                    chunk_size=chunk_size, serialize=True,
+                                                                    annotated_field=annotated_field,
+                                                                    window_size=window_size):
+            num_lines += 1
+            if result is not None:
+                out.write(result)
+                out.write('\n')
+        out.close()
+        elapsed = time.time() - start
+        print 'preprocessed '+str(num_lines)+' lines in '+str(round(elapsed, 2))+' seconds ('+\
+              str(round(num_lines/elapsed if elapsed else 0.0, 1))+' lines per second, '+str(workers)+' worker(s))'
+
+    @staticmethod
+    def collect_token_vocabulary(preprocessed_file, text_field):
+        """
+        Collects every token that occurs in the text field of a file written by preprocess_annotated_file. Use
+        this to restrict the embeddings we load to the ones the corpus can actually use.
+        :param preprocessed_file: a tokens file, output by preprocess_annotated_file
+        :param text_field: e.g. 'readability_text'
+        :return: a set of tokens
+        """
+        vocabulary = set()
+        with codecs.open(preprocessed_file, 'r', 'utf-8') as f:
             for line in f:
                 obj = json.loads(line)
-                tokenized_field = TextPreprocessors._tokenize_field(obj, text_field)
-                if tokenized_field:
-                    obj[text_field] = TextPreprocessors._preprocess_tokens(tokenized_field,
-                                                                                               options=["lower"])
-                    for k in obj.keys():
-                        obj[k] = TextPreprocessors._preprocess_tokens(obj[k], options=["lower"])
-                    json.dump(obj, out)
-                    out.write('\n')
-        out.close()
+                if text_field in obj and obj[text_field]:
+                    vocabulary.update(obj[text_field])
+        return vocabulary
 
     @staticmethod
     def get_rankings(data):
@@ -467,7 +773,20 @@ class TextPreprocessors:
         print "Precision: {}".format(float(total_classified_city_which_is_a_city)/(total_classified_city_which_is_a_city+total_classified_city_which_is_not_a_city))
         print "Recall: {}".format(float(total_classified_city_which_is_a_city)/(total_classified_city_which_is_a_city+total_city_not_classified_as_city))
 
-                
+
+
+def _preprocess_annotated_chunk(args):
+    """
+    Process pool worker for TextPreprocessors.preprocess_annotated_stream (it has to be a module-level function to
+    be picklable). Each worker process uses its own default TokenizerSession.
+    :param args: a tuple (list of json lines, text_field, serialize, annotated_field, window_size)
+    :return: the list of results of TextPreprocessors._preprocess_annotated_line, in order
+    """
+    lines, text_field, serialize, annotated_field, window_size = args
+    return [TextPreprocessors._preprocess_annotated_line(line, text_field, serialize=serialize,
+                        annotated_field=annotated_field, window_size=window_size) for line in lines]
+
+
 # path='/Users/mayankkejriwal/ubuntu-vm-stuff/home/mayankkejriwal/tmp/'
 # TextPreprocessors.preprocess_annotated_cities_file(path+'raw-data/annotated-cities-2.json',
 #                                                 path+'prepped-data/annotated-cities-2-prepped.json')
@@ -1,8 +1,13 @@
 import TextPreprocessors
 import codecs, json
+import os
 import kNearestNeighbors
+import EmbeddingStore
+import FeatureFile
+import NearDuplicates
 import re
 import numpy as np
+from scipy import sparse
 import warnings
 from sklearn.preprocessing import normalize
 from sklearn.ensemble import RandomForestClassifier
@@ -13,6 +18,7 @@ from sklearn.linear_model import LogisticRegression, LinearRegression
 from sklearn.metrics import roc_auc_score, accuracy_score, precision_score, precision_recall_fscore_support
 from sklearn.metrics import precision_recall_curve
 import ContextVectorGenerators
+import PhraseMatcher
 import FieldAnalyses
 import matplotlib.pyplot as plt
 from random import shuffle
@@ -77,15 +83,241 @@ class TokenSupervised:
         out = codecs.open(output_file, 'w', 'utf-8')
         with codecs.open(dictionary_file1, 'r', 'utf-8') as f:
             for line in f:
-                out.write(line[0:-1]+'\t'+str(full_embeddings[line[0:-1]])+'\t0\n')
+                out.write(line[0:-1]+'\t'+str(full_embeddings[line[0:-1]].tolist())+'\t0\n')
         with codecs.open(dictionary_file2, 'r', 'utf-8') as f:
             for line in f:
-                out.write(line[0:-1]+'\t'+str(full_embeddings[line[0:-1]])+'\t1\n')
+                out.write(line[0:-1]+'\t'+str(full_embeddings[line[0:-1]].tolist())+'\t1\n')
         out.close()
 
+    @staticmethod
+    def _generate_combined_context_vecs(obj, text_field, annotated_field, embeddings, context_generator,
+                                        context_cache=None):
+        """
+        The per-object part of the prep_preprocessed_* functions. Single-token words are located through one token
+        position index of the text field, and all the multi-token words through one PhraseMatcher pass over it, both
+        built once for the object. The spans are handed to the context generator so it doesn't have to search the
+        text again. If a word occurs (with context) more than once, its context vectors are averaged.
+        :param obj: a preprocessed object (see TextPreprocessors.preprocess_annotated_file)
+        :param text_field: e.g. 'high_recall_readability_text'
+        :param annotated_field: e.g. 'annotated_cities'
+        :param embeddings: the embeddings table/dict
+        :param context_generator: a function in ContextVectorGenerator that accepts spans
+        :param context_cache: if specified, passed on to context_generator, which must accept it (e.g.
+        ContextVectorGenerators.memoized_symmetric_generator)
+        :return: a generator of (word, combined_context_vec) tuples, where combined_context_vec is a numpy array. If
+        the generator returns a dictionary of lists of context vectors (e.g. prefix_sum_multi_window_generator),
+        combined_context_vec is the dictionary of their averages (None where a list is None).
+        """
+        words = list()
+        words_covered = set()
+        for word in obj[annotated_field]:
+            if(word in words_covered):
+                continue
+            else:
+                words_covered.add(word)
+            words.append((word, TextPreprocessors.TextPreprocessors.tokenize_string_cached(word)))
+        if not words:
+            return
+
+        generator_args = dict()
+        if context_cache is not None:
+            generator_args['context_cache'] = context_cache
+        position_index = TextPreprocessors.TextPreprocessors.build_token_position_index(obj[text_field])
+        matcher = PhraseMatcher.PhraseMatcher()
+        for word, word_tokens in words:
+            if len(word_tokens) > 1:
+                matcher.add_phrase(word_tokens, word)
+        multi_token_spans = matcher.find_spans(obj[text_field])
+
+        for word, word_tokens in words:
+            if len(word_tokens) <= 1: # we're dealing with a single word
+                if word not in position_index:
+                    print 'skipping word not found in text field: ',
+                    print word
+                    continue
+                spans = TextPreprocessors.TextPreprocessors.find_token_spans(position_index, obj[text_field], [word])
+                context_vecs = context_generator(word, obj[text_field], embeddings, spans=spans, **generator_args)
+            elif word in multi_token_spans:
+                context_vecs = context_generator(word, obj[text_field], embeddings, multi=True,
+                                                 spans=multi_token_spans[word], **generator_args)
+            else:
+                continue
+
+            if not context_vecs:
+                print 'context_generator did not return anything for word: ',
+                print word
+                continue
+
+            if type(context_vecs) == dict:
+                yield word, dict((k, TokenSupervised._average_context_vecs(v)) for k, v in context_vecs.items())
+            else:
+                yield word, TokenSupervised._average_context_vecs(context_vecs)
+
+    @staticmethod
+    def _average_context_vecs(context_vecs):
+        """
+        :param context_vecs: a list of context vectors, or None
+        :return: their average as a numpy array (a sparse row, if the context vectors are), or None
+        """
+        if not context_vecs:
+            return None
+        count = len(context_vecs)
+        if sparse.issparse(context_vecs[0]):
+            combined_context_vec = context_vecs[0]
+            for context_vec in context_vecs[1:]:
+                combined_context_vec = combined_context_vec + context_vec
+            return combined_context_vec/count if count > 1 else combined_context_vec
+        if(count > 1):
+            combined_context_vec = np.array(context_vecs).sum(axis=0)
+            combined_context_vec = combined_context_vec/count
+        else:
+            combined_context_vec = np.array(context_vecs[0])
+        return combined_context_vec
+
+    @staticmethod
+    def generate_context_rows(objs, text_field, annotated_field, correct_field, embeddings, context_generator,
+                              context_cache=None, representatives=None):
+        """
+        Streams the rows of a pos-neg file without writing it: one (word, context vector, label, index) tuple for
+        every annotated word with a context vector, where label is 1 if the word is in the correct field, and index
+        is the position of its object in objs (the line number of the tokens file).
+        :param objs: an iterable of preprocessed objects (see TextPreprocessors.preprocess_annotated_stream)
+        :param text_field: e.g. 'high_recall_readability_text'
+        :param annotated_field: e.g. 'annotated_cities'
+        :param correct_field: e.g. 'correct_cities'
+        :param embeddings: the embeddings table/dict
+        :param context_generator: a function in ContextVectorGenerator that accepts spans
+        :param context_cache: see _generate_combined_context_vecs
+        :param representatives: if specified, the index of the representative of each object (see
+        NearDuplicates); objects that aren't their own representative are skipped. It only needs to be filled in up
+        to the current object, so it can be built as objs goes by.
+        :return: a generator
+        """
+        for index, obj in enumerate(objs):
+            if representatives is not None and representatives[index] != index:
+                continue
+            for word, combined_context_vec in TokenSupervised._generate_combined_context_vecs(obj, text_field,
+                                                annotated_field, embeddings, context_generator, context_cache):
+                if word in obj[correct_field]:
+                    yield word, combined_context_vec, 1, index
+                else:
+                    yield word, combined_context_vec, 0, index
+
+    @staticmethod
+    def _read_json_lines(jlines_file):
+        """
+        :param jlines_file:
+        :return: a generator over the objects in jlines_file
+        """
+        with codecs.open(jlines_file, 'r', 'utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    @staticmethod
+    def _open_context_rows_file(output_file, output_format='text'):
+        """
+        :param output_file:
+        :param output_format: 'text' for the tab-delimited pos-neg format, or 'binary' for a FeatureFile
+        :return: something to pass to _write_context_row, and close once done
+        """
+        if output_format == 'binary':
+            return FeatureFile.FeatureFile(output_file)
+        else:
+            return codecs.open(output_file, 'w', 'utf-8')
+
+    @staticmethod
+    def _dense_context_vec(context_vec):
+        """
+        Context vectors from sparse generators (e.g. ContextVectorGenerators.sparse_symmetric_generator) stay sparse
+        until they get written or handed to a classifier; this is where they get densified.
+        :param context_vec: a numpy array or a 1 x dimensions scipy.sparse row
+        :return: a 1-d numpy array
+        """
+        if sparse.issparse(context_vec):
+            return context_vec.toarray().ravel()
+        return context_vec
+
+    @staticmethod
+    def _write_context_row(out, row, output_format='text', line_nums=True):
+        """
+        :param out: see _open_context_rows_file
+        :param row: a (word, context vector, label, index) tuple
+        :param output_format: what out was opened with
+        :param line_nums: if False, the index is not written (to text files), as in pos-neg training files
+        :return: None
+        """
+        word, combined_context_vec, label, index = row
+        combined_context_vec = TokenSupervised._dense_context_vec(combined_context_vec)
+        if output_format == 'binary':
+            out.write(word, combined_context_vec, label, index if line_nums else -1)
+        elif line_nums:
+            out.write(word + '\t' + str(combined_context_vec.tolist()) + '\t' + str(label) + '\t' + str(index)
+                      + '\n')
+        else:
+            out.write(word + '\t' + str(combined_context_vec.tolist()) + '\t' + str(label) + '\n')
+
+    @staticmethod
+    def tee_context_rows(rows, output_file, output_format='text', line_nums=True):
+        """
+        Writes the rows of generate_context_rows to output_file as they go by, and passes them on.
+        :param rows: an iterable of (word, context vector, label, index) tuples
+        :param output_file:
+        :param output_format: 'text' for the tab-delimited pos-neg format, or 'binary' for a FeatureFile
+        :param line_nums: if False, the index is not written (to text files), as in pos-neg training files
+        :return: a generator over rows
+        """
+        out = TokenSupervised._open_context_rows_file(output_file, output_format)
+        for row in rows:
+            TokenSupervised._write_context_row(out, row, output_format, line_nums)
+            yield row
+        out.close()
+
+    @staticmethod
+    def collect_context_rows(rows):
+        """
+        The in-memory counterpart of writing rows out and reading them back with _read_pos_neg_file.
+        :param rows: an iterable of (word, context vector, label, index) tuples
+        :return: a dictionary with 'vectors' (l2-normalized float32), 'labels', 'line_nums' and 'words', like
+        _read_pos_neg_file
+        """
+        vectors = list()
+        labels = list()
+        line_nums = list()
+        words = list()
+        for word, combined_context_vec, label, index in rows:
+            vectors.append(np.asarray(TokenSupervised._dense_context_vec(combined_context_vec), dtype=np.float32))
+            labels.append(label)
+            line_nums.append(index)
+            words.append(word)
+        features = {'vectors': np.array(vectors, dtype=np.float32), 'labels': np.array(labels, dtype=np.int64),
+                    'line_nums': np.array(line_nums, dtype=np.int64), 'words': words}
+        TokenSupervised._l2_norm_in_place(features['vectors'])
+        return features
+
+    @staticmethod
+    def _load_prep_embeddings(preprocessed_file, embeddings_file, text_field, restrict_vocabulary=False,
+                              sparse_embeddings=False):
+        """
+        :param preprocessed_file:
+        :param embeddings_file:
+        :param text_field:
+        :param restrict_vocabulary: see prep_preprocessed_annotated_file_for_classification
+        :param sparse_embeddings: if True, the table's matrix is CSR (see EmbeddingStore.get_sparse_table)
+        :return: the embeddings table for the prep_preprocessed_* functions
+        """
+        if restrict_vocabulary:
+            full_embeddings = EmbeddingStore.EmbeddingStore.get_restricted_table(embeddings_file,
+                        TextPreprocessors.TextPreprocessors.collect_token_vocabulary(preprocessed_file, text_field))
+            return full_embeddings.to_sparse() if sparse_embeddings else full_embeddings
+        elif sparse_embeddings:
+            return EmbeddingStore.EmbeddingStore.get_sparse_table(embeddings_file)
+        return kNearestNeighbors.read_in_embeddings(embeddings_file)
+
     @staticmethod
     def prep_preprocessed_annotated_file_for_classification(preprocessed_file, embeddings_file,
-                                            output_file, context_generator, text_field, annotated_field, correct_field):
+                                            output_file, context_generator, text_field, annotated_field, correct_field,
+                                            restrict_vocabulary=False, output_format='text', context_cache=None,
+                                            sparse_embeddings=False):
         """
         Meant for prepping a preprocessed annotated tokens file (e.g. a file output by  into something that is
         amenable to the ML experiments such as in supervised-exp-datasets.
@@ -95,69 +327,34 @@ class TokenSupervised:
         :param embeddings_file:
         :param output_file:
         :param context_generator: a function in ContextVectorGenerator that will be used for taking a word from
-        the text field (e.g.high_recall_readability_text)and generating a context vector based on some notion of context
+        the text field (e.g.high_recall_readability_text)and generating a context vector based on some notion of context.
+        It must accept the spans argument (see ContextVectorGenerators).
         :param text_field: e.g. 'high_recall_readability_text'
         :param: annotated_field: e.g. 'annotated_cities'
         :param correct_field: e.g. 'correct_cities'
+        :param restrict_vocabulary: if True, we only load the embeddings of tokens that occur in the text field of
+        preprocessed_file (see EmbeddingStore.load_restricted). Use this for small batches against big embeddings.
+        :param output_format: 'text' for the tab-delimited pos-neg format, or 'binary' for a FeatureFile. The
+        _prepare_* readers accept either.
+        :param context_cache: an LRUCache of context vectors, for context generators that memoize (e.g.
+        ContextVectorGenerators.memoized_symmetric_generator). Share one across calls with the same embeddings.
+        :param sparse_embeddings: if True, the embeddings are loaded in CSR form (see EmbeddingStore.get_sparse_table),
+        for use with ContextVectorGenerators.sparse_symmetric_generator
         :return: None
         """
-        full_embeddings = kNearestNeighbors.read_in_embeddings(embeddings_file)
+        full_embeddings = TokenSupervised._load_prep_embeddings(preprocessed_file, embeddings_file, text_field,
+                                                                restrict_vocabulary, sparse_embeddings)
         # embeddings = set(full_embeddings.keys())
-        out = codecs.open(output_file, 'w', 'utf-8')
-        with codecs.open(preprocessed_file, 'r', 'utf-8') as f:
-            for line in f:
-                words_covered = set()
-                obj = json.loads(line)
-                for word in obj[annotated_field]:
-                    if(word in words_covered):
-                        continue
-                    else:
-                        words_covered.add(word)
-                    word_tokens = TextPreprocessors.TextPreprocessors.tokenize_string(word)
-                    if len(word_tokens) <= 1: # we're dealing with a single word
-                        if word not in obj[text_field]:
-                            print 'skipping word not found in text field: ',
-                            print word
-                            continue
-                        context_vecs = context_generator(word, obj[text_field], full_embeddings)
-                    elif TextPreprocessors.TextPreprocessors.is_sublist_in_big_list(obj[text_field], word_tokens):
-                        context_vecs = context_generator(word, obj[text_field], full_embeddings, multi=True)
-                    else:
-                        continue
-
-
-                    if not context_vecs:
-                        print 'context_generator did not return anything for word: ',
-                        print word
-                        continue
-                    count = 0
-                    context_vecs_for_word = None
-                    for context_vec in context_vecs:
-                        count+=1
-                    #    print context_vec
-                        if (context_vecs_for_word is None):
-                            context_vecs_for_word = np.array(context_vec)
-                        else:
-                            context_vecs_for_word = np.vstack((context_vecs_for_word, context_vec))
-
-                    #print context_vecs_for_word
-                    if(count > 1):
-                        combined_context_vec = context_vecs_for_word.sum(axis=0)
-                        combined_context_vec = combined_context_vec/count
-                    else:
-                        combined_context_vec = context_vecs_for_word
-
-                    if word in obj[correct_field]:
-                        out.write(word + '\t' + str(combined_context_vec.tolist()) + '\t1\n')
-                    else:
-                        out.write(word + '\t' + str(combined_context_vec.tolist()) + '\t0\n')
-
-        out.close()
+        rows = TokenSupervised.generate_context_rows(TokenSupervised._read_json_lines(preprocessed_file), text_field,
+                                annotated_field, correct_field, full_embeddings, context_generator, context_cache)
+        for row in TokenSupervised.tee_context_rows(rows, output_file, output_format, line_nums=False):
+            pass
 
     @staticmethod
     def prep_preprocessed_actual_file_for_classification(preprocessed_file, embeddings_file,
                                             output_file, context_generator, text_field, annotated_field
-                                            ,correct_field):
+                                            ,correct_field, restrict_vocabulary=False, output_format='text',
+                                            context_cache=None, representatives=None, sparse_embeddings=False):
         """
         Meant for prepping a preprocessed annotated tokens file (e.g. a file output by  into something that is
         amenable to the ML experiments such as in supervised-exp-datasets.
@@ -167,66 +364,97 @@ class TokenSupervised:
         :param embeddings_file:
         :param output_file:
         :param context_generator: a function in ContextVectorGenerator that will be used for taking a word from
-        the text field (e.g.high_recall_readability_text)and generating a context vector based on some notion of context
+        the text field (e.g.high_recall_readability_text)and generating a context vector based on some notion of context.
+        It must accept the spans argument (see ContextVectorGenerators).
         :param text_field: e.g. 'high_recall_readability_text'
         :param: annotated_field: e.g. 'annotated_cities'
+        :param restrict_vocabulary: if True, we only load the embeddings of tokens that occur in the text field of
+        preprocessed_file (see EmbeddingStore.load_restricted). Use this for small batches against big embeddings.
+        :param output_format: 'text' for the tab-delimited pos-neg format, or 'binary' for a FeatureFile. The
+        _prepare_* readers accept either.
+        :param context_cache: an LRUCache of context vectors, for context generators that memoize (e.g.
+        ContextVectorGenerators.memoized_symmetric_generator). Share one across calls with the same embeddings.
+        :param sparse_embeddings: if True, the embeddings are loaded in CSR form (see EmbeddingStore.get_sparse_table),
+        for use with ContextVectorGenerators.sparse_symmetric_generator
+        :param representatives: the line number of the representative of each line of preprocessed_file (see
+        NearDuplicates.group_file). Only representatives get featurized; line numbers are kept as they are.
         :return: None
         """
-        full_embeddings = kNearestNeighbors.read_in_embeddings(embeddings_file)
+        full_embeddings = TokenSupervised._load_prep_embeddings(preprocessed_file, embeddings_file, text_field,
+                                                                restrict_vocabulary, sparse_embeddings)
         # embeddings = set(full_embeddings.keys())
-        out = codecs.open(output_file, 'w', 'utf-8')
-        with codecs.open(preprocessed_file, 'r', 'utf-8') as f:
-            for index,line in enumerate(f):
-                words_covered = set()
-                obj = json.loads(line)
-                for word in obj[annotated_field]:
-                    if(word in words_covered):
-                        continue
-                    else:
-                        words_covered.add(word)
-                    word_tokens = TextPreprocessors.TextPreprocessors.tokenize_string(word)
-                    if len(word_tokens) <= 1: # we're dealing with a single word
-                        if word not in obj[text_field]:
-                            print 'skipping word not found in text field: ',
-                            print word
-                            continue
-                        context_vecs = context_generator(word, obj[text_field], full_embeddings)
-                    elif TextPreprocessors.TextPreprocessors.is_sublist_in_big_list(obj[text_field], word_tokens):
-                        context_vecs = context_generator(word, obj[text_field], full_embeddings, multi=True)
-                    else:
-                        continue
-
-
-                    if not context_vecs:
-                        print 'context_generator did not return anything for word: ',
-                        print word
-                        continue
-
-                    count = 0
-                    context_vecs_for_word = None
-                    for context_vec in context_vecs:
-                        count+=1
-                    #    print context_vec
-                        if (context_vecs_for_word is None):
-                            context_vecs_for_word = np.array(context_vec)
-                        else:
-                            context_vecs_for_word = np.vstack((context_vecs_for_word, context_vec))
+        rows = TokenSupervised.generate_context_rows(TokenSupervised._read_json_lines(preprocessed_file), text_field,
+                                annotated_field, correct_field, full_embeddings, context_generator, context_cache,
+                                representatives)
+        for row in TokenSupervised.tee_context_rows(rows, output_file, output_format, line_nums=True):
+            pass
 
-                    #print context_vecs_for_word
-                    if(count > 1):
-                        combined_context_vec = context_vecs_for_word.sum(axis=0)
-                        combined_context_vec = combined_context_vec/count
-                    else:
-                        combined_context_vec = context_vecs_for_word
-                    combined_context_vec = combined_context_vec.tolist()
-                    
-                    if word in obj[correct_field]:
-                        out.write(word + '\t' + str(combined_context_vec) + '\t1' + '\t'+str(index)+'\n')
-                    else:
-                        out.write(word + '\t' + str(combined_context_vec) + '\t0' + '\t'+str(index)+'\n')
-                        
+    @staticmethod
+    def window_sweep_file_name(output_file, window_size):
+        """
+        :param output_file: e.g. pos-neg-train.txt
+        :param window_size: e.g. 3
+        :return: the name of the window_size feature set of a sweep over output_file, e.g. pos-neg-train-w3.txt
+        """
+        root, ext = os.path.splitext(output_file)
+        return root + '-w' + str(window_size) + ext
 
-        out.close()
+    @staticmethod
+    def prep_preprocessed_file_for_window_sweep(preprocessed_file, embeddings_file, output_file, text_field,
+                                            annotated_field, correct_field, window_sizes=(2, 3, 5, 8),
+                                            concatenate=False, line_nums=False, restrict_vocabulary=False,
+                                            output_format='text'):
+        """
+        The prep_preprocessed_* functions for several window sizes in one pass over preprocessed_file, using
+        ContextVectorGenerators.prefix_sum_multi_window_generator.
+        :param preprocessed_file:
+        :param embeddings_file:
+        :param output_file: if concatenate is False, one pos-neg file per window size gets written, named after
+        output_file (see window_sweep_file_name)
+        :param text_field: e.g. 'high_recall_readability_text'
+        :param annotated_field: e.g. 'annotated_cities'
+        :param correct_field: e.g. 'correct_cities'
+        :param window_sizes: a list of window sizes
+        :param concatenate: if True, we write a single pos-neg file whose vectors are the context vectors for each
+        of the window sizes, concatenated in order. Where a smaller window has no embedded words, its part is zeros.
+        :param line_nums: True for actual data files (see prep_preprocessed_actual_file_for_classification)
+        :param restrict_vocabulary: see prep_preprocessed_annotated_file_for_classification
+        :param output_format: see prep_preprocessed_annotated_file_for_classification
+        :return: None
+        """
+        if restrict_vocabulary:
+            full_embeddings = EmbeddingStore.EmbeddingStore.get_restricted_table(embeddings_file,
+                        TextPreprocessors.TextPreprocessors.collect_token_vocabulary(preprocessed_file, text_field))
+        else:
+            full_embeddings = kNearestNeighbors.read_in_embeddings(embeddings_file)
+
+        def context_generator(word, list_of_words, embeddings_dict, multi=False, spans=None):
+            return ContextVectorGenerators.ContextVectorGenerators.prefix_sum_multi_window_generator(word,
+                                                list_of_words, embeddings_dict, window_sizes, multi=multi, spans=spans)
+
+        rows = TokenSupervised.generate_context_rows(TokenSupervised._read_json_lines(preprocessed_file), text_field,
+                                            annotated_field, correct_field, full_embeddings, context_generator)
+        if concatenate:
+            out = TokenSupervised._open_context_rows_file(output_file, output_format)
+            for word, combined_context_vecs, label, index in rows:
+                zeros = np.zeros_like([v for v in combined_context_vecs.values() if v is not None][0])
+                combined_context_vec = np.concatenate([combined_context_vecs[w] if combined_context_vecs[w] is not None
+                                                       else zeros for w in window_sizes])
+                TokenSupervised._write_context_row(out, (word, combined_context_vec, label, index), output_format,
+                                                   line_nums)
+            out.close()
+        else:
+            outs = dict()
+            for w in window_sizes:
+                outs[w] = TokenSupervised._open_context_rows_file(
+                    TokenSupervised.window_sweep_file_name(output_file, w), output_format)
+            for word, combined_context_vecs, label, index in rows:
+                for w in window_sizes:
+                    if combined_context_vecs[w] is not None:
+                        TokenSupervised._write_context_row(outs[w], (word, combined_context_vecs[w], label, index),
+                                                           output_format, line_nums)
+            for out in outs.values():
+                out.close()
 
     @staticmethod
     def preprocess_prepped_annotated_cities(annotated_cities_file, embeddings_file, output_file, context_generator):
@@ -279,7 +507,8 @@ class TokenSupervised:
 
     @staticmethod
     def construct_nationality_pos_neg_files(ground_truth_corpus, embeddings_file, output_dir,
-                        context_generator=ContextVectorGenerators.ContextVectorGenerators.tokenize_add_all_generator):
+                        context_generator=ContextVectorGenerators.ContextVectorGenerators.tokenize_add_all_generator,
+                        block_size=1000):
         """
         The pos-neg file(s) generator for our nationality experiments. We will apply a filter of 10 (if a nationality
         occurs in fewer than 10 objects) we do not include it herein.
@@ -290,6 +519,8 @@ class TokenSupervised:
         problems
         :param context_generator: a function in ContextVectorGenerator that will be used for taking a word from
         high_recall_readability_text and generating a context vector based on some notion of context
+        :param block_size: with tokenize_add_all_generator, the context vectors are computed block_size objects at a
+        time, with ContextVectorGenerators.tokenize_add_all_block
         :return: None
         """
         full_embeddings = kNearestNeighbors.read_in_embeddings(embeddings_file)
@@ -300,6 +531,8 @@ class TokenSupervised:
         for nat in valid_nats:
             file_name = output_dir+'pos-neg-location-'+nat+'.txt'
             outs[nat] = codecs.open(file_name, 'w', 'utf-8')
+        batched = context_generator is ContextVectorGenerators.ContextVectorGenerators.tokenize_add_all_generator
+        block = list()  # (elements, tokens) of the objects whose context vectors are yet to be computed
         with codecs.open(ground_truth_corpus, 'r', 'utf-8') as f:
             for line in f:
                 obj = json.loads(line.lower())
@@ -309,19 +542,55 @@ class TokenSupervised:
                     elements = obj['nationality'] # we know nationality is always a list
                     if not set(elements).intersection(valid_nats):
                         continue # not a valid nationality for us to use
-                    context_vec = context_generator(None, TextPreprocessors.TextPreprocessors._tokenize_field(obj, 'location'),
-                                                    full_embeddings)
+                    tokens = TextPreprocessors.TextPreprocessors._tokenize_field(obj, 'location')
+                    if batched:
+                        block.append((elements, tokens))
+                        if len(block) >= block_size:
+                            TokenSupervised._write_nationality_block(block, full_embeddings, outs)
+                            block = list()
+                        continue
+                    context_vec = context_generator(None, tokens, full_embeddings)
                     if not context_vec:
                         continue
-                    for element in elements:
-                        for k, v in outs.items():
-                            if k == element:
-                                v.write(element+'\t'+str(context_vec)+'\t1\n')
-                            else:
-                                v.write(element+'\t'+str(context_vec)+'\t0\n')
+                    TokenSupervised._write_nationality_rows(elements, context_vec, outs)
+        if block:
+            TokenSupervised._write_nationality_block(block, full_embeddings, outs)
         for v in outs.values():
             v.close()
 
+    @staticmethod
+    def _write_nationality_rows(elements, context_vec, outs):
+        """
+        Writes a row for each of elements to each of the nationality pos-neg files (see
+        construct_nationality_pos_neg_files)
+        :param elements: the nationalities of the object
+        :param context_vec: its context vector (a list)
+        :param outs: a dictionary of nationality -> open pos-neg file
+        :return: None
+        """
+        for element in elements:
+            for k, v in outs.items():
+                if k == element:
+                    v.write(element+'\t'+str(context_vec)+'\t1\n')
+                else:
+                    v.write(element+'\t'+str(context_vec)+'\t0\n')
+
+    @staticmethod
+    def _write_nationality_block(block, full_embeddings, outs):
+        """
+        Computes the context vectors of a block of objects with one sparse matrix multiply
+        (ContextVectorGenerators.tokenize_add_all_block) and writes their rows.
+        :param block: a list of (elements, tokens) tuples
+        :param full_embeddings:
+        :param outs: see _write_nationality_rows
+        :return: None
+        """
+        context_vecs, present = ContextVectorGenerators.ContextVectorGenerators.tokenize_add_all_block(
+            [tokens for elements, tokens in block], full_embeddings)
+        for i in range(0, len(block)):
+            if present[i]:
+                TokenSupervised._write_nationality_rows(block[i][0], context_vecs[i].tolist(), outs)
+
     @staticmethod
     def construct_nationality_multi_file(nationality_pos_neg_file, output_file,
                                          constraint_list = ['american', 'russian', 'turkish', 'swedish', 'indian']):
@@ -383,11 +652,104 @@ class TokenSupervised:
         print 'neg samples: '+str(len(neg))
         out = codecs.open(output_file, 'w', 'utf-8')
         for p in pos:
-            out.write(p+'\t'+str(full_embeddings[p])+'\t1\n')
+            out.write(p+'\t'+str(full_embeddings[p].tolist())+'\t1\n')
         for n in neg:
-            out.write(n+'\t'+str(full_embeddings[n])+'\t0\n')
+            out.write(n+'\t'+str(full_embeddings[n].tolist())+'\t0\n')
         out.close()
 
+    @staticmethod
+    def _l2_norm_in_place(vectors):
+        """
+        l2-normalizes the rows of a float numpy array without copying it.
+        :param vectors:
+        :return: vectors
+        """
+        if len(vectors):
+            warnings.filterwarnings("ignore")
+            normalize(vectors, copy=False)
+        return vectors
+
+    @staticmethod
+    def _read_pos_neg_text_file(pos_neg_file, numeric_labels=True, block_size=4096):
+        """
+        Bulk parser for the tab-delimited word, str(vector), label[, line number] files. Rather than building lists
+        of python floats (see _convert_string_to_float_list) and then a matrix, the vectors get parsed by numpy,
+        block_size rows at a time, straight into a preallocated float32 array. Every vector must have as many
+        values as the one on the first line; otherwise we raise an error with the line number.
+        :param pos_neg_file:
+        :param numeric_labels: if True, the labels are parsed into an int array. Otherwise (e.g. multi files)
+        they are kept as strings.
+        :param block_size: the number of vectors to parse per numpy call
+        :return: a dictionary with 'vectors', 'labels', 'line_nums' (-1 where there is no line number column)
+        and 'words', like FeatureFile.read
+        """
+        rows = 0
+        dimensions = 0
+        # the files are read as bytes, since decoding them line by line costs more than parsing the floats; only the
+        # words get decoded
+        with open(pos_neg_file, 'rb') as f:
+            for line in f:
+                if rows == 0:
+                    dimensions = len(line.split('\t')[1].split(','))
+                rows += 1
+        vectors = np.empty((rows, dimensions), dtype=np.float32)
+        line_nums = np.full(rows, -1, dtype=np.int64)
+        labels = list()
+        words = list()
+        block = list()
+        with open(pos_neg_file, 'rb') as f:
+            for i, line in enumerate(f):
+                cols = line.rstrip('\n').split('\t')
+                if cols[1].count(',')+1 != dimensions:
+                    raise Exception(pos_neg_file+', line '+str(i+1)+': expected a vector of '+str(dimensions)+
+                                    ' values, like on the first line, but got '+str(cols[1].count(',')+1))
+                block.append(cols[1][1:-1])
+                words.append(cols[0].decode('utf-8'))
+                labels.append(cols[2].decode('utf-8'))
+                if len(cols) > 3:
+                    line_nums[i] = int(cols[3])
+                if len(block) == block_size or i == rows-1:
+                    values = np.fromstring(','.join(block), dtype=np.float32, sep=',')
+                    if len(values) != len(block)*dimensions:
+                        TokenSupervised._raise_unparsable_row(pos_neg_file, block, i+1-len(block), dimensions)
+                    vectors[i+1-len(block):i+1] = values.reshape(len(block), dimensions)
+                    block = list()
+        if numeric_labels:
+            labels = np.array(labels, dtype=np.int64)
+        return {'vectors': vectors, 'labels': labels, 'line_nums': line_nums, 'words': words}
+
+    @staticmethod
+    def _raise_unparsable_row(pos_neg_file, block, first_row, dimensions):
+        """
+        Finds the row of a block that numpy could not parse into dimensions floats, and raises an error with its
+        line number.
+        :param pos_neg_file:
+        :param block: the vectors of the block, without their brackets
+        :param first_row: the (0-based) row of the first vector of the block
+        :param dimensions:
+        :return: does not return
+        """
+        for j in range(0, len(block)):
+            if len(np.fromstring(block[j], dtype=np.float32, sep=',')) != dimensions:
+                raise Exception(pos_neg_file+', line '+str(first_row+j+1)+': could not parse '+str(dimensions)+
+                                ' floats from the vector')
+        raise Exception(pos_neg_file+', lines '+str(first_row+1)+'-'+str(first_row+len(block))+
+                        ': could not parse the vectors')
+
+    @staticmethod
+    def _read_pos_neg_file(pos_neg_file, numeric_labels=True):
+        """
+        :param pos_neg_file: a pos-neg text file or a FeatureFile
+        :param numeric_labels: see _read_pos_neg_text_file. FeatureFile labels are always numeric.
+        :return: see _read_pos_neg_text_file. The vectors are l2-normalized (in place).
+        """
+        if FeatureFile.FeatureFile.is_feature_file(pos_neg_file):
+            features = FeatureFile.FeatureFile.read(pos_neg_file)
+        else:
+            features = TokenSupervised._read_pos_neg_text_file(pos_neg_file, numeric_labels)
+        TokenSupervised._l2_norm_in_place(features['vectors'])
+        return features
+
     @staticmethod
     def _prepare_multi_for_ML_classification(multi_file):
         """
@@ -398,70 +760,55 @@ class TokenSupervised:
         :return: dict
         """
         result = dict()
-        with codecs.open(multi_file, 'r', 'utf-8') as f:
-            for line in f:
-                line = line[0:-1]
-                cols = re.split('\t',line)
-                if cols[2] not in result:
-                    result[cols[2]] = list()
-                result[cols[2]].append(TokenSupervised._convert_string_to_float_list(cols[1]))
-        for k, v in result.items():
-            result[k] = TokenSupervised._l2_norm_on_matrix(np.matrix(v))
+        features = TokenSupervised._read_pos_neg_file(multi_file, numeric_labels=False)
+        labels = np.array(features['labels'])
+        for label in set(features['labels']):
+            result[label] = features['vectors'][labels == label]
         return result
 
     @staticmethod
     def _prepare_for_ML_classification(pos_neg_file):
         """
         We need to read in embeddings
-        :param pos_neg_file: The file generated in one of the preprocess_filtered_* files
+        :param pos_neg_file: The file generated in one of the preprocess_filtered_* files, or a FeatureFile
+        :return: A dictionary where a 0,1 label references a numpy matrix.
+        """
+        return TokenSupervised._split_features_by_label(TokenSupervised._read_pos_neg_file(pos_neg_file))
+
+    @staticmethod
+    def _split_features_by_label(features):
+        """
+        :param features: see _read_pos_neg_file or collect_context_rows
         :return: A dictionary where a 0,1 label references a numpy matrix.
         """
         result = dict()
-        pos_features = list()
-        neg_features = list()
-        with codecs.open(pos_neg_file, 'r', 'utf-8') as f:
-            for line in f:
-                line = line[0:-1]
-                cols = re.split('\t',line)
-                # break
-                if int(cols[2]) == 1:
-                    pos_features.append(TokenSupervised._convert_string_to_float_list(cols[1]))
-                elif int(cols[2]) == 0:
-                    neg_features.append(TokenSupervised._convert_string_to_float_list(cols[1]))
-                else:
-                    print 'error; label not recognized'
-        # print np.matrix(pos_features)
-        result[0] = TokenSupervised._l2_norm_on_matrix(np.matrix(neg_features))
-        result[1] = TokenSupervised._l2_norm_on_matrix(np.matrix(pos_features))
+        labels = features['labels']
+        if ((labels != 0) & (labels != 1)).any():
+            print 'error; label not recognized'
+        result[0] = features['vectors'][labels == 0]
+        result[1] = features['vectors'][labels == 1]
         return result
 
     @staticmethod
     def _prepare_actual_data_for_ML_classification(pos_neg_file):
         """
         We need to read in embeddings
-        :param pos_neg_file: The file generated in one of the preprocess_filtered_* files
+        :param pos_neg_file: The file generated in one of the preprocess_filtered_* files, or a FeatureFile
         :return: A dictionary where a 0,1 label references a numpy matrix.
         """
+        return TokenSupervised._features_as_actual_data(TokenSupervised._read_pos_neg_file(pos_neg_file))
+
+    @staticmethod
+    def _features_as_actual_data(features):
+        """
+        :param features: see _read_pos_neg_file or collect_context_rows
+        :return: the dictionary returned by _prepare_actual_data_for_ML_classification
+        """
         result = dict()
-        features = list()
-        words = list()
-        labels = list()
-        line_num = list()
-        with codecs.open(pos_neg_file, 'r', 'utf-8') as f:
-            for line in f:
-                line = line[0:-1]
-                cols = re.split('\t',line)
-                # print list(cols[1])
-                # break
-                features.append(TokenSupervised._convert_string_to_float_list(cols[1]))
-                words.append(cols[0])
-                labels.append(int(cols[2]))
-                line_num.append(cols[3])
-
-        result[0] = TokenSupervised._l2_norm_on_matrix(np.matrix(features))
-        result[2] = words
-        result[1] = labels
-        result[3] = line_num
+        result[0] = features['vectors']
+        result[2] = features['words']
+        result[1] = features['labels'].tolist()
+        result[3] = [str(n) for n in features['line_nums']]
         return result
 
     @staticmethod
@@ -616,17 +963,20 @@ class TokenSupervised:
         return np.append(list_of_vectors, new_data, axis=0)
 
     @staticmethod
-    def _prepare_all_data_as_train(pos_neg_file):
+    def _prepare_all_data_as_train(pos_neg_file, data_vectors=None):
         """
 
         :param pos_neg_file:
+        :param data_vectors: see _prepare_train_test_data
         :return: dictionary containing training/testing data/labels
         """
         print ">>Prepare All Data as Training Data<<"
         if pos_neg_file:
             data = TokenSupervised._prepare_for_ML_classification(pos_neg_file)
+        elif data_vectors:
+            data = data_vectors
         else:
-            raise Exception('No pos_neg_file is specified. Exiting.')
+            raise Exception('Neither pos_neg_file nor data_vectors argument is specified. Exiting.')
 
         train_pos_num = len(data[1])
         train_neg_num = len(data[0])
@@ -753,17 +1103,21 @@ class TokenSupervised:
 
     @staticmethod
 
-    def _prepare_actual_data(pos_neg_file):
+    def _prepare_actual_data(pos_neg_file, data_vectors=None):
         """
 
         :param pos_neg_file:
+        :param data_vectors: this should be set if pos_neg_file is None, to the dictionary that
+        _prepare_actual_data_for_ML_classification would have returned.
         :return: dictionary containing the data/labels along with words and line_nums
         """
         print ">>Prepare Actual Data<<"
         if pos_neg_file:
             data = TokenSupervised._prepare_actual_data_for_ML_classification(pos_neg_file)
+        elif data_vectors:
+            data = data_vectors
         else:
-            raise Exception('No pos_neg_file specified. Exiting.')
+            raise Exception('Neither pos_neg_file nor data_vectors argument is specified. Exiting.')
 
         results = dict()
         results['test_data'] = data[0]
@@ -1229,15 +1583,9 @@ class TokenSupervised:
             k = 5
             predicted_labels = list()
             # print len(test_data)
-            for t in test_data:
-                scores_dict = dict()
-                for i in range(0, len(train_data)):
-                    score = SimFunctions.SimFunctions.abs_dot_product_sim(train_data[i], t)
-                    label = train_labels[i]
-                    if score not in scores_dict:
-                        scores_dict[score] = list()
-                    scores_dict[score].append(label)
-                results = kNearestNeighbors._extract_top_k(scores_dict, k=k)
+            all_scores = SimFunctions.SimFunctions.abs_dot_product_sim_matrix(test_data, train_data)
+            for top in kNearestNeighbors._top_k_indices(all_scores, k=k):
+                results = [train_labels[i] for i in top]
                 predicted_labels.append(TokenSupervised._compute_majority_label_in_vector(results))
             predicted_labels = np.array(predicted_labels)
         elif classifier_model == 'logistic_regression':
@@ -1320,11 +1668,13 @@ class TokenSupervised:
             TokenSupervised._train_and_test_classifier(**data_dict)
 
     @staticmethod
-    def extract_model(pos_neg_file, opt=2):
+    def extract_model(pos_neg_file, opt=2, data_vectors=None):
         """
         Trains and returns the model dictionary
         :param pos_neg_file: e.g. token-supervised/pos-neg-eyeColor.txt
         :param opt:use this to determine which script to run.
+        :param data_vectors: if pos_neg_file is None, the dictionary _prepare_for_ML_classification would have
+        returned for it (e.g. from _split_features_by_label(collect_context_rows(...)))
         :return: model
         """
         print ">>Extract Model<<"
@@ -1334,7 +1684,7 @@ class TokenSupervised:
             #We do NOT do any kind of feature selection.
 
             #data_dict = TokenSupervised._prepare_train_test_data(pos_neg_file)
-            data_dict = TokenSupervised._prepare_all_data_as_train(pos_neg_file)
+            data_dict = TokenSupervised._prepare_all_data_as_train(pos_neg_file, data_vectors=data_vectors)
             # print data_dict['train_labels'][0]
             data_dict['classifier_model'] = 'manual_knn'
             model = TokenSupervised._train_classifier(**data_dict)
@@ -1348,7 +1698,7 @@ class TokenSupervised:
 
             #---For Testing----
             #Using Random Sample as Training Data
-            data_dict = TokenSupervised._prepare_train_test_data(pos_neg_file)
+            data_dict = TokenSupervised._prepare_train_test_data(pos_neg_file, data_vectors=data_vectors)
             #model_dict['k_best'] = TokenSupervised._select_k_best_features(data_dict, k=20)
             del data_dict['test_data']
             del data_dict['test_labels']
@@ -1359,12 +1709,17 @@ class TokenSupervised:
         return model_dict
     
     @staticmethod
-    def classify_data(model, pos_neg_file, opt=2):
+    def classify_data(model, pos_neg_file, opt=2, data_vectors=None, representatives=None):
         """
         Classifies the data in the pos_neg_file using the model passed
         :param model: model dictionary used having 'model' and 'k_best'(optional) transformation
         :param pos_neg_file: e.g. token-supervised/pos-neg-eyeColor.txt
         :param opt:use this to determine which script to run.
+        :param data_vectors: if pos_neg_file is None, the dictionary _prepare_actual_data_for_ML_classification
+        would have returned for it
+        :param representatives: if the data was deduplicated (see NearDuplicates), the line number of the
+        representative of each line. The results of representatives are copied to the rest of their groups (whose
+        lines have the same annotated values; see NearDuplicates.group_file).
         :return: model
         """
 
@@ -1373,17 +1728,22 @@ class TokenSupervised:
             #Test Set 1: read in data from pos_neg_file and use classifiers from scikit-learn/manual impl.
             #We do NOT do any kind of feature selection.
 
-            data_dict = TokenSupervised._prepare_actual_data(pos_neg_file)
+            data_dict = TokenSupervised._prepare_actual_data(pos_neg_file, data_vectors=data_vectors)
             # print data_dict['train_labels'][0]
             data_dict['classifier_model'] = 'manual_knn'
-            classified_cities = TokenSupervised._classify(model['model'], **data_dict)
         elif opt == 2:
             #Test Set 2: read in data from pos_neg_file and use classifiers from scikit-learn/manual impl.
             #We do feature selection.
-            data_dict = TokenSupervised._prepare_actual_data(pos_neg_file)
+            data_dict = TokenSupervised._prepare_actual_data(pos_neg_file, data_vectors=data_vectors)
             #TokenSupervised._select_same_k_best(model['k_best'], data_dict)
             data_dict['classifier_model'] = 'random_forest'
-            classified_cities = TokenSupervised._classify(model['model'], **data_dict)
+        if len(data_dict['line_num']) == 0:
+            # nothing to classify (e.g. no annotations in the actual data)
+            return {'classified_cities': [], 'combined_all_data': []}
+        classified_cities = TokenSupervised._classify(model['model'], **data_dict)
+        if representatives is not None:
+            classified_cities = NearDuplicates.NearDuplicates.fan_out_classified(classified_cities, representatives,
+                                                                            int(data_dict['line_num'][0]))
         return classified_cities
 
 
@@ -0,0 +1,40 @@
+from digTokenizerExtractor.tokenizer_extractor import TokenizerExtractor
+
+
+class TokenizerSession:
+    """
+    Holds one DIG TokenizerExtractor, so that we pay for setting up the tokenizer once per session rather than once
+    per object and field. The tokens are the same as the ones we used to get by running a fresh
+    ExtractorProcessor(TokenizerExtractor) chain over {'string': text}: lower-cased DIG tokens.
+
+    Create one per corpus (or use TokenizerSession.default(), which is per process) and call tokenize or
+    tokenize_batch on it.
+    """
+
+    _default_session = None
+
+    def __init__(self):
+        self.extractor = TokenizerExtractor()
+
+    @staticmethod
+    def default():
+        """
+        :return: the shared session of this process, created on first use
+        """
+        if TokenizerSession._default_session is None:
+            TokenizerSession._default_session = TokenizerSession()
+        return TokenizerSession._default_session
+
+    def tokenize(self, string):
+        """
+        :param string: e.g. the readability_text of an object
+        :return: a list of (lower-cased) tokens
+        """
+        return self.extractor.extract({'text': string})[0]
+
+    def tokenize_batch(self, strings):
+        """
+        :param strings: a list of strings
+        :return: a list with the list of tokens of each string, in order
+        """
+        return [self.tokenize(string) for string in strings]
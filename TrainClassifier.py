@@ -1,8 +1,17 @@
 import TextPreprocessors
 import TokenSupervised
 import ContextVectorGenerators
+import EmbeddingStore
+import EmbeddingTable
+import FeatureFile
+import LRUCache
+import NearDuplicates
+import PhraseMatcher
+import StageCache
+import TokenizerSession
 import os
 import codecs
+import json
 import sys
 from sklearn.externals import joblib
 
@@ -13,10 +22,141 @@ UNIGRAM_FILE = 'unigram-part-00000-v2.json'
 
 DATA_FOLDER = 'annotated-cities-trial' #Should be present in the path of this file
 
+TOKENIZE_CACHE_FILE = 'tokenize-string-cache.jl' #Written to the output folder, so later runs can reuse it
+
+FEATURE_FORMAT = 'binary' #'text' writes the old tab-delimited pos-neg files instead of FeatureFiles
+
+IN_MEMORY = False #If True, run in_memory_pipeline instead of writing and re-reading the intermediate files
+
+DEDUP = False #If True, only one representative per group of near-duplicate actual data lines gets classified
+
+WINDOW_SIZES = [2, 3, 5, 8] #For data_preparation_window_sweep
+
+#If True, only the text around the annotations gets tokenized (enough for windows of up to the largest of the
+#WINDOW_SIZES, and the default window of the context generators); see TextPreprocessors.preprocess_annotated_file
+REGION_TOKENIZATION = False
+
+SPARSE_EMBEDDINGS = False #If True, keep the (random-indexing) embeddings in CSR form and sum the windows sparsely
+
+#The size of the caches of context vectors of (word, window) pairs (one per embeddings table; see _context_cache and
+#ContextVectorGenerators.memoized_symmetric_generator)
+CONTEXT_CACHE_SIZE = 20000
+
+_context_caches = dict() #absolute path of the embeddings file -> (size and mtime of the file, LRUCache)
+
+STAGE_CACHE_FOLDER = None #e.g. 'stage-cache/', in the output folder, to only re-run the stages whose inputs changed
+
 # A supervised classification module that can be used for detecting wrong/right annotations
 
+def pos_neg_file_name(stage, output_format=FEATURE_FORMAT):
+    """
+    :param stage: 'train' or 'actual'
+    :param output_format: 'text' or 'binary'
+    :return: the name of the pos-neg file that data preparation writes for stage in the output folder
+    """
+    if output_format == 'binary':
+        return 'pos-neg-'+stage+'.features'
+    return 'pos-neg-'+stage+'.txt'
+
+def _tokenize_args(annotated_attribute, window_sizes=WINDOW_SIZES):
+    """
+    :param annotated_attribute: e.g. 'annotated_cities'
+    :param window_sizes: the window sizes the tokens are going to be used with
+    :return: the region tokenization arguments of TextPreprocessors.preprocess_annotated_file, if
+    REGION_TOKENIZATION, or an empty dictionary
+    """
+    if not REGION_TOKENIZATION:
+        return dict()
+    return {'annotated_field': annotated_attribute, 'window_size': max(list(window_sizes)+[5])}
+
+def _context_cache(embeddings_file):
+    """
+    Context vectors are only valid for the embeddings table they were summed from, so each embeddings file gets its
+    own cache, shared by all the data preparation stages that use it. If the file changed since its cache was
+    started (e.g. it was regenerated in place), a new one is started, just as EmbeddingStore.get_table loads a new
+    table then.
+    :param embeddings_file: the json lines embeddings file
+    :return: an LRUCache for memoized_symmetric_generator
+    """
+    key = os.path.abspath(embeddings_file)
+    stat = os.stat(embeddings_file)
+    signature = (stat.st_size, stat.st_mtime)
+    if key not in _context_caches or _context_caches[key][0] != signature:
+        _context_caches[key] = (signature, LRUCache.LRUCache(max_size=CONTEXT_CACHE_SIZE))
+    return _context_caches[key][1]
+
+def _data_preparation(data_file, embeddings_file, text_attribute, annotated_attribute, correct_attribute,
+                      output_folder, stage, restrict_vocabulary, workers, output_format, stage_cache, dedup=False):
+    """
+    The tokenize and featurize stages of data_preparation_for_training_data/data_preparation_for_actual_data.
+    Without a stage_cache, the tokens file and the pos-neg file get written to output_folder. With one, each stage
+    is keyed by the contents of its input files, its parameters (the text/annotated/correct attributes, the context
+    generator and the output format) and the code of the modules it runs, including the generator's default
+    window size, and only re-runs if one of those changed.
+    :param stage: 'train' or 'actual'
+    :param dedup: (actual data only) if True, only the representatives of groups of near-duplicate lines get
+    featurized, and the groups are written next to the pos-neg file (see NearDuplicates.groups_file_name)
+    :return: the path of the pos-neg file
+    """
+    prep_args = dict()
+    if stage == 'train':
+        prep = TokenSupervised.TokenSupervised.prep_preprocessed_annotated_file_for_classification
+    else:
+        prep = TokenSupervised.TokenSupervised.prep_preprocessed_actual_file_for_classification
+    context_generator = ContextVectorGenerators.ContextVectorGenerators.memoized_symmetric_generator
+    # a restricted embeddings table has its own rows, so its context vectors can't be shared
+    context_cache = None if restrict_vocabulary else _context_cache(embeddings_file)
+    if SPARSE_EMBEDDINGS:
+        context_generator = ContextVectorGenerators.ContextVectorGenerators.sparse_symmetric_generator
+        context_cache = None
+        prep_args['sparse_embeddings'] = True
+
+    def tokenize(tokens_file):
+        TextPreprocessors.TextPreprocessors.preprocess_annotated_file(data_file, text_attribute, tokens_file,
+                                                                      workers=workers, **tokenize_args)
+
+    tokenize_args = _tokenize_args(annotated_attribute)
+    if stage_cache is None:
+        tokens_file = output_folder+'tokens-file.jl'
+        tokenize(tokens_file)
+    else:
+        params = {'text_attribute': text_attribute}
+        params.update(tokenize_args)
+        tokens_file = stage_cache.run('tokenize', [data_file], params, [TextPreprocessors, TokenizerSession],
+                                      tokenize, suffix='.jl')
+
+    dedup = dedup and stage == 'actual'
+    if dedup:
+        prep_args['representatives'] = NearDuplicates.NearDuplicates.group_file(tokens_file, text_attribute,
+                                                                                 annotated_attribute)
+
+    def featurize(pos_neg_file):
+        prep(tokens_file, embeddings_file, pos_neg_file, context_generator, text_attribute, annotated_attribute,
+             correct_attribute, restrict_vocabulary=restrict_vocabulary, output_format=output_format,
+             context_cache=context_cache, **prep_args)
+
+    if stage_cache is None:
+        pos_neg_file = output_folder+pos_neg_file_name(stage, output_format)
+        featurize(pos_neg_file)
+    else:
+        params = {'text_attribute': text_attribute, 'annotated_attribute': annotated_attribute,
+                  'correct_attribute': correct_attribute, 'context_generator': context_generator.__name__,
+                  'output_format': output_format, 'dedup': dedup}
+        pos_neg_file = stage_cache.run('featurize-'+stage, [tokens_file, embeddings_file], params,
+                               [TokenSupervised, ContextVectorGenerators, EmbeddingStore, EmbeddingTable, PhraseMatcher,
+                                FeatureFile, TextPreprocessors, NearDuplicates], featurize,
+                               suffix=os.path.splitext(pos_neg_file_name(stage, output_format))[1])
+
+    groups_file = NearDuplicates.NearDuplicates.groups_file_name(pos_neg_file)
+    if dedup:
+        NearDuplicates.NearDuplicates.write_groups(prep_args['representatives'], groups_file)
+    elif os.path.exists(groups_file):
+        os.remove(groups_file)
+    return pos_neg_file
+
 def data_preparation_for_training_data(training_file, embeddings_file, text_attribute, annotated_attribute,
-                              correct_attribute, output_folder):
+                              correct_attribute, output_folder, restrict_vocabulary=False, workers=1,
+                              output_format=FEATURE_FORMAT, stage_cache=None):
     """
     At present, this script cannot deal with multi-token annotations (e.g. 'Mary Ann' or 'Salt lake city'). We
     will convert all tokens to lower-case; thus, case-differences will not be accounted for.
@@ -29,17 +169,20 @@ def data_preparation_for_training_data(training_file, embeddings_file, text_attr
     :param annotated_attribute: e.g. 'annotated_cities'
     :param correct_attribute: e.g. 'correct_cities'
     :param output_folder: a folder for writing out files in
-    :return: None
+    :param restrict_vocabulary: only load embeddings for tokens that occur in the (tokenized) text attribute
+    :param workers: the number of processes to tokenize with
+    :param output_format: 'binary' to write the pos-neg file as a FeatureFile, or 'text'
+    :param stage_cache: a StageCache. If specified, the files are written to (or reused from) the cache instead
+    of the output_folder.
+    :return: the path of the pos-neg file
     """
     print ">>Data Preparation for Training Data<<"
-    TextPreprocessors.TextPreprocessors.preprocess_annotated_file(training_file, text_attribute,
-                                                                  output_folder+'tokens-file.jl')
-    TokenSupervised.TokenSupervised.prep_preprocessed_annotated_file_for_classification(output_folder+'tokens-file.jl',
-                embeddings_file, output_folder+'pos-neg-train.txt',
-                ContextVectorGenerators.ContextVectorGenerators.symmetric_generator,
-                text_attribute, annotated_attribute, correct_attribute)
+    return _data_preparation(training_file, embeddings_file, text_attribute, annotated_attribute, correct_attribute,
+                             output_folder, 'train', restrict_vocabulary, workers, output_format, stage_cache)
 
-def data_preparation_for_actual_data(actual_file, embeddings_file, text_attribute, annotated_attribute, output_folder, correct_attribute):
+def data_preparation_for_actual_data(actual_file, embeddings_file, text_attribute, annotated_attribute, output_folder, correct_attribute,
+                                     restrict_vocabulary=False, workers=1, output_format=FEATURE_FORMAT,
+                                     stage_cache=None, dedup=False):
     """
     At present, this script cannot deal with multi-token annotations (e.g. 'Mary Ann' or 'Salt lake city'). We
     will convert all tokens to lower-case; thus, case-differences will not be accounted for.
@@ -51,36 +194,179 @@ def data_preparation_for_actual_data(actual_file, embeddings_file, text_attribut
     :param text_attribute: e.g. 'high_recall_readability_text'
     :param annotated_attribute: e.g. 'annotated_cities'
     :param output_folder: a folder for writing out files in
-    :return: None
+    :param restrict_vocabulary: only load embeddings for tokens that occur in the (tokenized) text attribute
+    :param workers: the number of processes to tokenize with
+    :param output_format: 'binary' to write the pos-neg file as a FeatureFile, or 'text'
+    :param stage_cache: a StageCache. If specified, the files are written to (or reused from) the cache instead
+    of the output_folder.
+    :param dedup: if True, near-duplicate lines are grouped and only one per group gets featurized (and
+    classified; see classification_script)
+    :return: the path of the pos-neg file
     """
     print ">>Data Preparation for Actual Data<<"
-    TextPreprocessors.TextPreprocessors.preprocess_annotated_file(actual_file, text_attribute,
-                                                                  output_folder+'tokens-file.jl')
-    TokenSupervised.TokenSupervised.prep_preprocessed_actual_file_for_classification(output_folder+'tokens-file.jl',
-                embeddings_file, output_folder+'pos-neg-actual.txt',
-                ContextVectorGenerators.ContextVectorGenerators.symmetric_generator,
-                text_attribute, annotated_attribute, correct_attribute)
+    return _data_preparation(actual_file, embeddings_file, text_attribute, annotated_attribute, correct_attribute,
+                             output_folder, 'actual', restrict_vocabulary, workers, output_format, stage_cache,
+                             dedup=dedup)
 
+def data_preparation_window_sweep(data_file, embeddings_file, text_attribute, annotated_attribute, correct_attribute,
+                                  output_folder, stage='train', window_sizes=WINDOW_SIZES, concatenate=False,
+                                  workers=1, output_format=FEATURE_FORMAT):
+    """
+    Data preparation for several context window sizes at once: the data gets tokenized once, and the context
+    vectors for all window sizes come out of one pass over the tokens file.
+    :param data_file: A file where each line is a json.
+    :param embeddings_file: At present, use the provided file; do not try to generate it yourself
+    :param text_attribute: e.g. 'high_recall_readability_text'
+    :param annotated_attribute: e.g. 'annotated_cities'
+    :param correct_attribute: e.g. 'correct_cities'
+    :param output_folder: a folder for writing out files in
+    :param stage: 'train' or 'actual'
+    :param window_sizes: a list of window sizes
+    :param concatenate: if True, we write one pos-neg file with the concatenated context vectors; otherwise one
+    per window size
+    :param workers: the number of processes to tokenize with
+    :param output_format: 'binary' to write the pos-neg files as FeatureFiles, or 'text'
+    :return: the list of the paths of the pos-neg files (in the order of window_sizes, unless concatenate)
+    """
+    print ">>Data Preparation Window Sweep ("+stage+")<<"
+    TextPreprocessors.TextPreprocessors.preprocess_annotated_file(data_file, text_attribute,
+                                output_folder+'tokens-file.jl', workers=workers,
+                                **_tokenize_args(annotated_attribute, window_sizes))
+    pos_neg_file = output_folder+pos_neg_file_name(stage, output_format)
+    TokenSupervised.TokenSupervised.prep_preprocessed_file_for_window_sweep(output_folder+'tokens-file.jl',
+                embeddings_file, pos_neg_file, text_attribute, annotated_attribute, correct_attribute,
+                window_sizes=window_sizes, concatenate=concatenate, line_nums=(stage == 'actual'),
+                output_format=output_format)
+    if concatenate:
+        return [pos_neg_file]
+    return [TokenSupervised.TokenSupervised.window_sweep_file_name(pos_neg_file, w) for w in window_sizes]
+
+def _tee_tokens_file(objs, tokens_file):
+    """
+    Writes the preprocessed objects to tokens_file (as preprocess_annotated_file would) as they go by.
+    """
+    out = codecs.open(tokens_file, 'w', 'utf-8')
+    for obj in objs:
+        json.dump(obj, out)
+        out.write('\n')
+        yield obj
+    out.close()
+
+def _tee_representatives(objs, text_attribute, annotated_attribute, representatives):
+    """
+    Appends the representative of each of the preprocessed objects to representatives as they go by. Only objects
+    with the same annotated values get grouped.
+    """
+    near_duplicates = NearDuplicates.NearDuplicates()
+    for obj in objs:
+        key = NearDuplicates.NearDuplicates.annotations_key(obj, annotated_attribute)
+        representatives.append(near_duplicates.add(obj[text_attribute], key))
+        yield obj
+
+def in_memory_data_preparation(data_file, embeddings_file, text_attribute, annotated_attribute, correct_attribute,
+                               stage, debug_folder=None, workers=1, dedup=False):
+    """
+    The fused version of data_preparation_for_training_data/data_preparation_for_actual_data: documents get
+    streamed through tokenization and context vector generation straight into a feature matrix, without writing
+    and re-parsing the tokens file and the pos-neg file.
+    :param data_file: A file where each line is a json.
+    :param embeddings_file: At present, use the provided file; do not try to generate it yourself
+    :param text_attribute: e.g. 'high_recall_readability_text'
+    :param annotated_attribute: e.g. 'annotated_cities'
+    :param correct_attribute: e.g. 'correct_cities'
+    :param stage: 'train' or 'actual'
+    :param debug_folder: if specified, the intermediate files (tokens-file.jl and the pos-neg file) still get
+    written to it, as a side effect of the stream
+    :param workers: the number of processes to tokenize with
+    :param dedup: (actual data only) if True, only the representatives of groups of near-duplicate lines get
+    featurized, and the features get a 'representatives' list (see NearDuplicates)
+    :return: the features (see TokenSupervised.collect_context_rows)
+    """
+    print ">>In-memory Data Preparation ("+stage+")<<"
+    objs = (obj for obj in TextPreprocessors.TextPreprocessors.preprocess_annotated_stream(data_file, text_attribute,
+                            workers=workers, **_tokenize_args(annotated_attribute)) if obj is not None)
+    if debug_folder:
+        objs = _tee_tokens_file(objs, debug_folder+'tokens-file.jl')
+    representatives = None
+    if dedup and stage == 'actual':
+        representatives = list()
+        objs = _tee_representatives(objs, text_attribute, annotated_attribute, representatives)
+    if SPARSE_EMBEDDINGS:
+        rows = TokenSupervised.TokenSupervised.generate_context_rows(objs, text_attribute, annotated_attribute,
+                correct_attribute, EmbeddingStore.EmbeddingStore.get_sparse_table(embeddings_file),
+                ContextVectorGenerators.ContextVectorGenerators.sparse_symmetric_generator, None, representatives)
+    else:
+        rows = TokenSupervised.TokenSupervised.generate_context_rows(objs, text_attribute, annotated_attribute,
+                correct_attribute, EmbeddingStore.EmbeddingStore.get_table(embeddings_file),
+                ContextVectorGenerators.ContextVectorGenerators.memoized_symmetric_generator,
+                _context_cache(embeddings_file), representatives)
+    if debug_folder:
+        rows = TokenSupervised.TokenSupervised.tee_context_rows(rows, debug_folder+pos_neg_file_name(stage, FEATURE_FORMAT),
+                                                                FEATURE_FORMAT, line_nums=(stage == 'actual'))
+    features = TokenSupervised.TokenSupervised.collect_context_rows(rows)
+    if representatives is not None:
+        features['representatives'] = representatives
+    return features
+
+def in_memory_pipeline(training_file, actual_file, embeddings_file, text_attribute, annotated_attribute,
+                       correct_attribute, GENERATE, debug_folder=None, workers=1, dedup=False):
+    """
+    Data preparation and classification_script in one go, without intermediate files (unless debug_folder is
+    specified; see in_memory_data_preparation). The model is used as trained, rather than re-loaded from disk.
+    If dedup, only one representative per group of near-duplicate actual data lines gets classified, and its
+    results are copied to the rest of the group.
+    :return: the classified data, or None if GENERATE is 1
+    """
+    training = in_memory_data_preparation(training_file, embeddings_file, text_attribute, annotated_attribute,
+                                          correct_attribute, 'train', debug_folder=debug_folder, workers=workers)
+    print ">>Classification Script<<"
+    model = TokenSupervised.TokenSupervised.extract_model(None,
+                            data_vectors=TokenSupervised.TokenSupervised._split_features_by_label(training))
+    persist(model)
+    if(GENERATE == 1):
+        return None
+
+    actual = in_memory_data_preparation(actual_file, embeddings_file, text_attribute, annotated_attribute,
+                                        correct_attribute, 'actual', debug_folder=debug_folder, workers=workers,
+                                        dedup=dedup)
+    return TokenSupervised.TokenSupervised.classify_data(model, None,
+                            data_vectors=TokenSupervised.TokenSupervised._features_as_actual_data(actual),
+                            representatives=actual.get('representatives'))
 
 def post_processing(classified_cities, actual_data_file):
     TextPreprocessors.TextPreprocessors.post_processing(classified_cities, actual_data_file, type=TYPE)
                     
-def classification_script(pos_neg_file_training, pos_neg_file_actual_data, GENERATE):
+def classification_script(pos_neg_file_training, pos_neg_file_actual_data, GENERATE, stage_cache=None):
     """
     Run this code after running a data preparation script.
     Prints out a bunch of metrics.
-    :param pos_neg_file: This is the pos-neg-file.txt generated by data preparation in the output folder.
+    :param pos_neg_file: This is the pos-neg file generated by data preparation in the output folder.
+    :param stage_cache: a StageCache. If specified, the model is only re-trained if the training data or the
+    code changed.
+    If the actual data was deduplicated (see data_preparation_for_actual_data), the results of each group's
+    representative are copied to the rest of the group.
     :return: None
     """
     print ">>Classification Script<<"
     #TokenSupervised.TokenSupervised.trial_script_binary(pos_neg_file_training)
-    model = TokenSupervised.TokenSupervised.extract_model(pos_neg_file_training)
+    if stage_cache is None:
+        model = TokenSupervised.TokenSupervised.extract_model(pos_neg_file_training)
+    else:
+        def train(model_file):
+            joblib.dump(TokenSupervised.TokenSupervised.extract_model(pos_neg_file_training), model_file)
+        model = joblib.load(stage_cache.run('train', [pos_neg_file_training], {'opt': 2}, [TokenSupervised], train,
+                                            suffix='.pkl'))
     persist(model)
     if(GENERATE == 1):
         return None
 
     model['model'] = joblib.load('model.pkl')
-    return TokenSupervised.TokenSupervised.classify_data(model, pos_neg_file_actual_data)
+    representatives = None
+    groups_file = NearDuplicates.NearDuplicates.groups_file_name(pos_neg_file_actual_data)
+    if os.path.exists(groups_file):
+        representatives = NearDuplicates.NearDuplicates.read_groups(groups_file)
+    return TokenSupervised.TokenSupervised.classify_data(model, pos_neg_file_actual_data,
+                                                         representatives=representatives)
 
 def persist(classifier):
     if('scaler' in classifier):
@@ -112,12 +398,32 @@ if __name__ == '__main__':
     print "Only Generate Model File", GENERATE
 
     path = os.path.dirname(os.path.abspath(__file__)) + '/'+DATA_FOLDER+'/'
-    data_preparation_for_training_data(path+TRAINING_FILE, path+UNIGRAM_FILE,'readability_text', 'annotated_'+TYPE, 'correct_'+TYPE, path+'output_folder/')
+    if os.path.exists(path+'output_folder/'+TOKENIZE_CACHE_FILE):
+        TextPreprocessors.TextPreprocessors.load_tokenize_string_cache(path+'output_folder/'+TOKENIZE_CACHE_FILE)
+    if IN_MEMORY:
+        classified_cities = in_memory_pipeline(path+TRAINING_FILE, path+ACTUAL_FILE, path+UNIGRAM_FILE,
+                                    'readability_text', 'annotated_'+TYPE, 'correct_'+TYPE, GENERATE, dedup=DEDUP)
+    else:
+        stage_cache = None
+        if STAGE_CACHE_FOLDER:
+            stage_cache = StageCache.StageCache(path+'output_folder/'+STAGE_CACHE_FOLDER)
+        pos_neg_file_training = data_preparation_for_training_data(path+TRAINING_FILE, path+UNIGRAM_FILE,'readability_text', 'annotated_'+TYPE, 'correct_'+TYPE, path+'output_folder/', stage_cache=stage_cache)
 
-    if(GENERATE != 1):
-        data_preparation_for_actual_data(path+ACTUAL_FILE, path+UNIGRAM_FILE,'readability_text', 'annotated_'+TYPE, path+'output_folder/', 'correct_'+TYPE)
+        pos_neg_file_actual_data = None
+        if(GENERATE != 1):
+            pos_neg_file_actual_data = data_preparation_for_actual_data(path+ACTUAL_FILE, path+UNIGRAM_FILE,'readability_text', 'annotated_'+TYPE, path+'output_folder/', 'correct_'+TYPE, stage_cache=stage_cache, dedup=DEDUP)
+
+    # both data preparation stages shared one embeddings table; we don't need it past this point
+    EmbeddingStore.EmbeddingStore.release(path+UNIGRAM_FILE)
+    ContextVectorGenerators.ContextVectorGenerators.clear_document_cache()
+    print "Annotation tokenization cache:", TextPreprocessors.TextPreprocessors.tokenize_string_cache_stats()
+    print "Context vector cache:", _context_cache(path+UNIGRAM_FILE).stats()
+    _context_caches.clear()
+    TextPreprocessors.TextPreprocessors.save_tokenize_string_cache(path+'output_folder/'+TOKENIZE_CACHE_FILE)
 
-    classified_cities = classification_script(path+'output_folder/pos-neg-train.txt', path+'output_folder/pos-neg-actual.txt', GENERATE)
+    if not IN_MEMORY:
+        classified_cities = classification_script(pos_neg_file_training, pos_neg_file_actual_data, GENERATE,
+                                                  stage_cache=stage_cache)
     
     if(GENERATE != 1):
         post_processing(classified_cities, path+ACTUAL_FILE)
\ No newline at end of file
@@ -1,70 +1,76 @@
 import codecs
+import heapq
 import json
 import math
 import SimFunctions
+import EmbeddingStore
+import NeighborGraph
 import pprint
+import numpy as np
+from scipy import sparse
 
 
-def _extract_top_k(scored_results_dict, k, disable_k=False, reverse=True):
-    """
+# the random-indexing placeholder tokens, which are never anybody's neighbors
+DUMMY_TOKENS = ['dummy_punct', 'dummy_alpha_num', 'dummy_alpha_punct', 'dummy_idf', 'dummy_num', 'dummy_unicode']
+
 
-    :param scored_results_dict: a score always references a list
-    :param k: Max. size of returned list.
-    :param disable_k: ignore k, and sort the list by k
-    :param reverse: if reverse is true, the top k will be the highest scoring k. If reverse is false,
-    top k will be the lowest scoring k.
-    :return:
+def _top_k_pairs(pairs, k, nearest=True):
+    """
+    Streaming top k: keeps a heap of (at most) k pairs, so memory stays O(k) however many pairs there are.
+    :param pairs: an iterable of (score, item)
+    :param k:
+    :param nearest: if True, the k highest scores are kept; otherwise the k lowest
+    :return: the (at most) k kept items, best first. Ties go to the earlier pair.
     """
+    if k <= 0:
+        return list()
+    heap = list()  # the root is the worst kept pair: the lowest (highest, if not nearest) score, latest among ties
+    sign = 1 if nearest else -1
     count = 0
-    # print k
-    results = list()
-    scores = scored_results_dict.keys()
-    scores.sort(reverse=reverse)
-    for score in scores:
-        # print score
-        # print count
-        if count >= k and not disable_k:
-            break
-        vals = scored_results_dict[score]
-        if disable_k:
-            results += vals
-            continue
-        if count + len(vals) <= k:
-            results += vals
-            count = len(results)
-        else:
-            results += vals[0: k - count]
-            count = len(results)
-    # print results[0]
-    return results
-
-
-def _compute_abs_cosine_sim(vector1, vector2):
-    return SimFunctions.SimFunctions.abs_cosine_sim(vector1, vector2)
-
-
-def _generate_scored_dict(unigram_embeddings, seed_token):
-    scored_dict = dict()
-    seed_vector = unigram_embeddings[seed_token]
-    for token, vector in unigram_embeddings.items():
-        if token == seed_token:
-            continue
-        else:
-            score = _compute_abs_cosine_sim(seed_vector, vector)
-            if score not in scored_dict:
-                scored_dict[score] = list()
-            scored_dict[score].append(token)
-    return scored_dict
+    for score, item in pairs:
+        entry = (sign*score, -count, item)
+        count += 1
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[0:2] > heap[0][0:2]:
+            heapq.heapreplace(heap, entry)
+    heap.sort(key=lambda entry: entry[0:2], reverse=True)
+    return [entry[2] for entry in heap]
+
+
+def _top_k_indices(scores, k, nearest=True):
+    """
+    Top k over a score array, with argpartition (see _merge_top_k) rather than a sort of every score.
+    :param scores: a 1-d array, or a 2-d array whose rows are selected from independently
+    :param k:
+    :param nearest: if True, the indices of the k highest scores; otherwise those of the k lowest
+    :return: an array with the (at most) k indices of each row, best first. Ties go to the lower index.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    vector = scores.ndim == 1
+    if vector:
+        scores = scores[np.newaxis, :]
+    if k <= 0:
+        return np.zeros((len(scores), 0), dtype=np.int64)[0 if vector else slice(None)]
+    if not nearest:
+        scores = -scores
+    best_scores, best_indices = _merge_top_k(np.zeros((len(scores), 0)), np.zeros((len(scores), 0), dtype=np.int64),
+                                             scores, np.arange(scores.shape[1], dtype=np.int64), k)
+    rows = np.arange(len(scores))[:, np.newaxis]
+    best_indices = best_indices[rows, np.lexsort((best_indices, -best_scores))]
+    return best_indices[0] if vector else best_indices
 
 
 def read_in_embeddings(embeddings_file):
-    unigram_embeddings = dict()
-    with codecs.open(embeddings_file, 'r', 'utf-8') as f:
-        for line in f:
-            obj = json.loads(line)
-            for k, v in obj.items():
-                unigram_embeddings[k] = v
-    return unigram_embeddings
+    """
+    The json lines file gets converted to a memory-mapped binary store the first time we see it, and the table is
+    registered for the rest of the process (see EmbeddingStore), so this is cheap after the first call.
+    The returned table is shared; do not modify it.
+    :param embeddings_file: a json lines file, with each line of the form {token: vector}
+    :return: an EmbeddingTable, which behaves like a dictionary where each token references its (float32,
+    read-only) vector
+    """
+    return EmbeddingStore.EmbeddingStore.get_table(embeddings_file)
 
 
 @DeprecationWarning
@@ -77,8 +83,147 @@ def find_k_nearest_neighbors(embeddings_file, seed_token, k=10):
     :return: None
     """
     unigram_embeddings = read_in_embeddings(embeddings_file)
-    scored_dict = _generate_scored_dict(unigram_embeddings, seed_token)
-    print _extract_top_k(scored_dict, k=k, disable_k=False)
+    print k_nearest_neighbors_blocked(unigram_embeddings, [seed_token], k=k)[seed_token]
+
+
+def _embeddings_block_reader(unigram_embeddings, tokens):
+    """
+    :param unigram_embeddings: an EmbeddingTable or a {token: vector} dict
+    :param tokens: the tokens to read, in order
+    :return: a function that takes (start, end) and returns the float64 vectors of tokens[start:end]
+    """
+    if hasattr(unigram_embeddings, 'indices'):
+        return _matrix_block_reader(unigram_embeddings.matrix, unigram_embeddings.indices(tokens))
+    return lambda start, end: np.array([unigram_embeddings[token] for token in tokens[start:end]],
+                                       dtype=np.float64).reshape((end-start, -1))
+
+
+def _matrix_block_reader(matrix, rows):
+    """
+    :param matrix: the (dense or CSR) matrix of an EmbeddingTable
+    :param rows: the rows to read, in order
+    :return: a function that takes (start, end) and returns the float64 vectors of rows[start:end]
+    """
+    if sparse.issparse(matrix):
+        return lambda start, end: matrix[rows[start:end]].toarray().astype(np.float64)
+    return lambda start, end: np.asarray(matrix[rows[start:end]], dtype=np.float64)
+
+
+def _inverse_norms(read_block, num_tokens, block_size=4096):
+    """
+    :param read_block: see _embeddings_block_reader
+    :param num_tokens:
+    :param block_size:
+    :return: the inverse of the norm of each vector, or 0.0 for all-zero vectors (which then score 0.0, as in
+    abs_cosine_sim)
+    """
+    norms = np.concatenate([SimFunctions.SimFunctions.row_norms(read_block(start, min(start+block_size, num_tokens)))
+                            for start in range(0, num_tokens, block_size)] or [np.zeros(0)])
+    inverse_norms = np.zeros(num_tokens)
+    inverse_norms[norms != 0.0] = 1.0/norms[norms != 0.0]
+    return inverse_norms
+
+
+def _merge_top_k(best_scores, best_indices, scores, indices, k):
+    """
+    Keeps the k highest scores of each row of [best_scores, scores]. Ties go to the lower index.
+    :param best_scores: a seeds x (at most) k array (-inf for excluded entries)
+    :param best_indices: the vocabulary indices of best_scores
+    :param scores: a seeds x block array of new scores
+    :param indices: the vocabulary indices of the columns of scores (or of each of its entries, if 2-d)
+    :param k:
+    :return: the new (best_scores, best_indices), in no particular order
+    """
+    if indices.ndim == 1:
+        indices = np.tile(indices, (len(scores), 1))
+    all_scores = np.concatenate((best_scores, scores), axis=1)
+    all_indices = np.concatenate((best_indices, indices), axis=1)
+    if all_scores.shape[1] > k:
+        top = np.argpartition(-all_scores, k-1, axis=1)[:, 0:k]
+        rows = np.arange(len(all_scores))[:, np.newaxis]
+        kth = all_scores[rows, top].min(axis=1)
+        # argpartition picks arbitrarily among the scores tied with the k-th one; redo those rows by index
+        tied = np.flatnonzero((all_scores >= kth[:, np.newaxis]).sum(axis=1) > k)
+        for row in tied:
+            candidates = np.flatnonzero(all_scores[row] >= kth[row])
+            order = np.lexsort((all_indices[row, candidates], -all_scores[row, candidates]))
+            top[row] = candidates[order[0:k]]
+        all_scores = all_scores[rows, top]
+        all_indices = all_indices[rows, top]
+    return all_scores, all_indices
+
+
+def _blocked_top_k(read_block, inverse_norms, seed_positions, k, column_start=0, block_size=4096,
+                   seed_block_size=1024):
+    """
+    The core of k_nearest_neighbors_blocked, over positions rather than tokens.
+    :param read_block: see _embeddings_block_reader
+    :param inverse_norms: see _inverse_norms
+    :param seed_positions: an int array with the positions of the seeds
+    :param k:
+    :param column_start: only the positions from column_start on are candidate neighbors
+    :param block_size:
+    :param seed_block_size:
+    :return: a tuple (scores, indices) of len(seed_positions) x (at most) k arrays, with the neighbors of each seed
+    by decreasing score (ties by increasing position). Missing neighbors (fewer than k candidates) score -inf.
+    """
+    num_tokens = len(inverse_norms)
+    width = min(k, max(num_tokens-column_start, 0))
+    all_scores = np.full((len(seed_positions), width), -np.inf)
+    all_indices = np.zeros((len(seed_positions), width), dtype=np.int64)
+    for seed_start in range(0, len(seed_positions), seed_block_size):
+        seeds = seed_positions[seed_start:seed_start+seed_block_size]
+        queries = np.array([read_block(p, p+1)[0] for p in seeds]).reshape((len(seeds), -1)) \
+                  * inverse_norms[seeds][:, np.newaxis]
+        best_scores = np.full((len(seeds), 0), -np.inf)
+        best_indices = np.zeros((len(seeds), 0), dtype=np.int64)
+        for start in range(column_start, num_tokens, block_size):
+            end = min(start+block_size, num_tokens)
+            block = read_block(start, end) * inverse_norms[start:end][:, np.newaxis]
+            scores = np.abs(queries.dot(block.T))
+            # a seed is not its own neighbor
+            own = np.flatnonzero((seeds >= start) & (seeds < end))
+            scores[own, seeds[own]-start] = -np.inf
+            best_scores, best_indices = _merge_top_k(best_scores, best_indices, scores,
+                                                     np.arange(start, end, dtype=np.int64), k)
+        order = np.lexsort((best_indices, -best_scores))
+        rows = np.arange(len(seeds))[:, np.newaxis]
+        all_scores[seed_start:seed_start+len(seeds)] = best_scores[rows, order]
+        all_indices[seed_start:seed_start+len(seeds)] = best_indices[rows, order]
+    return all_scores, all_indices
+
+
+def k_nearest_neighbors_blocked(unigram_embeddings, seed_tokens, k=10, block_size=4096, seed_block_size=1024):
+    """
+    The k nearest neighbors (by absolute cosine similarity) of many seed tokens at once. The row norms of the
+    vocabulary are computed once; then each block of seeds is scored against each block of the vocabulary with
+    one matrix multiply, and only the running top k per seed is kept (argpartition, not a sort of every score).
+    Memory stays around seed_block_size x block_size scores, however big the vocabulary. Neighbors come in
+    order of decreasing score; ties go to the token that comes first in unigram_embeddings.keys().
+    :param unigram_embeddings: an EmbeddingTable or a {token: vector} dict
+    :param seed_tokens: a list of tokens that must be in unigram_embeddings
+    :param k:
+    :param block_size: the number of vocabulary vectors scored at a time
+    :param seed_block_size: the number of seeds scored at a time
+    :return: a dictionary where each seed token references the list of its (at most) k nearest tokens
+    """
+    if k <= 0:
+        return dict((seed_token, list()) for seed_token in seed_tokens)
+    tokens = list(unigram_embeddings.keys())
+    positions = dict()
+    for i in range(0, len(tokens)):
+        positions[tokens[i]] = i
+    seed_tokens = list(seed_tokens)
+    seed_positions = np.array([positions[seed_token] for seed_token in seed_tokens], dtype=np.int64)
+    read_block = _embeddings_block_reader(unigram_embeddings, tokens)
+    inverse_norms = _inverse_norms(read_block, len(tokens), block_size)
+    scores, indices = _blocked_top_k(read_block, inverse_norms, seed_positions, k, block_size=block_size,
+                                     seed_block_size=seed_block_size)
+    results = dict()
+    for i in range(0, len(seed_tokens)):
+        results[seed_tokens[i]] = [tokens[indices[i][j]] for j in range(0, scores.shape[1])
+                                   if scores[i][j] != -np.inf]
+    return results
 
 
 def find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=10, suppress_print=True):
@@ -88,22 +233,14 @@ def find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=10, suppress_
     :param seed_tokens: a set of tokens that must occur in the embeddings_file
     :param k:
     :param suppress_print
-    :return: None
+    :return: a dictionary where each seed token references the list of its k nearest neighbors (see
+    k_nearest_neighbors_blocked)
     """
-    results = dict()
-    unigram_embeddings = read_in_embeddings(embeddings_file)
-
-    # let's remove the dummies.
-    del unigram_embeddings['dummy_punct']
-    del unigram_embeddings['dummy_alpha_num']
-    del unigram_embeddings['dummy_alpha_punct']
-    del unigram_embeddings['dummy_idf']
-    del unigram_embeddings['dummy_num']
-    del unigram_embeddings['dummy_unicode']
+    # let's remove the dummies. The table is shared, so we take a copy of its index rather than deleting.
+    unigram_embeddings = read_in_embeddings(embeddings_file).without(DUMMY_TOKENS)
 
+    results = k_nearest_neighbors_blocked(unigram_embeddings, seed_tokens, k=k)
     for seed_token in seed_tokens:
-        scored_dict = _generate_scored_dict(unigram_embeddings, seed_token)
-        results[seed_token]=_extract_top_k(scored_dict, k=k, disable_k=False)
         if not suppress_print:
             print 'seed_token: ',
             print seed_token
@@ -112,62 +249,36 @@ def find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=10, suppress_
     return results
 
 
-def _reverse_dict(dictionary):
-        """
-        Borrowed from FieldAnalyses.
-        Turn keys into (lists of) values, and values into keys. Values must originally be primitive.
-        :param dictionary:
-        :return: Another dictionary
-        """
-        new_dict = dict()
-        for k, v in dictionary.items():
-            if v not in new_dict:
-                new_dict[v] = list()
-            new_dict[v].append(k)
-        return new_dict
-
-
-def prune_low_scores_from_score_dict(score_dict, threshold):
-    """
-    Modifies score_dict
-    :param score_dict:
-    :param threshold: any entries (strictly) below this threshold get deleted
-    :return: None
-    """
-    k = score_dict.keys()
-    for score in k:
-        if score < threshold:
-            del score_dict[score]
-
-
-def supplement_dictionary_v1(input_dictionary_file, embeddings_file, output_dictionary_file, threshold=5, k=20):
+def supplement_dictionary_v1(input_dictionary_file, embeddings_file, output_dictionary_file, threshold=5, k=20,
+                             workers=1):
     """
     It's okay if there are words in the dictionary file that are not in the embeddings file. See threshold
-    description below.
+    description below. The top-k lists are looked up in the neighbor graph of the embeddings file (see
+    NeighborGraph), which gets built the first time.
     :param dictionary_file:
     :param embeddings_file:
     :param threshold: a word must show up at least this many top-k lists generated for the words in
      the dictionary file.
+    :param workers: the number of processes to build the neighbor graph with, if it has to be built
     :return: None
     """
     seed_tokens = list()
     all_seed_tokens = set()
-    word_embeddings = read_in_embeddings(embeddings_file).keys()
+    graph = NeighborGraph.NeighborGraph.get(embeddings_file, k=k, workers=workers)
     total_seed_tokens = 0
     with codecs.open(input_dictionary_file, 'r', 'utf-8') as f:
         for line in f:
             line = line.lower()
             token = line[0:-1]
             all_seed_tokens.add(token)
-            if token in word_embeddings:
+            if token in graph:
                 seed_tokens.append(token)
             total_seed_tokens += 1
     print 'number of total seed tokens in dictionary: ',
     print total_seed_tokens
     print 'number of seed tokens in dictionary that are also in embeddings: ',
     print len(seed_tokens)
-    del word_embeddings
-    knn_multi_dict = find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=k)
+    knn_multi_dict = dict((seed_token, graph.neighbors(seed_token, k)) for seed_token in seed_tokens)
     dict_words = set(_get_knn_multi_dict_counts(knn_multi_dict, prune=threshold).keys())
     dict_words = dict_words.union(all_seed_tokens)
     out = codecs.open(output_dictionary_file, 'w', 'utf-8')
@@ -202,13 +313,14 @@ def _get_knn_multi_dict_counts(knn_multi_dict, prune=5):
 
 
 @DeprecationWarning
-def supplement_dictionary_v0(dictionary_file, embeddings_file, k=20):
+def supplement_dictionary_v0(dictionary_file, embeddings_file, k=20, workers=1):
     """
     At present dictionary_file must only contain words that are in embeddings, otherwise I'll raise an exception
     Will print a list of words that should be included but aren't, in increasing order of probability.
     :param dictionary_file:
     :param embeddings_file:
     :param k:
+    :param workers: see supplement_dictionary_v1
     :return: None
     """
     seed_tokens = list()
@@ -216,7 +328,8 @@ def supplement_dictionary_v0(dictionary_file, embeddings_file, k=20):
         for line in f:
             seed_tokens.append(line[0:-1])
 
-    knn_multi_dict = find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=k)
+    knn_multi_dict = NeighborGraph.NeighborGraph.find_k_nearest_neighbors_multi(embeddings_file, seed_tokens, k=k,
+                                                                                 workers=workers)
     results = dict()  # only contains tokens that do not occur in dictionary_file
     seed_tokens = set(seed_tokens)
     for v in knn_multi_dict.values():
@@ -227,10 +340,8 @@ def supplement_dictionary_v0(dictionary_file, embeddings_file, k=20):
             if val not in results:
                 results[val] = 0
             results[val] += (len(v)-i)
-    score_dict = _reverse_dict(results)
-    prune_low_scores_from_score_dict(score_dict, threshold=200)
     pp = pprint.PrettyPrinter(indent=4)
-    pp.pprint(_extract_top_k(score_dict, k=0, disable_k=True))
+    pp.pprint(_top_k_pairs(((score, val) for val, score in results.items() if score >= 200), k=len(results)))
 
 #
 # path = '/Users/mayankkejriwal/ubuntu-vm-stuff/home/mayankkejriwal/Downloads/memex-cp4-october/'
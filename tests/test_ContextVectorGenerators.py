@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+from ContextVectorGenerators import ContextVectorGenerators
+from EmbeddingTable import EmbeddingTable
+from LRUCache import LRUCache
+
+
+class TestTokenizeAddAllBlock(unittest.TestCase):
+
+    def setUp(self):
+        self.embeddings = {'a': [1.0, 2.0], 'b': [3.0, 4.0]}
+        self.table = EmbeddingTable(['a', 'b'], np.array([[1.0, 2.0], [3.0, 4.0]], dtype=np.float32))
+
+    def test_matches_generator(self):
+        lists_of_words = [['a', 'b', 'a'], ['zz'], ['b']]
+        for embeddings in (self.embeddings, self.table):
+            context_vecs, present = ContextVectorGenerators.tokenize_add_all_block(lists_of_words, embeddings)
+            self.assertEqual(present.tolist(), [True, False, True])
+            for i in (0, 2):
+                self.assertEqual(context_vecs[i].tolist(), ContextVectorGenerators.tokenize_add_all_generator(
+                    None, lists_of_words[i], embeddings))
+
+    def test_all_out_of_vocabulary(self):
+        for embeddings in (self.embeddings, self.table):
+            context_vecs, present = ContextVectorGenerators.tokenize_add_all_block([['zz'], ['yy']], embeddings)
+            self.assertEqual(context_vecs.shape, (2, 2))
+            self.assertFalse(present.any())
+            self.assertIsNone(ContextVectorGenerators.tokenize_add_all_generator(None, ['zz'], embeddings))
+
+
+class TestMemoizedSymmetricGenerator(unittest.TestCase):
+
+    def test_matches_symmetric_generator_across_documents(self):
+        embeddings = {'x': [10.0, 0.0], 'a': [1.0, 1.0], 'b': [0.0, 0.0], 'c': [5.0, 6.0], 'd': [2.0, 3.0]}
+        table = EmbeddingTable(sorted(embeddings), np.array([embeddings[w] for w in sorted(embeddings)]))
+        documents = [['x', 'a', 'b'], ['x', 'c', 'b'], ['d', 'x', 'zz', 'a'], ['x', 'a', 'b', 'x'], ['zz', 'x']]
+        for embeddings_dict in (embeddings, table):
+            context_cache = LRUCache()
+            for list_of_words in documents:
+                expected = ContextVectorGenerators.symmetric_generator('x', list_of_words, embeddings_dict,
+                                                                       window_size=1)
+                actual = ContextVectorGenerators.memoized_symmetric_generator('x', list_of_words, embeddings_dict,
+                                                                              window_size=1,
+                                                                              context_cache=context_cache)
+                self.assertEqual(actual, expected)
+            self.assertTrue(context_cache.hits > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
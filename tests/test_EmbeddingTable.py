@@ -0,0 +1,20 @@
+import unittest
+import numpy as np
+from EmbeddingTable import EmbeddingTable
+
+
+class TestEmbeddingTable(unittest.TestCase):
+
+    def test_tables_cannot_be_modified(self):
+        table = EmbeddingTable(['a', 'b'], np.array([[1.0, 2.0], [3.0, 4.0]], dtype=np.float32))
+        with self.assertRaises(Exception):
+            del table['a']
+        self.assertTrue('a' in table)
+        without = table.without(['a'])
+        self.assertFalse('a' in without)
+        self.assertTrue('a' in table)
+        self.assertEqual(without['b'].tolist(), [3.0, 4.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
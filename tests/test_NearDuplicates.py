@@ -0,0 +1,17 @@
+import unittest
+from NearDuplicates import NearDuplicates
+
+
+class TestNearDuplicates(unittest.TestCase):
+
+    def test_groups_only_matching_keys(self):
+        tokens = u'call me tonight at the downtown hotel for a good time'.split()
+        near_duplicates = NearDuplicates()
+        self.assertEqual(near_duplicates.add(tokens, key=u'["portland"]'), 0)
+        self.assertEqual(near_duplicates.add(list(tokens), key=u'["portland"]'), 0)
+        self.assertEqual(near_duplicates.add(list(tokens), key=u'["paris"]'), 2)
+        self.assertEqual(near_duplicates.add(u'something else entirely different here'.split()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import codecs
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import EmbeddingStore
+import kNearestNeighbors
+from NeighborGraph import NeighborGraph
+
+
+class TestNeighborGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.embeddings_file = os.path.join(self.folder, 'embeddings.json')
+        random_state = np.random.RandomState(1)
+        out = codecs.open(self.embeddings_file, 'w', 'utf-8')
+        for i in range(0, 40):
+            out.write(json.dumps({u'w'+str(i): random_state.randn(4).tolist()}))
+            out.write('\n')
+        out.close()
+        NeighborGraph._registry.clear()
+
+    def tearDown(self):
+        NeighborGraph._registry.clear()
+        EmbeddingStore.EmbeddingStore.release()
+        shutil.rmtree(self.folder)
+
+    def test_get_does_not_read_an_unchanged_file(self):
+        graph = NeighborGraph.get(self.embeddings_file, k=5)
+        file_crc = NeighborGraph._file_crc
+
+        def fail(*args):
+            raise AssertionError('the embeddings file was read')
+
+        NeighborGraph._file_crc = staticmethod(fail)
+        try:
+            self.assertIs(NeighborGraph.get(self.embeddings_file, k=5), graph)
+        finally:
+            NeighborGraph._file_crc = staticmethod(file_crc)
+        mtime = os.path.getmtime(self.embeddings_file)+10
+        os.utime(self.embeddings_file, (mtime, mtime))
+        touched = NeighborGraph.get(self.embeddings_file, k=5)
+        self.assertTrue(touched.is_current(self.embeddings_file))
+        self.assertEqual(touched.indices.tolist(), graph.indices.tolist())
+
+    def test_pool_matches_one_process(self):
+        table = EmbeddingStore.EmbeddingStore.get_table(self.embeddings_file)
+        rows = NeighborGraph._graph_rows(table)
+        read_block = kNearestNeighbors._matrix_block_reader(table.matrix, rows)
+        inverse_norms = kNearestNeighbors._inverse_norms(read_block, len(rows), 8)
+        seeds = np.arange(len(rows), dtype=np.int64)
+        expected = NeighborGraph._top_k(self.embeddings_file, table, rows, inverse_norms, seeds, 5, block_size=8)
+        pooled = NeighborGraph._top_k(self.embeddings_file, table, rows, inverse_norms, seeds, 5, workers=2,
+                                      block_size=8, chunk_size=7)
+        self.assertEqual(pooled[0].tolist(), expected[0].tolist())
+        self.assertEqual(pooled[1].tolist(), expected[1].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
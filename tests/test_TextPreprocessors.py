@@ -0,0 +1,23 @@
+import unittest
+from TextPreprocessors import TextPreprocessors
+
+
+class TestTokenizeRegions(unittest.TestCase):
+
+    @staticmethod
+    def _windows(tokens, word, window_size):
+        return [tokens[max(i-window_size, 0):i+window_size+1] for i in range(0, len(tokens)) if tokens[i] == word]
+
+    def test_same_windows_as_full_tokenization(self):
+        filler = u' '.join([u'w'+str(i) for i in range(0, 20)])
+        for text in [u'aa jj blue_green kk ' + filler + u' yy blue zz',
+                     u'blue_ ' + filler + u' _blue x-blue ' + filler + u' <b>blue</b>, bluegreen blue2 blue']:
+            obj = {'text': text, 'annotated': [u'blue']}
+            full = TextPreprocessors._tokenize_field(obj, 'text')
+            regions = TextPreprocessors._tokenize_regions(obj, 'text', 'annotated', 2)
+            self.assertTrue(len(regions) < len(full))
+            self.assertEqual(self._windows(regions, u'blue', 2), self._windows(full, u'blue', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
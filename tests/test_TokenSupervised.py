@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from TokenSupervised import TokenSupervised
+
+
+class TestReadPosNegTextFile(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.pos_neg_file = tempfile.mkstemp(suffix='.txt')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.pos_neg_file)
+
+    def _read(self, vectors, block_size=4096):
+        with open(self.pos_neg_file, 'wb') as out:
+            for i in range(0, len(vectors)):
+                out.write('w'+str(i)+'\t['+vectors[i]+']\t1\t'+str(i)+'\n')
+        return TokenSupervised._read_pos_neg_text_file(self.pos_neg_file, block_size=block_size)
+
+    def test_read(self):
+        for block_size in (1, 2, 4096):
+            features = self._read(['1.0, 2.0, 3.0', '4.0, 5.0, 6.0', '7.0, 8.0, 9.0'], block_size)
+            self.assertEqual(features['vectors'].tolist(), [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+            self.assertEqual(features['line_nums'].tolist(), [0, 1, 2])
+
+    def test_ragged_rows(self):
+        for block_size in (1, 4096):
+            with self.assertRaisesRegexp(Exception, 'line 2'):
+                self._read(['1.0, 2.0, 3.0', '4.0, 5.0', '6.0, 7.0, 8.0, 9.0'], block_size)
+
+    def test_unparsable_row(self):
+        for block_size in (1, 4096):
+            with self.assertRaisesRegexp(Exception, 'line 3'):
+                self._read(['1.0, 2.0, 3.0', '4.0, 5.0, 6.0', '7.0,, 9.0'], block_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import codecs
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import TrainClassifier
+
+
+class TestContextCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.training_file = os.path.join(self.folder, 'training.jl')
+        out = codecs.open(self.training_file, 'w', 'utf-8')
+        for text, annotated, correct in [(u'her eyes are blue and bright', [u'blue'], [u'blue']),
+                                         (u'blue car for sale , call now', [u'blue'], []),
+                                         (u'her eyes are blue and bright', [u'blue'], [u'blue'])]:
+            out.write(json.dumps({'text': text, 'annotated_eye-color': annotated, 'correct_eye-color': correct}))
+            out.write('\n')
+        out.close()
+        TrainClassifier._context_caches.clear()
+
+    def tearDown(self):
+        TrainClassifier._context_caches.clear()
+        shutil.rmtree(self.folder)
+
+    def _write_embeddings(self, embeddings_file, sign, mtime=None):
+        vocabulary = [u'her', u'eyes', u'are', u'blue', u'and', u'bright', u'car', u'for', u'sale', u',', u'call']
+        out = codecs.open(embeddings_file, 'w', 'utf-8')
+        for i in range(0, len(vocabulary)):
+            out.write(json.dumps({vocabulary[i]: [sign*(i+1.0), sign*0.5]}))
+            out.write('\n')
+        out.close()
+        if mtime is not None:
+            os.utime(embeddings_file, (mtime, mtime))
+
+    def _prepare(self, embeddings_file, name):
+        output_folder = os.path.join(self.folder, name)+'/'
+        os.makedirs(output_folder)
+        pos_neg_file = TrainClassifier.data_preparation_for_training_data(self.training_file, embeddings_file,
+                                    'text', 'annotated_eye-color', 'correct_eye-color', output_folder,
+                                    output_format='text')
+        with codecs.open(pos_neg_file, 'r', 'utf-8') as f:
+            return f.read()
+
+    def _fresh(self, embeddings_file):
+        TrainClassifier._context_caches.clear()
+        return self._prepare(embeddings_file, 'fresh')
+
+    def test_two_tables(self):
+        embeddings_file = os.path.join(self.folder, 'embeddings.json')
+        negated_file = os.path.join(self.folder, 'negated.json')
+        self._write_embeddings(embeddings_file, 1.0)
+        self._write_embeddings(negated_file, -1.0)
+        first = self._prepare(embeddings_file, 'first')
+        second = self._prepare(negated_file, 'second')
+        self.assertNotEqual(first, second)
+        self.assertEqual(second, self._fresh(negated_file))
+
+    def test_regenerated_in_place(self):
+        embeddings_file = os.path.join(self.folder, 'embeddings.json')
+        self._write_embeddings(embeddings_file, 1.0)
+        first = self._prepare(embeddings_file, 'first')
+        self._write_embeddings(embeddings_file, -1.0, mtime=os.path.getmtime(embeddings_file)+10)
+        second = self._prepare(embeddings_file, 'second')
+        self.assertNotEqual(first, second)
+        self.assertEqual(second, self._fresh(embeddings_file))
+
+
+if __name__ == '__main__':
+    unittest.main()